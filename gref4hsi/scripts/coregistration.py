@@ -1,21 +1,26 @@
 import configparser
 import os
 import time
+from concurrent.futures import ProcessPoolExecutor
 from glob import glob
 
 import numpy as np
-import spectral as sp
 
 from gref4hsi.utils.gis_tools import GeoSpatialAbstractionHSI
-from gref4hsi.utils.parsing_utils import Hyperspectral
+from gref4hsi.utils.parsing_utils import Hyperspectral, alphanum_key, config_option, infer_transect_structure
+from gref4hsi.utils.footprint_index import footprint_index_path, read_aoi, chunks_in_aoi, is_chunk_in_aoi
+from gref4hsi.utils.reference_keypoints import reference_keypoint_index_path, build_reference_keypoint_index, compare_hsi_composite_with_keypoint_index
+from gref4hsi.utils.reference_rasters import reference_raster_service
+from gref4hsi.utils.gcp_store import GCPStoreWriter, gcp_store_path, list_gcp_store, read_gcp_store
 import gref4hsi.utils.geometry_utils as geom_utils
 from gref4hsi.utils.geometry_utils import CalibHSI, GeoPose
 
 from scipy.spatial.transform import Rotation as RotLib
 from scipy.optimize import least_squares
-from scipy.interpolate import interp1d, RBFInterpolator
+from scipy.interpolate import interp1d, BSpline, RBFInterpolator
 import pandas as pd
-from scipy.sparse import lil_matrix
+import rasterio
+from scipy import sparse
 import pymap3d as pm
 import matplotlib.pyplot as plt
 from pykrige import OrdinaryKriging
@@ -23,53 +28,12 @@ from sklearn.utils import resample
 from sklearn.model_selection import train_test_split
 from scipy.signal import medfilt
 
-import re
-
-def tryint(s):
-    try:
-        return int(s)
-    except:
-        return s
-
-def alphanum_key(s):
-    """ Turn a string into a list of string and number chunks.
-        "z23a" -> ["z", 23, "a"]
-    """
-    return [ tryint(c) for c in re.split('([0-9]+)', s) ]
-
 def sort_nicely(l):
     """ Sort the given list in the way that humans expect.
     """
     l.sort(key=alphanum_key)
 
 
-def infer_transect_structure(h5_dir, h5_folder_time_scanlines):
-
-
-    transect = {}
-    timestamp_prev = -1
-    
-    for h5_filename in sorted(os.listdir(h5_dir), key=alphanum_key):
-        h5_filepath = os.path.join(h5_dir, h5_filename)
-        # Assuming sorted dir
-        time_scanlines = Hyperspectral.get_dataset(h5_filename=h5_filepath,
-                                                                dataset_name= h5_folder_time_scanlines)
-        
-        if timestamp_prev == -1: # meaning first iteration
-            current_transect_nr = 0
-            transect[current_transect_nr] = [h5_filepath]
-            
-        elif time_scanlines[0] - timestamp_prev < 1: # second (arbitrary)
-            transect[current_transect_nr].append(h5_filepath)
-        else: # New transect
-            current_transect_nr += 1
-            transect[current_transect_nr] = [h5_filepath]
-
-        timestamp_prev = time_scanlines[-1]
-
-    return transect
-
-
 def _get_time_nodes(node_partition, df, h5_folder_time_scanlines, time_node_spacing):
     """Finds all the time nodes and scanline timestamps for each feature
     """
@@ -223,84 +187,142 @@ def apply_cam_and_pose_params(is_calibrated, h5_filename, param_optimized, h5_pa
                     param_dict = camera_model_dict_updated)
 
 
-def numerical_jacobian(fun, param, eps=1e-6, **kwargs):
-  """
-  Computes the Jacobian of a function using central differences.
+class FeaturePack:
+    """
+    The features (GCPs) of a solve packed into contiguous float64 arrays once, so that evaluations of the objective do not index the data frame.
+    The rotations are converted once, and the interpolation weights from the time nodes to the features and scanlines are cached for the last nodes.
+    """
+    def __init__(self, features_df):
+        """
+        :param features_df: The features, with the columns of the GCP file
+        :type features_df: pandas.DataFrame
+        """
+        def columns(names):
+            return np.ascontiguousarray(np.vstack([features_df[name].to_numpy(dtype=np.float64) for name in names]).transpose())
+        
+        self.n = features_df.shape[0]
 
-  Args:
-      fun: The function for which to compute the Jacobian.
-      param: The parameters of the function.
-      eps: A small epsilon value for numerical differentiation.
+        # The position of the vehicle body and the reference points in ECEF
+        self.pos_body = columns(['position_x', 'position_y', 'position_z'])
+        self.points_world_reference = columns(['reference_points_x', 'reference_points_y', 'reference_points_z'])
 
-  Returns:
-      A numpy array representing the Jacobian.
-  """
-  n_param = len(param)
-  n_fun = len(fun(param, **kwargs))
-  jacobian = np.zeros((n_fun, n_param))
-  for i in range(n_param):
-    param_pos = param.copy()
-    param_neg = param.copy()
-    param_pos[i] += eps
-    param_neg[i] -= eps
-    jacobian[:, i] = (fun(param_pos, **kwargs) - fun(param_neg, **kwargs)) / (2 * eps)
-  return jacobian
+        # The observed pixel and time of each feature
+        self.pixel_nr = np.ascontiguousarray(features_df['pixel_nr'].to_numpy(dtype=np.float64))
+        self.unix_time = np.ascontiguousarray(features_df['unix_time'].to_numpy(dtype=np.float64))
 
+        # The rotation of the body with respect to NED and from NED to ECEF
+        self.rot_body_ned = RotLib.from_quat(columns(['quat_body_to_ned_x', 'quat_body_to_ned_y', 'quat_body_to_ned_z', 'quat_body_to_ned_w']))
+        self.rot_ned_ecef = RotLib.from_quat(columns(['quat_ned_to_ecef_x', 'quat_ned_to_ecef_y', 'quat_ned_to_ecef_z', 'quat_ned_to_ecef_w']))
 
-def assemble_jacobian_pattern(is_variab_param_intr, is_variab_param_extr, n_features):
+        self.R_body_ned = self.rot_body_ned.as_matrix()
+        self.R_ned_ecef = self.rot_ned_ecef.as_matrix()
 
+        self._weights = None
+    
+    @classmethod
+    def from_features(cls, features):
+        """Packs a data frame of features, while a FeaturePack is returned as is"""
+        if isinstance(features, cls):
+            return features
+        return cls(features)
+    
+    def interpolation_weights(self, time_nodes, time_interpolation_method, time_scanlines):
+        """The interpolation weights from the time nodes to the features and to the scanlines (see interpolation_weights). 
+        Not defined for 'gaussian' time interpolation.
+
+        :return: The weights of the features and the scanlines
+        :rtype: scipy.sparse.csr_matrix (n, n_nodes), scipy.sparse.csr_matrix (m, n_nodes)
+        """
+        if self._weights is not None:
+            method, nodes, scanlines, weights = self._weights
+            if method == time_interpolation_method and np.array_equal(nodes, time_nodes) and np.array_equal(scanlines, time_scanlines):
+                return weights
+        
+        weights = (interpolation_weights(time_nodes, self.unix_time, time_interpolation_method), 
+                   interpolation_weights(time_nodes, time_scanlines, time_interpolation_method))
+        
+        self._weights = (time_interpolation_method, np.array(time_nodes), np.array(time_scanlines), weights)
 
-    n_param_tot_static = len(is_variab_param_intr)
-    n_variab_param_static = sum(is_variab_param_intr==1)
-    n_adjustable_dofs = sum(is_variab_param_extr==1)
-    n_variab_param_time_varying = n_adjustable_dofs*n_features # Work with flattened vectors
+        return weights
 
-    n_cols = n_variab_param_static + n_variab_param_time_varying
-    n_rows = 2*n_features + n_variab_param_time_varying # Latter is added to penalize errors
 
+def jacobian_sparsity_pattern(features_df, is_variab_param_intr, is_variab_param_extr, time_nodes, time_interpolation_method, time_scanlines):
+    """The sparsity pattern of the Jacobian of objective_fun_reprojection_error, derived from the model rather than probed. The reprojection errors of a feature depend on the
+    static (intrinsic) parameters and on the few time nodes whose interpolation covers its timestamp, and the penalty term of a scanline on the nodes covering the scanline. 
+    The pattern is built as a CSR matrix in O(features x support).
 
-    sparsity = lil_matrix((n_rows, n_cols), dtype=int)
-    
-    # Iterate Static parameters (not time-varying)
-    param_count = 0
-    for i in range(n_param_tot_static):
-        if bool(is_variab_param_intr[i]):
-            # take from the parameter vector (assuming that they are ordered the same way)
+    :param features_df: The features
+    :type features_df: pandas.DataFrame or FeaturePack
+    :param is_variab_param_intr: Array describing which of the 11 intrinsic parameters to be calibrated (boresight, lever arm, cam calib)
+    :type is_variab_param_intr: ndarray (11,) bool
+    :param is_variab_param_extr: Array describing which of the 6 intrinsic pose time series to be calibrated (posX, posY, posZ, roll, pitch, yaw)
+    :type is_variab_param_extr: ndarray (6,) bool
+    :param time_nodes: The time of the time nodes
+    :type time_nodes: ndarray (n_nodes,)
+    :param time_interpolation_method: The interpolation of the time nodes, see interpolate_time_nodes
+    :type time_interpolation_method: string
+    :param time_scanlines: The time of the scanlines
+    :type time_scanlines: ndarray (m,)
+    :return: The pattern, with ones where the Jacobian may be nonzero
+    :rtype: scipy.sparse.csr_matrix (n_residuals, n_param)
+    """
+    features = FeaturePack.from_features(features_df)
 
-            # All camera parameters affect the reprojection error in x
-            sparsity[0:n_features, param_count] = 1
+    n_features = features.n
 
-            # These params rx, ry, rz, f, tx, ty, tz affect the reprojection error in y
-            if i in [0, 1, 2, 4, 8, 9, 10]:
-                sparsity[n_features:2*n_features, param_count] = 1
-            
-            param_count += 1
-    
-    
-    param_count_ext = 0
-    for i in range(6):
-        if bool(is_variab_param_extr[i]):
-            # take from the parameter vector (assuming that they are ordered the same way)
+    # All camera parameters affect the reprojection error in x, while the principal point and distortions (cx, k1, k2, k3) do not affect it in y
+    is_variab_param_static = np.array(is_variab_param_intr) == 1
+    affects_y = np.isin(np.arange(len(is_variab_param_intr)), [0, 1, 2, 4, 8, 9, 10])
 
-            row_list_x = np.arange(n_features)
-            row_list_y = n_features + np.arange(n_features)
-            col_list = n_variab_param_static + param_count_ext*n_features + np.arange(n_features)
-            
+    pattern_x = sparse.csr_matrix(np.ones((n_features, is_variab_param_static.sum()), dtype=np.int64))
+    pattern_y = sparse.csr_matrix(np.tile(affects_y[is_variab_param_static].astype(np.int64), (n_features, 1)))
 
+    if np.all(is_variab_param_extr==0):
+        return sparse.vstack((pattern_x, pattern_y), format='csr')
 
-            row_list_err = 2*n_features + np.arange(n_variab_param_time_varying)
-            col_list_err = n_variab_param_static + np.arange(n_variab_param_time_varying)
-
+    # Each adjusted DOF adds a block of node parameters
+    support_features = interpolation_support(time_nodes, features.unix_time, time_interpolation_method)
+    support_scanlines = interpolation_support(time_nodes, time_scanlines, time_interpolation_method)
+    
+    blocks_obs = []
+    blocks_penalty = []
+    for i in range(6):
+        if is_variab_param_extr[i]:
+            blocks_obs.append(support_features)
 
-            # A time varying error only affects it's corresponding feature
-            sparsity[row_list_x, col_list] = 1
-            sparsity[row_list_y, col_list] = 1
-            sparsity[row_list_err, col_list_err] = 1
+            # Roll errors are not penalized, see calculate_pose_param
+            if i != 3:
+                blocks_penalty.append(support_scanlines)
+            else:
+                blocks_penalty.append(sparse.csr_matrix(support_scanlines.shape, dtype=np.int64))
 
-            param_count_ext += 1
+    pattern_obs = sparse.vstack((sparse.hstack([pattern_x] + blocks_obs), 
+                                 sparse.hstack([pattern_y] + blocks_obs)))
+            
+    pattern_penalty = sparse.hstack((sparse.csr_matrix((len(blocks_penalty)*support_scanlines.shape[0], pattern_x.shape[1]), dtype=np.int64), 
+                                     sparse.block_diag(blocks_penalty)))
+    
+    return sparse.vstack((pattern_obs, pattern_penalty), format='csr')
+    
+def interpolation_support(time_from, time_to, method = 'linear'):
+    """The time nodes that each interpolated time depends on, i.e. the pattern of interpolation_weights. Kriging ('gaussian') depends on all nodes.
 
+    :param time_from: The time of the time_nodes
+    :type time_from: ndarray (n,)
+    :param time_to: The queried time points
+    :type time_to: ndarray (m,)
+    :param method: The interpolation method, see interpolate_time_nodes, defaults to 'linear'
+    :type method: str, optional
+    :return: Ones where the interpolated value depends on the node
+    :rtype: scipy.sparse.csr_matrix (m, n)
+    """
+    if method == 'gaussian':
+        return sparse.csr_matrix(np.ones((np.size(time_to), np.size(time_from)), dtype=np.int64))
+            
+    support = interpolation_weights(time_from, time_to, method).tocsr(copy=True)
+    support.data = np.ones(support.data.size, dtype=np.int64)
 
-    return sparsity
+    return support
 
 
 
@@ -313,7 +335,7 @@ def interpolate_time_nodes(time_from, value, time_to, method = 'linear'):
     :type value: ndarray (6, n)
     :param time_to: The queried time points for interpolation
     :type time_to: ndarray (m,)
-    :param method: ['nearest', 'linear', 'slinear', 'quadratic', 'cubic'], defaults to 'linear'
+    :param method: ['nearest', 'linear', 'slinear', 'quadratic', 'cubic', 'bspline', 'gaussian', 'none'], defaults to 'linear'
     :type method: str, optional
     :return: _description_
     :rtype: interpolated values (6, n)
@@ -339,6 +361,10 @@ def interpolate_time_nodes(time_from, value, time_to, method = 'linear'):
 
 
         return vals
+    elif method in ['bspline']:
+        # A sparse product with the basis of the B-spline
+        return np.asarray((interpolation_weights(time_from, time_to, method) @ value.T).T)
+    
     elif method in ['gaussian']:
         
         
@@ -389,6 +415,68 @@ def interpolate_time_nodes(time_from, value, time_to, method = 'linear'):
             return interpolate_time_nodes(time_from, value, time_to, method = 'linear')
 
 
+def interpolation_weights(time_from, time_to, method = 'linear'):
+    """The weights of interpolate_time_nodes as a sparse matrix W, such that interpolate_time_nodes(time_from, value, time_to, method) equals (W @ value.T).T.
+    All methods except 'gaussian' are linear in the values, including the nearest node extrapolation outside the time nodes.
+
+    :param time_from: The time of the time_nodes (error parameters)
+    :type time_from: ndarray (n,)
+    :param time_to: The queried time points for interpolation
+    :type time_to: ndarray (m,)
+    :param method: ['nearest', 'linear', 'slinear', 'quadratic', 'cubic', 'bspline', 'none'], defaults to 'linear'
+    :type method: str, optional
+    :return: The weights
+    :rtype: scipy.sparse.csr_matrix (m, n)
+    """
+    time_from = np.asarray(time_from, dtype=np.float64)
+    time_to = np.asarray(time_to, dtype=np.float64)
+
+    n = time_from.size
+    m = time_to.size
+
+    if method == 'none':
+        if n == m:
+            return sparse.identity(n, format='csr')
+        method = 'linear'
+
+    if n == 1:
+        # A constant error
+        return sparse.csr_matrix(np.ones((m, 1)))
+
+    if method in ['linear', 'slinear']:
+        # Two nodes per time, where times outside the nodes take the nearest node
+        j = np.clip(np.searchsorted(time_from, time_to, side='right') - 1, 0, n - 2)
+        w = np.clip((time_to - time_from[j])/(time_from[j + 1] - time_from[j]), 0, 1)
+
+        rows = np.concatenate((np.arange(m), np.arange(m)))
+        cols = np.concatenate((j, j + 1))
+        vals = np.concatenate((1 - w, w))
+    elif method == 'nearest':
+        # As interp1d, halfway between nodes rounds down
+        j = np.clip(np.searchsorted(0.5*(time_from[1:] + time_from[:-1]), time_to, side='left'), 0, n - 1)
+
+        rows = np.arange(m)
+        cols = j
+        vals = np.ones(m)
+    elif method in ['quadratic', 'cubic']:
+        # Splines are linear in the values, so the weights are the interpolated unit vectors
+        return sparse.csr_matrix(interpolate_time_nodes(time_from, np.eye(n), time_to, method=method).T)
+    elif method == 'bspline':
+        # A smooth alternative to kriging. The node values are the control points of a cubic B-spline clamped to the first and last node,
+        # so each time depends on at most 4 nodes (the curve approximates, rather than passes through, the node values). Times outside the nodes take the end values
+        degree = min(3, n - 1)
+        start = (degree + 1)//2
+        knots = np.concatenate((np.repeat(time_from[0], degree + 1), 
+                                time_from[start:start + n - degree - 1], 
+                                np.repeat(time_from[-1], degree + 1)))
+        
+        return sparse.csr_matrix(BSpline.design_matrix(np.clip(time_to, time_from[0], time_from[-1]), knots, degree))
+    else:
+        raise ValueError(f'The interpolation method {method} has no interpolation weights')
+    
+    return sparse.csr_matrix((vals, (rows, cols)), shape=(m, n))
+
+
 def plot_estimated_errors(unix_time_scans, time_nodes=None, param_pose_tot=None, vals_mu=None, vals_sigma=None):
 
 
@@ -521,18 +609,22 @@ def plot_estimated_errors(unix_time_scans, time_nodes=None, param_pose_tot=None,
 
 
 
-def compose_pose_errors(param_pose_tot, time_nodes, unix_time_features, rot_body_ned, rot_ned_ecef, pos_body, time_interpolation_method, pos_err_ref_frame, sigma_param, sigma_nodes = None, plot_error = False):
-    """Takes a (6*n_node) vector of errors, interpolates and composes (adds) them to the pose from the navigation data"""
+def compose_pose_errors(param_pose_tot, time_nodes, unix_time_features, rot_body_ned, rot_ned_ecef, pos_body, time_interpolation_method, pos_err_ref_frame, sigma_param, sigma_nodes = None, plot_error = False, weights = None):
+    """Takes a (6*n_node) vector of errors, interpolates and composes (adds) them to the pose from the navigation data. 
+    The interpolation is a product with the weights (see interpolation_weights) if given"""
     n_features = len(unix_time_features)
 
     # Interpolate to the right time
     if time_interpolation_method != 'gaussian':
         
         # Interpolate the errors
-        err_interpolated = interpolate_time_nodes(time_nodes, 
-                                                param_pose_tot,
-                                                time_to = unix_time_features, 
-                                                method=time_interpolation_method).transpose()
+        if weights is not None:
+            err_interpolated = np.asarray(weights @ param_pose_tot.transpose())
+        else:
+            err_interpolated = interpolate_time_nodes(time_nodes, 
+                                                    param_pose_tot,
+                                                    time_to = unix_time_features, 
+                                                    method=time_interpolation_method).transpose()
         
         # If available interpolate standard deviations
         if sigma_nodes is not None:
@@ -678,7 +770,7 @@ def calculate_intrinsic_param(is_variab_param_intr, param, param0, as_calib_obj
         return param_vec_total
 
 
-def calculate_pose_param(is_variab_param_extr, is_variab_param_intr, param, sigma=None, time_nodes = None, time_scanlines=None, time_interpolation_method=None):
+def calculate_pose_param(is_variab_param_extr, is_variab_param_intr, param, sigma=None, time_nodes = None, time_scanlines=None, time_interpolation_method=None, weights_scanlines=None):
     """Calculate a (6,n) pose vector from the parameter vector
 
     :param is_variab_param_extr: Boolean array saying which pose degrees of freedom are variable (to be adjusted)
@@ -687,6 +779,8 @@ def calculate_pose_param(is_variab_param_extr, is_variab_param_intr, param, sigm
     :type is_variab_param_intr: ndarray (11,) bool
     :param param: parameter vector
     :type param: ndarray (n_variab_param_static + 6*n,) 
+    :param weights_scanlines: The interpolation weights from the time nodes to the scanlines, used instead of interpolate_time_nodes if given, defaults to None
+    :type weights_scanlines: scipy.sparse.csr_matrix (m, n), optional
     :return: The (6, n) pose vector where n is the number of time nodes
     :rtype: ndarray (6, n) 
     """
@@ -706,10 +800,13 @@ def calculate_pose_param(is_variab_param_extr, is_variab_param_intr, param, sigm
     var_dof_count = 0
     if sigma is not None:
 
-        weighted_error_term_not_scaled_all = interpolate_time_nodes(time_nodes, 
-                                                param_time_var,
-                                                time_to = time_scanlines, 
-                                                method = time_interpolation_method)
+        if weights_scanlines is not None:
+            weighted_error_term_not_scaled_all = np.asarray(weights_scanlines @ param_time_var.transpose()).transpose()
+        else:
+            weighted_error_term_not_scaled_all = interpolate_time_nodes(time_nodes, 
+                                                    param_time_var,
+                                                    time_to = time_scanlines, 
+                                                    method = time_interpolation_method)
 
         weighted_error_term = np.zeros(weighted_error_term_not_scaled_all.shape)
 
@@ -747,8 +844,8 @@ def objective_fun_reprojection_error(param, features_df, param0, is_variab_param
 
     :param param: _description_
     :type param: _type_
-    :param features_df: _description_
-    :type features_df: _type_
+    :param features_df: The features, preferably packed once before the solve
+    :type features_df: FeaturePack or pandas.DataFrame
     :param param0: _description_
     :type param0: _type_
     :param is_variab_param_intr: Array describing which of the 11 intrinsic parameters to be calibrated (boresight, lever arm, cam calib)
@@ -763,7 +860,7 @@ def objective_fun_reprojection_error(param, features_df, param0, is_variab_param
     :rtype: _type_
     """
     
-    #
+    features = FeaturePack.from_features(features_df)
 
     param_vec_intr = calculate_intrinsic_param(is_variab_param_intr, param, param0)
 
@@ -799,26 +896,10 @@ def objective_fun_reprojection_error(param, features_df, param0, is_variab_param
     # Convert to rotation object for convenience
     rot_hsi_body = RotLib.from_euler('ZYX', eul_ZYX_hsi_body, degrees=True)
 
-    # The position of the vehicle body wrt ECEF
-    pos_body = np.vstack((features_df['position_x'], 
-                          features_df['position_y'], 
-                          features_df['position_z'])).transpose()
-    
-    # The quaternion of the body with respect to NED
-    quat_body_ned = np.vstack((features_df['quat_body_to_ned_x'],
-                          features_df['quat_body_to_ned_y'], 
-                          features_df['quat_body_to_ned_z'],
-                          features_df['quat_body_to_ned_w'])).transpose()
-    
-    # The rotation from NED to ECEF
-    quat_ned_ecef = np.vstack((features_df['quat_ned_to_ecef_x'],
-                          features_df['quat_ned_to_ecef_y'], 
-                          features_df['quat_ned_to_ecef_z'],
-                          features_df['quat_ned_to_ecef_w'])).transpose()
-
-    # Convert to rotation object for convenience
-    rot_body_ned = RotLib.from_quat(quat_body_ned)
-    rot_ned_ecef = RotLib.from_quat(quat_ned_ecef)
+    # The position of the vehicle body wrt ECEF, the rotation of the body with respect to NED and the rotation from NED to ECEF
+    pos_body = features.pos_body
+    rot_body_ned = features.rot_body_ned
+    rot_ned_ecef = features.rot_ned_ecef
 
     # Whether to estimate time-varying errors
     if np.all(is_variab_param_extr==0): # No variable extrinsic parameters
@@ -827,6 +908,11 @@ def objective_fun_reprojection_error(param, features_df, param0, is_variab_param
         pos_body_corr = pos_body
 
     else:
+        # The interpolation is linear in the nodes, except for kriging
+        if time_interpolation_method != 'gaussian':
+            weights_features, weights_scanlines = features.interpolation_weights(time_nodes, time_interpolation_method, time_scanlines)
+        else:
+            weights_features, weights_scanlines = None, None
         
         # Calculate the 6 dof pose error parameters (non-adjustable parameters rows are zero)
         param_pose_tot, weighted_error_term = calculate_pose_param(is_variab_param_extr, 
@@ -835,15 +921,16 @@ def objective_fun_reprojection_error(param, features_df, param0, is_variab_param
                                                                    sigma_param, 
                                                                    time_nodes, 
                                                                    time_scanlines, 
-                                                                   time_interpolation_method)
+                                                                   time_interpolation_method,
+                                                                   weights_scanlines)
         
         
 
         # The parametric errors represent a handful of nodes and must be interpolated to the feature times
-        unix_time_features = features_df['unix_time']
+        unix_time_features = features.unix_time
 
         # We compose them with (add them to) the position/orientation estimates from the nav system
-        pos_body_corr, rot_body_ecef_corr = compose_pose_errors(param_pose_tot, time_nodes, unix_time_features, rot_body_ned, rot_ned_ecef, pos_body, time_interpolation_method, pos_err_ref_frame, sigma_param)
+        pos_body_corr, rot_body_ecef_corr = compose_pose_errors(param_pose_tot, time_nodes, unix_time_features, rot_body_ned, rot_ned_ecef, pos_body, time_interpolation_method, pos_err_ref_frame, sigma_param, weights = weights_features)
 
         # Least squares expects a 1D function evaluation vector
         m = time_scanlines.size # Number of scanlines
@@ -855,9 +942,7 @@ def objective_fun_reprojection_error(param, features_df, param0, is_variab_param
 
 
     # The reference points in ECEF (obtained from the reference orthomosaic)
-    points_world_reference = np.vstack((features_df['reference_points_x'], 
-                          features_df['reference_points_y'], 
-                          features_df['reference_points_z'])).transpose()
+    points_world_reference = features.points_world_reference
     
     # We reproject the reference points to the normalized HSI image plane
     X_norm = geom_utils.reproject_world_points_to_hsi_plane(trans_hsi_body, 
@@ -873,7 +958,7 @@ def objective_fun_reprojection_error(param, features_df, param0, is_variab_param
     # The observation is by definition in the scanline where y_norm = 0
     # Using the pixel numbers corresponding to the features
     # we convert the pixel number to an x-coordinate on the normalized HSI image plane
-    pixel_nr = features_df['pixel_nr']
+    pixel_nr = features.pixel_nr
     x_norm = geom_utils.compute_camera_rays_from_parameters(pixel_nr=pixel_nr,
                                                    cx=cx,
                                                    f=f,
@@ -903,6 +988,179 @@ def objective_fun_reprojection_error(param, features_df, param0, is_variab_param
                               np.sqrt(rho)*weighted_error_term.reshape(-1)))
     return err_vec
 
+def jacobian_reprojection_error(param, features_df, param0, is_variab_param_intr, is_variab_param_extr, time_nodes, time_interpolation_method, pos_err_ref_frame, sigma_obs, sigma_param, time_scanlines):
+    """The analytic Jacobian of objective_fun_reprojection_error (same arguments), to be given to least_squares as jac. 
+    The reprojection errors are differentiated through the projection to the normalized image plane, the boresight and lever arm, the camera model
+    and the interpolated pose errors, whose dependence on the time nodes is given by interpolation_weights. Not defined for time_interpolation_method 'gaussian'.
+
+    :return: The Jacobian
+    :rtype: scipy.sparse.csr_matrix (n_residuals, n_param)
+    """
+    param_vec_intr = calculate_intrinsic_param(is_variab_param_intr, param, param0)
+
+    rot_x, rot_y, rot_z, cx, f, k1, k2, k3, trans_x, trans_y, trans_z = param_vec_intr
+
+    # Lever arm and boresight as in objective_fun_reprojection_error
+    trans_hsi_body = np.array([trans_z, trans_y, trans_x])
+    R_hsi_body = RotLib.from_euler('ZYX', np.array([rot_z, rot_y, rot_x])).as_matrix()
+
+    features = FeaturePack.from_features(features_df)
+
+    n = features.n
+    
+    pos_body = features.pos_body
+    rot_body_ned = features.rot_body_ned
+    rot_ned_ecef = features.rot_ned_ecef
+    points_world_reference = features.points_world_reference
+    
+    is_time_varying = not np.all(is_variab_param_extr==0)
+
+    if is_time_varying:
+        param_pose_tot, _ = calculate_pose_param(is_variab_param_extr, is_variab_param_intr, param)
+
+        # The interpolated errors are linear in the node parameters
+        W_features, W_scanlines = features.interpolation_weights(time_nodes, time_interpolation_method, time_scanlines)
+        err_interpolated = np.asarray(W_features @ param_pose_tot.T)
+
+        # As in compose_pose_errors (roll, pitch, yaw in degrees)
+        roll, pitch, yaw = np.deg2rad(err_interpolated[:, 3]), np.deg2rad(err_interpolated[:, 4]), np.deg2rad(err_interpolated[:, 5])
+        rot_err_ned = RotLib.from_euler('ZYX', np.vstack((yaw, pitch, roll)).transpose())
+
+        if pos_err_ref_frame == 'ecef':
+            M_pos = np.broadcast_to(np.eye(3), (n, 3, 3))
+        elif pos_err_ref_frame == 'ned':
+            M_pos = features.R_ned_ecef
+
+        pos_body_corr = pos_body + np.einsum('nij,nj->ni', M_pos, err_interpolated[:, 0:3])
+        rot_body_ecef_corr = rot_ned_ecef * rot_err_ned * rot_body_ned
+    else:
+        pos_body_corr = pos_body
+        rot_body_ecef_corr = rot_ned_ecef * rot_body_ned
+    
+    R_body_ecef = rot_body_ecef_corr.as_matrix()
+
+    # The feature in the body frame, q = R_body_ecef^T (p_world - p_body), and in the HSI frame, p = R_hsi_body^T (q - t)
+    vec_world = points_world_reference - pos_body_corr
+    q = np.einsum('nji,nj->ni', R_body_ecef, vec_world)
+    v = q - trans_hsi_body
+    p = v @ R_hsi_body
+
+    x_norm_reproj = p[:, 0]/p[:, 2]
+    y_norm_reproj = p[:, 1]/p[:, 2]
+
+    def derivative_residuals(dp):
+        """The derivatives of the residuals in x and y given derivatives dp (n, 3) of the feature in the HSI frame"""
+        dx_norm_reproj = (dp[:, 0] - x_norm_reproj*dp[:, 2])/p[:, 2]
+        dy_norm_reproj = (dp[:, 1] - y_norm_reproj*dp[:, 2])/p[:, 2]
+        return -f*dx_norm_reproj/sigma_obs[0], -f*dy_norm_reproj/sigma_obs[1]
+    
+    # For a rotation R' = [a]x R, the derivative of R^T v is -R^T (a x v)
+    R_z = RotLib.from_euler('Z', rot_z).as_matrix()
+    R_zy = R_z @ RotLib.from_euler('Y', rot_y).as_matrix()
+    boresight_axes = {0: R_zy[:, 0], 1: R_z[:, 1], 2: np.array([0, 0, 1])}
+
+    # The lever arm is ordered (tz, ty, tx)
+    lever_arm_axes = {8: 2, 9: 1, 10: 0}
+
+    u = features.pixel_nr - cx
+
+    J_static = np.zeros((2*n, int(np.sum(is_variab_param_intr==1))))
+    param_count = 0
+    for i in range(len(is_variab_param_intr)):
+        if not bool(is_variab_param_intr[i]):
+            continue
+
+        if i in boresight_axes:
+            dx, dy = derivative_residuals(-np.cross(boresight_axes[i], v) @ R_hsi_body)
+        elif i in lever_arm_axes:
+            dx, dy = derivative_residuals(-np.broadcast_to(R_hsi_body[lever_arm_axes[i], :], (n, 3)))
+        elif i == 3:
+            # Principal point, only in the camera model
+            dx, dy = (-1 + 5*k1*u**4 + 3*k2*u**2 + 2*k3*u)/sigma_obs[0], np.zeros(n)
+        elif i == 4:
+            # The focal length scales the reprojected coordinates, while f*x_norm is independent of f
+            dx, dy = -x_norm_reproj/sigma_obs[0], -y_norm_reproj/sigma_obs[1]
+        else:
+            # Distortions
+            dx, dy = -u**{5: 5, 6: 3, 7: 2}[i]/sigma_obs[0], np.zeros(n)
+
+        J_static[0:n, param_count] = dx
+        J_static[n:2*n, param_count] = dy
+        param_count += 1
+    
+    if not is_time_varying:
+        return sparse.csr_matrix(J_static)
+    
+    # Derivatives with respect to the interpolated errors of each feature, which are spread to the nodes by the interpolation weights
+    R_err_ned = rot_err_ned.as_matrix()
+    R_body_ned = features.R_body_ned
+    vec_ned = np.einsum('nji,nj->ni', features.R_ned_ecef, vec_world)
+
+    yaw_axis = np.broadcast_to(np.array([0, 0, 1]), (n, 3))
+    pitch_axis = np.vstack((-np.sin(yaw), np.cos(yaw), np.zeros(n))).transpose()
+    roll_axis = np.vstack((np.cos(yaw)*np.cos(pitch), np.sin(yaw)*np.cos(pitch), -np.sin(pitch))).transpose()
+    error_axes = {3: roll_axis, 4: pitch_axis, 5: yaw_axis}
+
+    m = time_scanlines.size # Number of scanlines
+    k = is_variab_param_extr.sum() # Number of adjusted DOFs
+    rho = (2*n/(k*m)) # Relationship between number of rp observations and penalty terms
+
+    J_time_varying = []
+    J_penalty = []
+    for i in range(6):
+        if not is_variab_param_extr[i]:
+            continue
+
+        if i < 3:
+            # The position error moves the body, so that q changes by -R_body_ecef^T M_pos e_i
+            dq = -np.einsum('nji,nj->ni', R_body_ecef, M_pos[:, :, i])
+        else:
+            # The attitude error R_err is left multiplied with the body attitude in NED (degrees)
+            dq = -np.einsum('nji,nj->ni', R_body_ned, np.einsum('nji,nj->ni', R_err_ned, np.cross(error_axes[i], vec_ned)))*np.pi/180
+        
+        dx, dy = derivative_residuals(dq @ R_hsi_body)
+
+        J_time_varying.append(sparse.vstack((sparse.diags(dx) @ W_features, 
+                                             sparse.diags(dy) @ W_features)))
+        
+        # The penalty terms as in calculate_pose_param, where roll (i=3) is not penalized
+        if i != 3:
+            J_penalty.append(np.sqrt(rho)/sigma_param[i]*W_scanlines)
+        else:
+            J_penalty.append(sparse.csr_matrix(W_scanlines.shape))
+    
+    J_obs = sparse.hstack([sparse.csr_matrix(J_static)] + J_time_varying)
+    J_penalty = sparse.hstack((sparse.csr_matrix((k*m, J_static.shape[1])), sparse.block_diag(J_penalty)))
+
+    return sparse.vstack((J_obs, J_penalty), format='csr')
+
+def least_squares_jacobian(param, kwargs):
+    """The Jacobian arguments to least_squares for objective_fun_reprojection_error. This is the analytic Jacobian, except for 'gaussian' time interpolation, 
+    which is not linear in the node parameters. There finite differences are used, with the sparsity pattern of jacobian_sparsity_pattern.
+
+    :param param: The initial parameters
+    :type param: ndarray
+    :param kwargs: The keyword arguments of objective_fun_reprojection_error
+    :type kwargs: dict
+    :return: Either {'jac': jacobian_reprojection_error} or {'jac_sparsity': sparsity}
+    :rtype: dict
+    """
+    sparsity = jacobian_sparsity_pattern(features_df = kwargs['features_df'], 
+                                         is_variab_param_intr = kwargs['is_variab_param_intr'], 
+                                         is_variab_param_extr = kwargs['is_variab_param_extr'], 
+                                         time_nodes = kwargs['time_nodes'], 
+                                         time_interpolation_method = kwargs['time_interpolation_method'], 
+                                         time_scanlines = kwargs['time_scanlines'])
+    
+    sparsity_perc = 100*(1 - sparsity.nnz/(sparsity.shape[0]*sparsity.shape[1]))
+
+    print(f'Jacobian has {sparsity_perc:.0f} % zeros')
+
+    if kwargs['time_interpolation_method'] == 'gaussian':
+        return {'jac_sparsity': sparsity}
+
+    return {'jac': jacobian_reprojection_error}
+
 def filter_gcp_by_registration_error(u_err, v_err, method = 'iqr', hard_threshold_pix = None):
     """
     Filters the matched point based on the registration error in pixels in x/east (u_err) and y/north (v_err). 
@@ -1043,6 +1301,381 @@ def calculate_cam_and_pose_from_param(h5_filename, param, features_df, param0, i
 
     # Read the correction data from param
 
+def _compare_chunk(settings, file_count, hsi_composite_file):
+    """Matches the RGB composite of one chunk with the reference orthomosaic and computes the GCPs. Runs in a worker process when n_workers > 1,
+    so the GCPs are returned rather than written.
+
+    :param settings: The paths, coordinate reference systems, h5 paths and matching options of main
+    :type settings: dict
+    :param file_count: The index of the composite
+    :type file_count: int
+    :param hsi_composite_file: The file name of the composite
+    :type hsi_composite_file: string
+    :return: The GCPs
+    :rtype: pandas.DataFrame
+    """
+    file_base_name = hsi_composite_file.split('.')[0]
+
+    is_calibrated = settings['is_calibrated']
+    ref_ortho_path = settings['ref_ortho_path']
+    dem_path = settings['dem_path']
+    path_composites_match = settings['path_composites_match']
+    path_anc_match = settings['path_anc_match']
+    h5_folder = settings['h5_folder']
+    epsg_proj = settings['epsg_proj']
+    epsg_geocsc = settings['epsg_geocsc']
+    h5_folder_position_ecef = settings['h5_paths']['h5_folder_position_ecef']
+    h5_folder_quaternion_ecef = settings['h5_paths']['h5_folder_quaternion_ecef']
+    h5_folder_time_scanlines = settings['h5_paths']['h5_folder_time_scanlines']
+    h5_folder_position_ecef_coreg = settings['h5_paths']['h5_folder_position_ecef_coreg']
+    h5_folder_quaternion_ecef_coreg = settings['h5_paths']['h5_folder_quaternion_ecef_coreg']
+
+    # The match data (hyperspectral)
+    hsi_composite_path = os.path.join(path_composites_match, hsi_composite_file)
+    print(hsi_composite_path)
+
+    # Prior to matching the reference data are resampled (in memory) to the image grid of hsi_composite_path
+    with rasterio.open(hsi_composite_path) as match:
+        hsi_grid = {'crs': match.crs, 'transform': match.transform, 'width': match.width, 'height': match.height}
+
+    # The DEM is also resampled to the grid for easy extraction of data
+    dem_reshaped = reference_raster_service(dem_path).resample_to_grid(**hsi_grid)[0]
+
+    # By comparing the hsi_composite with the reference rgb mosaic we get two feature vectors in the pixel grid and 
+    # the absolute registration error in meters in global coordinates
+    if settings['reference_keypoint_index'] is not None:
+        # The reference keypoints within the footprint were detected once for the mission
+        uv_vec_hsi, uv_vec_ref, diff_AE_meters, transform_pixel_projected  = compare_hsi_composite_with_keypoint_index(hsi_composite_path, 
+                                                                                                                        settings['reference_keypoint_index'], 
+                                                                                                                        tile_size=settings['match_tile_size'], 
+                                                                                                                        max_keypoints_per_tile=settings['max_keypoints_per_tile'])
+    else:
+        ref_ortho_reshaped = reference_raster_service(ref_ortho_path).resample_to_grid(**hsi_grid)
+
+        uv_vec_hsi, uv_vec_ref, diff_AE_meters, transform_pixel_projected  = GeoSpatialAbstractionHSI.compare_hsi_composite_with_rgb_mosaic(hsi_composite_path, 
+                                                                                                                                        ref_ortho_reshaped, 
+                                                                                                                                        tile_size=settings['match_tile_size'], 
+                                                                                                                                        max_keypoints_per_tile=settings['max_keypoints_per_tile'])
+
+
+    # At first the reference observations must be converted to a true 3D system, namely ecef
+    ref_points_ecef = GeoSpatialAbstractionHSI.compute_reference_points_ecef(uv_vec_ref, 
+                                                                            transform_pixel_projected, 
+                                                                            dem_reshaped, 
+                                                                            epsg_proj, 
+                                                                            epsg_geocsc)
+
+
+
+
+
+    # Next up we need to get the associated pixel number and frame number. Luckily they are in the same grid as the pixel observations
+    # The ancillary data is either ENVI (*.hdr) or COG (*.tif)
+    anc_file_path = os.path.join(path_anc_match, file_base_name)
+
+    pixel_nr_grid, anc_nodata = GeoSpatialAbstractionHSI.read_ancillary_band(anc_file_path, 'pixel_nr_grid')
+    unix_time_grid, _ = GeoSpatialAbstractionHSI.read_ancillary_band(anc_file_path, 'unix_time_grid')
+
+    # Remove the suffixes added in the orthorectification
+    suffixes = ["_north_east", "_minimal_rectangle"]
+    for suffix in suffixes:
+        if file_base_name.endswith(suffix):
+            file_base_name_h5 = file_base_name[:-len(suffix)]
+
+    # Read the ecef position, quaternion and timestamp
+    h5_filename = os.path.join(h5_folder, file_base_name_h5 + '.h5')
+
+    if is_calibrated:
+        # Extract data from coreg folder
+        position_ecef = Hyperspectral.get_dataset(h5_filename=h5_filename,
+                                                        dataset_name=h5_folder_position_ecef_coreg)
+
+        quaternion_ecef = Hyperspectral.get_dataset(h5_filename=h5_filename,
+                                                        dataset_name=h5_folder_quaternion_ecef_coreg)
+
+    else:
+        # Extract the ecef positions for each frame
+        position_ecef = Hyperspectral.get_dataset(h5_filename=h5_filename,
+                                                        dataset_name=h5_folder_position_ecef)
+        # Extract the ecef orientations for each frame
+        quaternion_ecef = Hyperspectral.get_dataset(h5_filename=h5_filename,
+                                                        dataset_name=h5_folder_quaternion_ecef)
+
+
+    # Extract the timestamps for each frame
+    time_scanlines = Hyperspectral.get_dataset(h5_filename=h5_filename,
+                                                    dataset_name=h5_folder_time_scanlines)
+
+
+
+    pixel_nr_vec, unix_time_vec, position_vec, quaternion_vec, feature_mask = GeoSpatialAbstractionHSI.compute_position_orientation_features(uv_vec_hsi, 
+                                                                pixel_nr_grid, 
+                                                                unix_time_grid, 
+                                                                position_ecef, 
+                                                                quaternion_ecef, 
+                                                                time_scanlines,
+                                                                nodata = anc_nodata)
+
+    rot_body = RotLib.from_quat(quaternion_vec)
+
+    geo_pose = GeoPose(timestamps=unix_time_vec, 
+                    rot_obj=rot_body, 
+                    rot_ref='ECEF', 
+                    pos=position_vec, 
+                    pos_epsg=4978)
+
+    # Divide into two linked rotations
+    quat_body_to_ned = geo_pose.rot_obj_ned.as_quat()
+    quat_ned_to_ecef = geo_pose.rot_obj_ned_2_ecef.as_quat()
+
+
+    # Mask the reference points accordingly and the difference vector
+    ref_points_vec = ref_points_ecef[feature_mask, :]
+    diff_AE_valid = diff_AE_meters[feature_mask]
+
+    diff_uv = uv_vec_hsi[feature_mask, :] - uv_vec_ref[feature_mask, :]
+
+    # Now we have computed the GCPs with coincident metainformation
+    n_cols_df = pixel_nr_vec.size
+    gcp_dict = {'file_count': np.ones(n_cols_df)*file_count,
+                'h5_filename': np.repeat(h5_filename, n_cols_df),
+                'pixel_nr': pixel_nr_vec, 
+                'unix_time': unix_time_vec,
+                'position_x': position_vec[:,0],
+                'position_y': position_vec[:,1],
+                'position_z': position_vec[:,2],
+                'quat_body_to_ned_x': quat_body_to_ned[:,0],
+                'quat_body_to_ned_y': quat_body_to_ned[:,1],
+                'quat_body_to_ned_z': quat_body_to_ned[:,2],
+                'quat_body_to_ned_w': quat_body_to_ned[:,3],
+                'quat_ned_to_ecef_x': quat_ned_to_ecef[:,0],
+                'quat_ned_to_ecef_y': quat_ned_to_ecef[:,1],
+                'quat_ned_to_ecef_z': quat_ned_to_ecef[:,2],
+                'quat_ned_to_ecef_w': quat_ned_to_ecef[:,3],
+                'reference_points_x': ref_points_vec[:,0],
+                'reference_points_y': ref_points_vec[:,1],
+                'reference_points_z': ref_points_vec[:,2],
+                'diff_absolute_error': diff_AE_valid,
+                'diff_u': diff_uv[:, 0],
+                'diff_v': diff_uv[:, 1]}
+
+    return pd.DataFrame(gcp_dict)
+
+def _compare_chunks(settings, compare_files, n_workers):
+    """Yields the GCPs of the composites in order, comparing them in a pool of processes if n_workers > 1. Failed composites are reported and skipped
+
+    :param settings: The settings of _compare_chunk
+    :type settings: dict
+    :param compare_files: The (file_count, hsi_composite_file) of the composites
+    :type compare_files: list of tuple
+    :param n_workers: The number of processes
+    :type n_workers: int
+    :yield: The GCPs of a composite
+    :rtype: pandas.DataFrame
+    """
+    n_skipped = 0
+    if n_workers <= 1:
+        for file_count, hsi_composite_file in compare_files:
+            try:
+                gcp_df = _compare_chunk(settings, file_count, hsi_composite_file)
+            except Exception as e:
+                print(f'Skipping composite {hsi_composite_file}: {type(e).__name__}: {e}')
+                n_skipped += 1
+                continue
+            yield gcp_df
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(_compare_chunk, settings, file_count, hsi_composite_file) for file_count, hsi_composite_file in compare_files]
+
+            for (_, hsi_composite_file), future in zip(compare_files, futures):
+                try:
+                    gcp_df = future.result()
+                except Exception as e:
+                    print(f'Skipping composite {hsi_composite_file}: {type(e).__name__}: {e}')
+                    n_skipped += 1
+                    continue
+                yield gcp_df
+
+    if n_skipped > 0:
+        print(f'Skipped {n_skipped} of {len(compare_files)} composites that failed to compare')
+
+def _calibrate_transect(settings, df_current, h5_filenames, time_node_spacing):
+    """Estimates the camera parameters and time-varying pose errors of one (super-)transect. Runs in a worker process when n_workers > 1.
+    Nothing is written here, the main process applies the solutions in the order of the transects
+
+    :param settings: The options of the calibration, including the keyword arguments of the objective ('kwargs')
+    :type settings: dict
+    :param df_current: The GCPs of the transect, sorted by time
+    :type df_current: pandas.DataFrame
+    :param h5_filenames: The h5 files of the transect
+    :type h5_filenames: list of string
+    :param time_node_spacing: The time between nodes in seconds
+    :type time_node_spacing: float
+    :return: The optimized parameters, the keyword arguments they apply to and the solver diagnostics
+    :rtype: dict
+    """
+    kwargs = dict(settings['kwargs'])
+    node_partition = settings['node_partition']
+    n_adjustable_dofs = settings['n_adjustable_dofs']
+    param0_variab = settings['param0_variab']
+    val_mode = settings['val_mode']
+
+    # Update the feature info for optimization from specific transect
+    kwargs['features_df'] = df_current
+
+    n_features = df_current.shape[0]
+
+    idx = np.arange(n_features)
+    if val_mode:
+        idx_train, idx_val = train_test_split(idx, test_size=0.50, random_state=42)
+    else:
+        idx_train = idx
+        idx_val = idx_train
+
+    # If we are to estimate that which is time varying
+    if settings['estimate_time_varying']:
+        # Extract the timestamps for each frame
+        time_scanlines = np.concatenate([Hyperspectral.get_dataset(h5_filename=h5_filename, dataset_name=settings['h5_folder_time_scanlines'])
+                                         for h5_filename in h5_filenames])
+        kwargs['time_scanlines'] = time_scanlines
+
+        # We can use the feature time:
+        time_arr_sorted_features = np.array(sorted(df_current['unix_time']))
+
+        transect_duration_sec = time_scanlines.max() - time_scanlines.min()
+
+        # Number of nodes calculated from this (except when using "All features")
+        number_of_nodes = int(np.floor(transect_duration_sec/time_node_spacing)) + 1
+        
+        if node_partition == 'temporal':
+            # It divides the transect into equal intervals time-wise, 
+            # meaning that the intervals can be somewhat different at least for a small number of them.
+            time_nodes = np.linspace(start=time_scanlines.min(), 
+                                stop = time_scanlines.max(), 
+                                num = number_of_nodes)
+
+        elif node_partition == 'feature':
+            # We divide to have an equal number of features in each interval
+            idx_nodes = np.round(np.linspace(start=0, 
+                                stop = n_features-1, 
+                                num = number_of_nodes)).astype(np.int64)
+
+            # Select corresponding time stamps
+            time_nodes = time_arr_sorted_features[idx_nodes]
+
+            # At ends we asign the min/max of the pose to avoid extrapolation
+            time_nodes[0] = time_scanlines.min()
+            time_nodes[-1]  = time_scanlines.max()
+
+        elif node_partition == 'all_features':
+            # Select corresponding time stamps to all features
+            time_nodes = time_arr_sorted_features
+
+            # No interpolation is needed
+            kwargs['time_interpolation_method'] = 'none'
+
+            number_of_nodes = time_nodes.size
+
+        # The time varying parameters are in total the number of dofs times number of nodes
+        param0_time_varying = np.zeros(n_adjustable_dofs*number_of_nodes)
+
+        # The time-varying parameters are stacked after the intrinsic parameters.
+        # This vector only holds parameters that will be adjusted
+        param0_variab_tot = np.concatenate((param0_variab, 
+                                            param0_time_varying), axis=0)
+
+        # Update optimization kwarg
+        kwargs['time_nodes'] = time_nodes
+    else:
+        kwargs['time_nodes'] = None
+        kwargs['time_scanlines'] = None
+        number_of_nodes = 0
+        param0_variab_tot = param0_variab
+
+    # Run once with initial using all features
+    res_pre_optim = objective_fun_reprojection_error(param0_variab_tot, **kwargs)
+
+    # Calculate the median absolute error in pixels
+    SE = res_pre_optim[0:n_features]**2 + res_pre_optim[n_features:2*n_features]**2
+    MAE_median_pre = np.median(np.sqrt(SE))
+
+    # Optimize the transect and record time duration
+    time_start  = time.time()
+
+    # The features are packed once for all evaluations of the objective
+    kwargs['features_df'] = FeaturePack(df_current.iloc[sorted(idx_train)] if val_mode else df_current)
+
+    res = least_squares(fun = objective_fun_reprojection_error, 
+                    x0 = param0_variab_tot, 
+                    x_scale='jac',
+                    kwargs=kwargs,
+                    loss = settings['loss_function'],
+                    **least_squares_jacobian(param0_variab_tot, kwargs))
+
+    duration_sec = time.time() - time_start
+
+    # Absolute reprojection errors
+    n_train = idx_train.size
+    SE = res.fun[0:n_train]**2 + res.fun[n_train:2*n_train]**2
+    MAE_median_train = np.median(np.sqrt(SE))
+    rmse_train = np.sqrt(np.mean(SE))
+
+    ## Run the validation
+    if val_mode:
+        kwargs['features_df'] = df_current.iloc[sorted(idx_val)]
+
+    res_val = objective_fun_reprojection_error(res.x, **kwargs)
+
+    n = idx_val.size
+    SE = res_val[0:n]**2 + res_val[n:2*n]**2
+    MAE_median_val = np.median(np.sqrt(SE))
+    rmse_val = np.sqrt(np.mean(SE))
+
+    # Now, if all features were used to optimize, use gaussian interpolation (KRIGING actually)
+    if node_partition == 'all_features':
+        kwargs['time_interpolation_method'] = 'gaussian'
+
+    # The features are not needed to apply the solution
+    kwargs['features_df'] = None
+
+    diagnostics = {'n_features': n_features,
+                   'n_nodes': number_of_nodes,
+                   'n_scanlines': 0 if kwargs['time_scanlines'] is None else kwargs['time_scanlines'].size,
+                   'mae_median_pre': MAE_median_pre,
+                   'mae_median_train': MAE_median_train,
+                   'mae_median_val': MAE_median_val,
+                   'rmse_train': rmse_train,
+                   'rmse_val': rmse_val,
+                   'cost': res.cost,
+                   'nfev': res.nfev,
+                   'status': res.status,
+                   'duration_sec': duration_sec}
+    
+    return {'param_optimized': res.x, 'kwargs': kwargs, 'diagnostics': diagnostics}
+
+def _calibrate_transects(settings, transect_tasks, n_workers):
+    """Yields the solutions of the transects in order, solving them in a pool of processes if n_workers > 1
+
+    :param settings: The settings of _calibrate_transect
+    :type settings: dict
+    :param transect_tasks: The (transect_nr, df_current, h5_filenames, time_node_spacing) of the transects
+    :type transect_tasks: list of tuple
+    :param n_workers: The number of processes
+    :type n_workers: int
+    :yield: The solution of a transect
+    :rtype: dict
+    """
+    if n_workers <= 1:
+        for _, df_current, h5_filenames, time_node_spacing in transect_tasks:
+            yield _calibrate_transect(settings, df_current, h5_filenames, time_node_spacing)
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(_calibrate_transect, settings, df_current, h5_filenames, time_node_spacing) 
+                       for _, df_current, h5_filenames, time_node_spacing in transect_tasks]
+
+            for future in futures:
+                yield future.result()
+
 # Function called to apply standard processing on a folder of files
 def main(config_path, mode, is_calibrated, coreg_dict = {}):
     config = configparser.ConfigParser()
@@ -1072,7 +1705,7 @@ def main(config_path, mode, is_calibrated, coreg_dict = {}):
     path_composites_match = config['Absolute Paths']['rgb_composite_folder']
     path_anc_match = config['Absolute Paths']['anc_folder']
 
-    # Create a temporary folder for resampled reference orthomosaics and DEMs
+    # Create a folder for the reference data derived for coregistration (e.g. the keypoint index)
     ref_resampled_gis_path = config['Absolute Paths']['ref_ortho_reshaped']
     if not os.path.exists(ref_resampled_gis_path):
         os.mkdir(ref_resampled_gis_path)
@@ -1080,6 +1713,13 @@ def main(config_path, mode, is_calibrated, coreg_dict = {}):
 
     ref_gcp_path = config['Absolute Paths']['ref_gcp_path']
 
+    # The GCPs are stored in a h5 file (see gcp_store). The csv is written for inspection
+    write_gcp_csv = coreg_dict.get('write_gcp_csv', True)
+    if not is_calibrated:
+        gcp_csv_path = ref_gcp_path
+    else:
+        gcp_csv_path = ref_gcp_path.split('.')[0] + '_coreg.csv'
+
     # Location for the calibrated Cal file:calib_file_coreg
     calib_file_coreg = config['Absolute Paths']['calib_file_coreg']
 
@@ -1110,167 +1750,98 @@ def main(config_path, mode, is_calibrated, coreg_dict = {}):
 
     
 
+    # Optional area of interest. Chunks whose indexed footprint is outside it are not coregistered
+    aoi = read_aoi(config, crs='EPSG:' + str(epsg_proj))
+    if aoi is not None:
+        aoi_chunks, indexed_chunks = chunks_in_aoi(footprint_index_path(config), aoi)
+
     print("\n################ Coregistering: ################")
 
     # Iterate the RGB composites
     #hsi_composite_files = sorted(os.listdir(path_composites_match))
     hsi_composite_paths = sorted(glob(os.path.join(path_composites_match, "*.tif")))
     hsi_composite_files = [os.path.basename(f) for f in hsi_composite_paths]
-    count_valid = 0
+
+    # Chunks (compare) and transects (calibrate) are processed in parallel processes
+    try:
+        n_workers = int(config_option(config, 'Orthorectification', 'n_workers'))
+    except KeyError:
+        n_workers = 1
+    n_workers = coreg_dict.get('n_workers', n_workers)
 
     if mode == 'compare':
         print("\n################ Comparing to reference: ################")
+
+        # Matching is coarse-to-fine in tiles of match_tile_size pixels (None matches full images)
+
+        settings = {'is_calibrated': is_calibrated,
+                    'ref_ortho_path': ref_ortho_path,
+                    'dem_path': dem_path,
+                    'path_composites_match': path_composites_match,
+                    'path_anc_match': path_anc_match,
+                    'h5_folder': config['Absolute Paths']['h5_folder'],
+                    'epsg_proj': epsg_proj,
+                    'epsg_geocsc': epsg_geocsc,
+                    'h5_paths': h5_paths,
+                    'match_tile_size': coreg_dict.get('match_tile_size', 1024),
+                    'max_keypoints_per_tile': coreg_dict.get('max_keypoints_per_tile', 2000),
+                    'reference_keypoint_index': None}
+        
+        # The keypoints of the reference orthomosaic are detected once (in tiles) and queried per chunk, rather than detected on a resampled crop per chunk
+        if coreg_dict.get('use_reference_keypoint_index', True) and settings['match_tile_size'] is not None:
+            settings['reference_keypoint_index'] = reference_keypoint_index_path(config)
+
+            build_reference_keypoint_index(ref_ortho_path=ref_ortho_path, 
+                                           index_path=settings['reference_keypoint_index'], 
+                                           crs='EPSG:' + str(epsg_proj), 
+                                           resolution=resolution, 
+                                           tile_size=settings['match_tile_size'], 
+                                           max_keypoints_per_tile=settings['max_keypoints_per_tile'])
+        
+        compare_files = []
         for file_count, hsi_composite_file in enumerate(hsi_composite_files):
             
-            try:
-                file_base_name = hsi_composite_file.split('.')[0]
-
-                
-                
-                # The match data (hyperspectral)
-                hsi_composite_path = os.path.join(path_composites_match, hsi_composite_file)
-                print(hsi_composite_path)
-
-                # Prior to matching the files are cropped to image grid of hsi_composite_path
-                ref_ortho_reshaped_path = os.path.join(ref_resampled_gis_path, hsi_composite_file)
-                # The DEM is also cropped to grid for easy extraction of data
-                dem_reshaped = os.path.join(ref_resampled_gis_path, file_base_name + '_dem.tif')
+            file_base_name = hsi_composite_file.split('.')[0]
 
-                # 
-                GeoSpatialAbstractionHSI.resample_rgb_ortho_to_hsi_ortho(ref_ortho_path, hsi_composite_path, ref_ortho_reshaped_path)
+            # A composite of several chunks (per_transect = True) has no single h5 file to take poses from
+            for suffix in ["_north_east", "_minimal_rectangle", "_rotated"]:
+                if file_base_name.endswith(suffix):
+                    file_base_name = file_base_name[:-len(suffix)]
+            if file_base_name.endswith('_transect'):
+                raise ValueError(f'Coregistration does not support per-transect composites ({hsi_composite_file}). '
+                                 'Orthorectify with [Orthorectification] per_transect = False for coregistration')
 
-                
+            file_base_name = hsi_composite_file.split('.')[0]
 
-                GeoSpatialAbstractionHSI.resample_dem_to_hsi_ortho(dem_path, hsi_composite_path, dem_reshaped)
-
-                # By comparing the hsi_composite with the reference rgb mosaic we get two feature vectors in the pixel grid and 
-                # the absolute registration error in meters in global coordinates
-                uv_vec_hsi, uv_vec_ref, diff_AE_meters, transform_pixel_projected  = GeoSpatialAbstractionHSI.compare_hsi_composite_with_rgb_mosaic(hsi_composite_path, 
-                                                                                                                                                ref_ortho_reshaped_path)
-                
-
-                # At first the reference observations must be converted to a true 3D system, namely ecef
-                ref_points_ecef = GeoSpatialAbstractionHSI.compute_reference_points_ecef(uv_vec_ref, 
-                                                                                        transform_pixel_projected, 
-                                                                                        dem_reshaped, 
-                                                                                        epsg_proj, 
-                                                                                        epsg_geocsc)
-
-
-
-
-                
-                # Next up we need to get the associated pixel number and frame number. Luckily they are in the same grid as the pixel observations
-                anc_file_path = os.path.join(path_anc_match, file_base_name + '.hdr')
-                anc_image_object = sp.io.envi.open(anc_file_path)
-                anc_band_list = anc_image_object.metadata['band names']
-                anc_nodata = float(anc_image_object.metadata['data ignore value'])
-
-                pixel_nr_grid = anc_image_object[:,:, anc_band_list.index('pixel_nr_grid')].squeeze()
-                unix_time_grid = anc_image_object[:,:, anc_band_list.index('unix_time_grid')].squeeze()
-
-                # Remove the suffixes added in the orthorectification
-                suffixes = ["_north_east", "_minimal_rectangle"]
-                for suffix in suffixes:
+            if aoi is not None:
+                chunk_name = file_base_name
+                for suffix in ["_north_east", "_rotated"]:
                     if file_base_name.endswith(suffix):
-                        file_base_name_h5 = file_base_name[:-len(suffix)]
-
-                # Read the ecef position, quaternion and timestamp
-                h5_filename = os.path.join(config['Absolute Paths']['h5_folder'], file_base_name_h5 + '.h5')
-
-                if is_calibrated:
-                    # Extract data from coreg folder
-                    position_ecef = Hyperspectral.get_dataset(h5_filename=h5_filename,
-                                                                    dataset_name=h5_folder_position_ecef_coreg)
-                    
-                    quaternion_ecef = Hyperspectral.get_dataset(h5_filename=h5_filename,
-                                                                    dataset_name=h5_folder_quaternion_ecef_coreg)
-
-                else:
-                    # Extract the ecef positions for each frame
-                    position_ecef = Hyperspectral.get_dataset(h5_filename=h5_filename,
-                                                                    dataset_name=h5_folder_position_ecef)
-                    # Extract the ecef orientations for each frame
-                    quaternion_ecef = Hyperspectral.get_dataset(h5_filename=h5_filename,
-                                                                    dataset_name=h5_folder_quaternion_ecef)
-
-                
-                # Extract the timestamps for each frame
-                time_scanlines = Hyperspectral.get_dataset(h5_filename=h5_filename,
-                                                                dataset_name=h5_folder_time_scanlines)
+                        chunk_name = file_base_name[:-len(suffix)]
                 
-            
+                if not is_chunk_in_aoi(chunk_name, aoi_chunks, indexed_chunks):
+                    print(f'Skipping composite outside area of interest: {hsi_composite_file}')
+                    continue
 
-                pixel_nr_vec, unix_time_vec, position_vec, quaternion_vec, feature_mask = GeoSpatialAbstractionHSI.compute_position_orientation_features(uv_vec_hsi, 
-                                                                            pixel_nr_grid, 
-                                                                            unix_time_grid, 
-                                                                            position_ecef, 
-                                                                            quaternion_ecef, 
-                                                                            time_scanlines,
-                                                                            nodata = anc_nodata)
-                
-                rot_body = RotLib.from_quat(quaternion_vec)
+            compare_files.append((file_count, hsi_composite_file))
 
-                geo_pose = GeoPose(timestamps=unix_time_vec, 
-                                rot_obj=rot_body, 
-                                rot_ref='ECEF', 
-                                pos=position_vec, 
-                                pos_epsg=4978)
-                
-                # Divide into two linked rotations
-                quat_body_to_ned = geo_pose.rot_obj_ned.as_quat()
-                quat_ned_to_ecef = geo_pose.rot_obj_ned_2_ecef.as_quat()
-
-
-                # Mask the reference points accordingly and the difference vector
-                ref_points_vec = ref_points_ecef[feature_mask, :]
-                diff_AE_valid = diff_AE_meters[feature_mask]
-
-                diff_uv = uv_vec_hsi[feature_mask, :] - uv_vec_ref[feature_mask, :]
-
-                # Now we have computed the GCPs with coincident metainformation
-                n_cols_df = pixel_nr_vec.size
-                gcp_dict = {'file_count': np.ones(n_cols_df)*file_count,
-                            'h5_filename': np.repeat(h5_filename, n_cols_df),
-                            'pixel_nr': pixel_nr_vec, 
-                            'unix_time': unix_time_vec,
-                            'position_x': position_vec[:,0],
-                            'position_y': position_vec[:,1],
-                            'position_z': position_vec[:,2],
-                            'quat_body_to_ned_x': quat_body_to_ned[:,0],
-                            'quat_body_to_ned_y': quat_body_to_ned[:,1],
-                            'quat_body_to_ned_z': quat_body_to_ned[:,2],
-                            'quat_body_to_ned_w': quat_body_to_ned[:,3],
-                            'quat_ned_to_ecef_x': quat_ned_to_ecef[:,0],
-                            'quat_ned_to_ecef_y': quat_ned_to_ecef[:,1],
-                            'quat_ned_to_ecef_z': quat_ned_to_ecef[:,2],
-                            'quat_ned_to_ecef_w': quat_ned_to_ecef[:,3],
-                            'reference_points_x': ref_points_vec[:,0],
-                            'reference_points_y': ref_points_vec[:,1],
-                            'reference_points_z': ref_points_vec[:,2],
-                            'diff_absolute_error': diff_AE_valid,
-                            'diff_u': diff_uv[:, 0],
-                            'diff_v': diff_uv[:, 1]}
-                
+        # The GCPs of each chunk are appended to the store (and the csv) as they arrive, in the order of the composites
+        if n_workers > 1:
+            print(f'Comparing with {n_workers} workers')
 
+        # The csv of an earlier run is removed up front, so that it is not left in place if no composite yields GCPs
+        if write_gcp_csv and os.path.exists(gcp_csv_path):
+            os.remove(gcp_csv_path)
 
-                # Convert to a dataframe
-                gcp_df = pd.DataFrame(gcp_dict)
+        with GCPStoreWriter(gcp_store_path(ref_gcp_path, is_calibrated)) as gcp_store:
+            is_first_chunk = True
+            for gcp_df in _compare_chunks(settings, compare_files, n_workers):
+                gcp_store.append(gcp_df)
 
-                # Concatanate frames
-                if count_valid==0:
-                    gcp_df_all = gcp_df
-                    count_valid += 1
-                else:
-                    gcp_df_all = pd.concat([gcp_df_all, gcp_df])
-            except:
-                pass
-
-        # Write points to a separate gcp_coreg.csv
-        if not is_calibrated:
-            gcp_df_all.to_csv(path_or_buf=ref_gcp_path)
-        else:
-            gcp_df_all.to_csv(path_or_buf=ref_gcp_path.split('.')[0] + '_coreg.csv')
+                # Write points to a separate gcp_coreg.csv
+                if write_gcp_csv:
+                    gcp_df.to_csv(path_or_buf=gcp_csv_path, mode='w' if is_first_chunk else 'a', header=is_first_chunk)
+                    is_first_chunk = False
 
 
 
@@ -1279,10 +1850,17 @@ def main(config_path, mode, is_calibrated, coreg_dict = {}):
         # Read Comparative data
         
         # Separate files for calibrated and uncalibrated data
-        if not is_calibrated:
-            gcp_df_all = pd.read_csv(ref_gcp_path)
+        gcp_path = gcp_store_path(ref_gcp_path, is_calibrated)
+        if os.path.exists(gcp_path):
+            # Only the features of chunks in the area of interest are read
+            if aoi is not None:
+                chunk_names = [chunk_name for chunk_name in list_gcp_store(gcp_path)['chunk_name'] if is_chunk_in_aoi(chunk_name, aoi_chunks, indexed_chunks)]
+            else:
+                chunk_names = None
+            gcp_df_all = read_gcp_store(gcp_path, chunk_names=chunk_names)
         else:
-            gcp_df_all = pd.read_csv(ref_gcp_path.split('.')[0] + '_coreg.csv')
+            # GCPs compared before the store was introduced
+            gcp_df_all = pd.read_csv(gcp_csv_path)
 
         # Registration error in pixels in x-direction (u_err) and y-direction (v_err)
         u_err = gcp_df_all['diff_u']
@@ -1316,7 +1894,7 @@ def main(config_path, mode, is_calibrated, coreg_dict = {}):
         calibrate_dict = coreg_dict.get('calibrate_dict', calibrate_dict_default)
         calibrate_dict_extr = coreg_dict.get('calibrate_dict_extr', calibrate_dict_extr_default)
         time_node_spacing = coreg_dict.get('time_node_spacing', large_number) # s. A large number means one single node in time i.e. constant error in the DOF you are estimating
-        time_interpolation_method = coreg_dict.get('time_interpolation_method', 'linear') # Interpolation method. Linear is currently recommended
+        time_interpolation_method = coreg_dict.get('time_interpolation_method', 'linear') # Interpolation method. Linear is currently recommended, 'bspline' for smooth errors
         node_partition = coreg_dict.get('node_partition', 'temporal') # ['temporal', 'feature', 'all_features']. The partitioning scheme. Temporal makes equitemporal nodes, while "feature" makes nodes with equal feature count in each time segment
         pos_err_ref_frame = coreg_dict.get('pos_err_ref_frame', 'ned') # ['ecef' or 'ned']
         loss_function = coreg_dict.get('loss_function', 'soft_l1') # ['linear', 'huber', 'cauchy'..]. Least squares loss function for scipy least_squares implementation.
@@ -1333,6 +1911,11 @@ def main(config_path, mode, is_calibrated, coreg_dict = {}):
 
         # These features are used
         df_gcp_filtered = gcp_df_all[feature_mask]
+
+        if aoi is not None and not os.path.exists(gcp_path):
+            # Only calibrate with features from chunks in the area of interest
+            chunk_names = df_gcp_filtered['h5_filename'].apply(lambda h5_fn: os.path.basename(h5_fn).split('.')[0])
+            df_gcp_filtered = df_gcp_filtered[[is_chunk_in_aoi(chunk_name, aoi_chunks, indexed_chunks) for chunk_name in chunk_names]]
         
        
 
@@ -1479,13 +2062,15 @@ def main(config_path, mode, is_calibrated, coreg_dict = {}):
                 # Do all
                 iter = np.arange(n_transects)
                 
+            # The transects are solved independently (in parallel if n_workers > 1)
+            transect_tasks = []
             for i in iter:
                 # Selected Transect
                 if plot_node_spacing:
-
-                    time_node_spacing = i
+                    time_node_spacing_transect = i
                 else:
                     transect_nr = i
+                    time_node_spacing_transect = time_node_spacing
                 
                 # The df should be sorted based on transect, not based on chunk 
                 if super_transects:
@@ -1497,292 +2082,69 @@ def main(config_path, mode, is_calibrated, coreg_dict = {}):
                 # Sort values by chronology
                 df_current = df_current_unsorted.sort_values(by='unix_time')
                 
-                # Update the feature info for optimization from specific transect
-                kwargs['features_df'] = df_current
-
-                n_features = df_current.shape[0]
-
-                # Read out the file name corresponding to file index i
-                try:
-                    h5_filename = df_current['h5_filename'].iloc[0]
-                except IndexError:
+                if df_current.shape[0] == 0:
                     print('No Matches for image, moving on')
                     continue
 
-                # If we are to estimate that which is time varying
-                if estimate_time_varying:
-                    ## The time range is defined by the transect time:
-                    #times_samples = df_current['unix_time']
-
-                    # Extract the timestamps for each frame
-
-                    if super_transects:
-                        time_scanlines_list = [Hyperspectral.get_dataset(h5_filename=h5_filename, dataset_name=h5_folder_time_scanlines)
-                         for h5_filename in transect_dict[i]]
-                        
-                        n_sub_transects = time_scanlines_list.__len__()
-
-                        time_scanlines = np.concatenate(time_scanlines_list)
-                        print('')
-                    else:
-                        time_scanlines = Hyperspectral.get_dataset(h5_filename=h5_filename,
-                                                                        dataset_name=h5_folder_time_scanlines)
-                    kwargs['time_scanlines'] = time_scanlines
-
-                    # We can use the feature time:
-                    time_arr_sorted_features = np.array(sorted(df_current['unix_time']))
-                    
-                    transect_duration_sec = time_arr_sorted_features.max() - time_arr_sorted_features.min()
-
-                    transect_duration_sec = time_scanlines.max() - time_scanlines.min()
-
-                    # Number of nodes calculated from this (except when using "All features")
-                    number_of_nodes = int(np.floor(transect_duration_sec/time_node_spacing)) + 1
-
-                    # The time varying parameters are in total the number of dofs times number of nodes
-                    param0_time_varying = np.zeros(n_adjustable_dofs*number_of_nodes)
-
-                    # The time-varying parameters are stacked after the intrinsic parameters.
-                    # This vector only holds parameters that will be adjusted
-                    param0_variab_tot = np.concatenate((param0_variab, 
-                                                        param0_time_varying), axis=0)
-                    
-                    # Should only use the training set:
-                    
-
-                    # Where we train:
-                    # Training data
-                    if val_mode:
-                        idx = np.arange(df_current.shape[0])
-                        idx_train, idx_val = train_test_split(idx, test_size=0.50, random_state=42)
-                        kwargs['features_df'] = df_current.iloc[sorted(idx_train)]
-                    else:
-                        idx = np.arange(df_current.shape[0])
-                        idx_train = idx
-                        idx_val = idx_train
-                    
-                    
-                    
-                    if node_partition == 'temporal':
-                        # It divides the transect into equal intervals time-wise, 
-                        # meaning that the intervals can be somewhat different at least for a small number of them.
-                        time_nodes = np.linspace(start=time_scanlines.min(), 
-                                            stop = time_scanlines.max(), 
-                                            num = number_of_nodes)
-                        # Update optimization kwarg
-                        kwargs['time_nodes'] = time_nodes
-
-                        # Calculate the Jacobian for finding and exploiting sparsity
-                        J = numerical_jacobian(fun = objective_fun_reprojection_error, param = param0_variab_tot, **kwargs)
-
-                        
-
-                        sparsity_perc = 100*((J==0).sum()/J.size)
-
-                        print(f'Jacobian computed with {sparsity_perc:.0f} % zeros')
-                        
-                        # Using list of list representation as recommended by Scipy's least squares
-                        sparsity = lil_matrix(J.shape, dtype=int)
-
-                        # Setting the non sparse elements (in theory they could be set for small values of J too)
-                        sparsity[J != 0] = 1
-                        
-                    elif node_partition == 'feature':
-                        # We divide to have an equal number of features in each interval
-                        idx_nodes = np.round(np.linspace(start=0, 
-                                            stop = n_features-1, 
-                                            num = number_of_nodes)).astype(np.int64)
-
-                        # Select corresponding time stamps
-                        time_nodes = time_arr_sorted_features[idx_nodes]
-
-                        # At ends we asign the min/max of the pose to avoid extrapolation
-                        time_nodes[0] = time_scanlines.min()
-                        time_nodes[-1]  = time_scanlines.max()
-
-                        # Update optimization kwarg
-                        kwargs['time_nodes'] = time_nodes
-
-                        
-                        # Calculate the Jacobian for finding and exploiting sparsity
-                        J = numerical_jacobian(fun = objective_fun_reprojection_error, param = param0_variab_tot, **kwargs)
-
-                        
-
-                        sparsity_perc = 100*((J==0).sum()/J.size)
-
-                        print(f'Jacobian computed with {sparsity_perc:.0f} % zeros')
-                        
-                        # Using list of list representation as recommended by Scipy's least squares
-                        sparsity = lil_matrix(J.shape, dtype=int)
-
-                        # Setting the non sparse elements (in theory they could be set for small values of J too)
-                        sparsity[J != 0] = 1
-
-                    elif node_partition == 'all_features':
-                        n_f = n_features
-                        idx_nodes = np.round(np.linspace(start=0, 
-                                            stop = n_f-1, 
-                                            num = n_f)).astype(np.int64)
-
-                        # Select corresponding time stamps to all features
-                        time_nodes = time_arr_sorted_features[idx_nodes]
-
-                        #At ends we asign the min/max of the pose to avoid extrapolation
-                        #time_nodes[0] = time_scanlines.min()
-                        #time_nodes[-1]  = time_scanlines.max()
-
-                        # No interpolation is needed
-                        kwargs['time_interpolation_method'] = 'none'
-
-                        # Redefine these
-                        # Number of nodes calculated from this
-                        number_of_nodes = time_nodes.size
-
-                        # The time varying parameters are in total the number of dofs times number of nodes
-                        param0_time_varying = np.zeros(n_adjustable_dofs*number_of_nodes)
-
-                        # The time-varying parameters are stacked after the intrinsic parameters.
-                        # This vector only holds parameters that will be adjusted
-                        param0_variab_tot = np.concatenate((param0_variab, 
-                                                            param0_time_varying), axis=0)
-                        
-                        sparsity = assemble_jacobian_pattern(is_variab_param_intr, is_variab_param_extr, n_features)
-                        
-
-
-                    # Update optimization kwarg
-                    kwargs['time_nodes'] = time_nodes
-                    
-
-                    
-                else:
-                    time_nodes = None
-                    param0_variab_tot = param0_variab
-
-                
-                # Run once with initial using all features
-                kwargs['features_df'] = df_current
-                res_pre_optim = objective_fun_reprojection_error(param0_variab_tot, **kwargs)
-
-                # Calculate the median absolute error in pixels
-                SE = res_pre_optim[0:n_features]**2 + res_pre_optim[n_features:2*n_features]**2
-                abs_err = np.sqrt(SE)
-                MAE_median = np.median(abs_err)
-                print(f'Original MAE median rp-error is {MAE_median:.2f} pixels')
-
-                # Optimize the transect and record time duration
-                time_start  = time.time()
-
-                if val_mode:
-                    # Prepare validation data
-                    kwargs['features_df'] = df_current.iloc[sorted(idx_train)]
+                # The h5 files the transect is read from and written to
+                if super_transects:
+                    h5_filenames = list(transect_dict[i])
                 else:
-                    # Optimize using all data points
-                    kwargs['features_df'] = df_current
-                    n_train = n_features
-
-                res = least_squares(fun = objective_fun_reprojection_error, 
-                                x0 = param0_variab_tot, 
-                                x_scale='jac',
-                                jac_sparsity=sparsity,
-                                kwargs=kwargs,
-                                loss = loss_function)
-
-                # Absolute reprojection errors
-                n_train = idx_train.size
-                SE = res.fun[0:n_train]**2 + res.fun[n_train:2*n_train]**2
-                abs_err = np.sqrt(SE)
-                MAE_mean = np.mean(abs_err)
-                MAE_median = np.median(abs_err)
-                rmse = np.sqrt(np.mean(SE))
-
-                print(f'Optimized MAE median train set {MAE_median:.2f} pixels')
-                print(f'Number of nodes was {number_of_nodes}')
-                print(f'Number of features was {n_features}')
-                print(f'Number of scanlines was {time_scanlines.size}')
-
-                # Compute the median absolute error (more informative in outlier presense)
-                x_err = res.fun[0:n_train]
-                x_MAE = np.median(np.abs(x_err))
-
-                y_err = res.fun[n_train:2*n_train]
-                y_MAE = np.median(np.abs(y_err))
-
-                ## Run the validation
-                if val_mode:
-                    kwargs['features_df'] = df_current.iloc[sorted(idx_val)]
-
-
-                res_pre_optim = objective_fun_reprojection_error(res.x, **kwargs)
-
-                # Calculate the median absolute error in pixels
-                n = idx_val.size
-                SE = res_pre_optim[0:n]**2 + res_pre_optim[n:2*n]**2
-                abs_err = np.sqrt(SE)
-                MAE_mean = np.mean(abs_err)
-                MAE_median = np.median(abs_err)
-                rmse_val = np.sqrt(np.mean(SE))
-
-                
-                print(f'MAE median error for VAL is {MAE_median:.2f} pixels')
+                    h5_filenames = [df_current['h5_filename'].iloc[0]]
+
+                transect_tasks.append((i, df_current, h5_filenames, time_node_spacing_transect))
+
+            settings = {'kwargs': kwargs,
+                        'node_partition': node_partition,
+                        'n_adjustable_dofs': n_adjustable_dofs,
+                        'param0_variab': param0_variab,
+                        'val_mode': val_mode,
+                        'estimate_time_varying': estimate_time_varying,
+                        'loss_function': loss_function,
+                        'h5_folder_time_scanlines': h5_folder_time_scanlines}
+                        
+            if n_workers > 1:
+                print(f'Calibrating {len(transect_tasks)} transects with {n_workers} workers')
+
+            # The solutions arrive in the order of the transects, and are written by this process only.
+            # Each transect writes its own h5 files, while the camera calibration is (as before) that of the last transect
+            diagnostics_list = []
+            for (transect_nr, _, h5_filenames, _), solution in zip(transect_tasks, _calibrate_transects(settings, transect_tasks, n_workers)):
+                diagnostics = solution['diagnostics']
+
+                print(f'Transect {transect_nr}:')
+                print(f'Original MAE median rp-error is {diagnostics["mae_median_pre"]:.2f} pixels')
+                print(f'Optimized MAE median train set {diagnostics["mae_median_train"]:.2f} pixels')
+                print(f'Number of nodes was {diagnostics["n_nodes"]}')
+                print(f'Number of features was {diagnostics["n_features"]}')
+                print(f'Number of scanlines was {diagnostics["n_scanlines"]}')
+                print(f'MAE median error for VAL is {diagnostics["mae_median_val"]:.2f} pixels')
                 print('')
 
+                diagnostics_list.append({'transect': transect_nr, **diagnostics})
 
+                param_optimized = solution['param_optimized'] # Error curves
+                kwargs_transect = solution['kwargs']
                 
-
-                
-                
-
-                
-                
-                # Now, if all features were used to optimize, use gaussian interpolation (KRIGING actually)
-                if node_partition == 'all_features':
-                    kwargs['time_interpolation_method'] = 'gaussian'
-                
-                param_optimized = res.x # Error curves
-
-
-
-
-                ## This bit should be done differently depending on whether it is chunk-level or transect level
-                if not super_transects:
-
-                    # Apply corrected cam and pose parameters
+                # Iterate the data and put back the corrected parameters into the appropriate h5-files
+                for h5_filename in h5_filenames:
+                    # Select the right time stamps
+                    kwargs_transect['time_scanlines'] = Hyperspectral.get_dataset(h5_filename=h5_filename, dataset_name=h5_folder_time_scanlines)
 
                     apply_cam_and_pose_params(is_calibrated, 
-                                              h5_filename, 
-                                              param_optimized, 
-                                              h5_paths, 
-                                              plot_err_vec_time, 
-                                              kwargs, 
-                                              h5_folder_position_ecef_coreg,
-                                              h5_folder_quaternion_ecef_coreg,
-                                              calib_file_coreg,
-                                              cal_obj_prior,
-                                              sigma_nodes = None)
+                                            h5_filename, 
+                                            param_optimized, 
+                                            h5_paths, 
+                                            plot_err_vec_time, 
+                                            kwargs_transect, 
+                                            h5_folder_position_ecef_coreg,
+                                            h5_folder_quaternion_ecef_coreg,
+                                            calib_file_coreg,
+                                            cal_obj_prior,
+                                            sigma_nodes = None)
                     
-                else:
-                    # Iterate the data and put back the corrected parameters into the appropriate h5-files
-                    for h5_filename in transect_dict[i]:
-                        # Select the right time stamps
-                        kwargs['time_scanlines'] = Hyperspectral.get_dataset(h5_filename=h5_filename, dataset_name=h5_folder_time_scanlines)
-
-                        apply_cam_and_pose_params(is_calibrated, 
-                                              h5_filename, 
-                                              param_optimized, 
-                                              h5_paths, 
-                                              plot_err_vec_time, 
-                                              kwargs, 
-                                              h5_folder_position_ecef_coreg,
-                                              h5_folder_quaternion_ecef_coreg,
-                                              calib_file_coreg,
-                                              cal_obj_prior,
-                                              sigma_nodes = None)
-
-
-                
-            
+            # The solver diagnostics of all transects
+            pd.DataFrame(diagnostics_list).to_csv(os.path.splitext(gcp_path)[0] + '_diagnostics.csv', index=False)
             
 
         else:
@@ -1828,21 +2190,17 @@ def main(config_path, mode, is_calibrated, coreg_dict = {}):
 
             kwargs['time_scanlines'] = time_scanlines
             kwargs['time_nodes'] = time_nodes
-            # Calculate the Jacobian for finding and exploiting sparsity
-            J = numerical_jacobian(fun = objective_fun_reprojection_error, param = param0_variab_tot, **kwargs)
             
-            # Using list of list representation as recommended by Scipy's least squares
-            sparsity = lil_matrix(J.shape, dtype=int)
-
-            # Setting the non sparse elements (in theory they could be set for small values of J too)
-            sparsity[J != 0] = 1
+            # The features are packed once for all evaluations of the objective
+            kwargs['features_df'] = FeaturePack(df_current)
+            
             print(param0_variab_tot*180/np.pi)
             res = least_squares(fun = objective_fun_reprojection_error, 
                                 x0 = param0_variab_tot, 
                                 x_scale='jac',
-                                jac_sparsity=sparsity,
                                 kwargs=kwargs,
-                                loss = loss_function)
+                                loss = loss_function,
+                                **least_squares_jacobian(param0_variab_tot, kwargs))
             
             median_error_x = np.median(np.abs(res.fun[0:n_features]))*resolution
             median_error_y = np.median(np.abs(res.fun[n_features:2*n_features]))*resolution
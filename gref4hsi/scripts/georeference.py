@@ -15,6 +15,7 @@ import h5py
 from gref4hsi.utils.geometry_utils import CameraGeometry, CalibHSI
 from gref4hsi.utils.parsing_utils import Hyperspectral
 from gref4hsi.utils import visualize
+from gref4hsi.utils.footprint_index import read_aoi, pose_track_footprint
 
 
 def cal_file_to_rays(filename_cal):
@@ -164,6 +165,11 @@ def main(iniPath, viz = False, use_coreg_param = False):
     # Maximal allowed ray length
     max_ray_length = float(config['General']['max_ray_length'])
 
+    # Optional area of interest. Chunks whose pose track (buffered by the max ray length) is outside are skipped
+    epsg_geocsc = int(config['Coordinate Reference Systems']['geocsc_epsg_export'])
+    epsg_proj = int(config['Coordinate Reference Systems']['proj_epsg'])
+    aoi = read_aoi(config, crs='EPSG:' + str(epsg_proj))
+
     dem_per_transect = False
 
     try:
@@ -241,6 +247,17 @@ def main(iniPath, viz = False, use_coreg_param = False):
             # Path to hierarchical file
             h5_filename = dir_r + filename
 
+            if aoi is not None:
+                position_track = Hyperspectral.get_dataset(h5_filename=h5_filename,
+                                                           dataset_name= h5_folder_position_ecef)
+                
+                footprint_track = pose_track_footprint(position_track, epsg_geocsc, epsg_proj, buffer_distance=max_ray_length)
+
+                if not footprint_track.intersects(aoi):
+                    print(f'Skipping transect chunk outside area of interest: {filename}')
+                    file_count+=1
+                    continue
+
             # Read h5 file
             hyp = Hyperspectral(h5_filename, config)
 
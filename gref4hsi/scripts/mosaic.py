@@ -0,0 +1,464 @@
+import configparser
+import json
+import os
+import sys
+from collections import namedtuple, defaultdict
+
+import geopandas as gpd
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.warp import reproject, Resampling
+from osgeo import gdal
+from scipy.ndimage import distance_transform_edt
+from shapely.geometry import box, Polygon
+
+from gref4hsi.utils.parsing_utils import config_option
+
+
+# The orthorectified chunks are written either as GeoTIFF/COG or as ENVI, with one of these extensions
+RASTER_EXTENSIONS = ['.tif', '.img', '.bsq', '.bil', '.bip']
+
+# Suffixes added to the chunk name by GeoSpatialAbstractionHSI.cube_to_raster_grid
+RASTER_SUFFIXES = ['_north_east', '_rotated']
+
+# For the best-view rules, the ancillary band deciding which chunk wins a cell and the sign making larger scores better
+SCORE_BANDS = {'min_theta_v': ('theta_v', -1.0),
+               'latest': ('unix_time_grid', 1.0)}
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def find_chunk_raster(raster_path):
+    """Finds the raster of an orthorectified chunk, which is written with one of RASTER_EXTENSIONS
+
+    :param raster_path: Path to the raster without extension
+    :type raster_path: string
+    :return: The path to the raster or None if it does not exist
+    :rtype: string
+    """
+    for ext in RASTER_EXTENSIONS:
+        if os.path.exists(raster_path + ext):
+            return raster_path + ext
+    return None
+
+def list_chunks(product_dir, anc_dir, footprint_dir):
+    """Lists the orthorectified chunks of a product folder, along with their ancillary data and footprint
+
+    :param product_dir: Folder with the orthorectified RGB composites or datacubes
+    :type product_dir: string
+    :param anc_dir: Folder with the orthorectified ancillary data
+    :type anc_dir: string
+    :param footprint_dir: Folder with the footprint shape files
+    :type footprint_dir: string
+    :return: Dictionary with the chunk name as key
+    :rtype: dict
+    """
+    chunks = {}
+    for filename in sorted(os.listdir(product_dir)):
+        raster_name, ext = os.path.splitext(filename)
+        if ext not in RASTER_EXTENSIONS:
+            continue
+
+        # E.g. transect_1_north_east.tif belongs to the chunk transect_1
+        chunk_name = raster_name
+        for raster_suffix in RASTER_SUFFIXES:
+            if raster_name.endswith(raster_suffix):
+                chunk_name = raster_name[:-len(raster_suffix)]
+
+        product_path = os.path.join(product_dir, filename)
+
+        chunks[chunk_name] = {'product': product_path,
+                              'ancillary': find_chunk_raster(os.path.join(anc_dir, raster_name)),
+                              # Ancillary data written one file per layer is named <ancillary>_<layer>
+                              'ancillary_base': os.path.join(anc_dir, raster_name),
+                              'footprint': os.path.join(footprint_dir, chunk_name + '.shp'),
+                              'mtime': os.path.getmtime(product_path)}
+    return chunks
+
+def chunk_footprint(chunk, crs):
+    """The ground footprint of a chunk in the project CRS. Uses the footprint shape file if it exists, and otherwise the raster extent
+
+    :param chunk: Entry from list_chunks
+    :type chunk: dict
+    :param crs: The project CRS, e.g. 'EPSG:25832'
+    :type crs: string
+    :return: The footprint
+    :rtype: shapely geometry
+    """
+    if os.path.exists(chunk['footprint']):
+        gdf = gpd.read_file(chunk['footprint']).to_crs(crs)
+        return gdf.union_all()
+
+    # Rotated rasters (minimal_rectangle) need all four corners
+    with rasterio.open(chunk['product']) as src:
+        corners = [src.transform * (col, row) for col, row in [(0, 0), (src.width, 0), (src.width, src.height), (0, src.height)]]
+    return Polygon(corners)
+
+def tile_transform(tile, config_mosaic):
+    """The north-up transform of a tile. The tiles are aligned with the origin of the project CRS so that the grid is fixed between runs
+
+    :param tile: Tile index (ix, iy), where iy increases northwards
+    :type tile: tuple
+    :param config_mosaic: The mosaic settings
+    :type config_mosaic: SettingsMosaic
+    :return: The affine transform of the tile
+    :rtype: Affine
+    """
+    tile_extent = config_mosaic.resolution*config_mosaic.tile_size
+    ix, iy = tile
+    return from_origin(ix*tile_extent, (iy + 1)*tile_extent, config_mosaic.resolution, config_mosaic.resolution)
+
+def tiles_covering(footprint, config_mosaic):
+    """Returns the tiles intersecting a footprint
+
+    :param footprint: The footprint in the project CRS
+    :type footprint: shapely geometry
+    :param config_mosaic: The mosaic settings
+    :type config_mosaic: SettingsMosaic
+    :return: List of tile indices (ix, iy)
+    :rtype: list
+    """
+    tile_extent = config_mosaic.resolution*config_mosaic.tile_size
+    min_x, min_y, max_x, max_y = footprint.bounds
+
+    tiles = []
+    for ix in range(int(np.floor(min_x/tile_extent)), int(np.floor(max_x/tile_extent)) + 1):
+        for iy in range(int(np.floor(min_y/tile_extent)), int(np.floor(max_y/tile_extent)) + 1):
+            tile_box = box(ix*tile_extent, iy*tile_extent, (ix + 1)*tile_extent, (iy + 1)*tile_extent)
+            if tile_box.intersects(footprint):
+                tiles.append((ix, iy))
+    return tiles
+
+def warp_to_tile(source, src_transform, src_nodata, tile, config_mosaic, dtype, band_indexes = None):
+    """Warps (parts of) a chunk into the tile grid with nearest neighbour resampling. Only the source pixels overlapping the tile are read.
+
+    :param source: Open rasterio dataset or array of shape (k, h, w)
+    :type source: rasterio.DatasetReader or ndarray
+    :param src_transform: Transform of the source
+    :type src_transform: Affine
+    :param src_nodata: Nodata value of the source
+    :type src_nodata: float
+    :param tile: Tile index (ix, iy)
+    :type tile: tuple
+    :param config_mosaic: The mosaic settings
+    :type config_mosaic: SettingsMosaic
+    :param dtype: Data type of the warped array
+    :type dtype: numpy dtype
+    :param band_indexes: Bands (1-based) to warp when source is a dataset, defaults to all bands
+    :type band_indexes: list, optional
+    :return: The warped array of shape (k, tile_size, tile_size) and a mask of valid cells
+    :rtype: ndarray, ndarray(bool)
+    """
+    if isinstance(source, np.ndarray):
+        src = source
+        k = source.shape[0]
+    else:
+        if band_indexes is None:
+            band_indexes = list(source.indexes)
+        src = rasterio.band(source, band_indexes)
+        k = len(band_indexes)
+
+    destination = np.full((k, config_mosaic.tile_size, config_mosaic.tile_size), fill_value=config_mosaic.nodata, dtype=dtype)
+
+    reproject(source=src,
+              destination=destination,
+              src_transform=src_transform,
+              src_crs=config_mosaic.crs,
+              src_nodata=src_nodata,
+              dst_transform=tile_transform(tile, config_mosaic),
+              dst_crs=config_mosaic.crs,
+              dst_nodata=config_mosaic.nodata,
+              resampling=Resampling.nearest)
+
+    valid = np.all(destination != config_mosaic.nodata, axis = 0)
+
+    return destination, valid
+
+def feather_weights(src, feather_distance):
+    """Weights decaying towards the edges of the chunk footprint, used to blend overlapping chunks
+
+    :param src: The product raster of a chunk
+    :type src: rasterio.DatasetReader
+    :param feather_distance: Distance in pixels from the edge where the weight reaches one
+    :type feather_distance: float
+    :return: Weights of shape (1, h, w), zero outside the footprint
+    :rtype: ndarray
+    """
+    valid = src.read(1) != src.nodata
+
+    # Distance (in pixels) to nearest invalid pixel
+    weights = distance_transform_edt(valid)
+    weights = np.clip(weights/feather_distance, 0, 1).astype(np.float64)
+
+    return weights.reshape((1, src.height, src.width))
+
+def composite_tile(tile_data, tile_score, chunk_data, chunk_score, chunk_valid, rule):
+    """Composites a chunk into a tile in-place. For the best-view rules, the chunk replaces tile cells where its score is higher.
+    For feathering, the score is the accumulated weight and the tile holds the weighted average, so that chunks can be added one by one.
+
+    :param tile_data: The tile data of shape (k, h, w)
+    :type tile_data: ndarray
+    :param tile_score: The tile score of shape (h, w). -inf (best-view) or 0 (feather) for empty cells
+    :type tile_score: ndarray
+    :param chunk_data: The chunk warped to the tile, of shape (k, h, w)
+    :type chunk_data: ndarray
+    :param chunk_score: The score of the chunk, of shape (h, w)
+    :type chunk_score: ndarray
+    :param chunk_valid: Where the chunk has data, of shape (h, w)
+    :type chunk_valid: ndarray(bool)
+    :param rule: 'min_theta_v', 'latest' or 'feather'
+    :type rule: string
+    """
+    if rule == 'feather':
+        update = chunk_valid & (chunk_score > 0)
+
+        weight_old = tile_score[update]
+        weight_new = weight_old + chunk_score[update]
+
+        blended = (tile_data[:, update]*weight_old + chunk_data[:, update]*chunk_score[update])/weight_new
+
+        if np.issubdtype(tile_data.dtype, np.integer):
+            blended = np.round(blended)
+
+        tile_data[:, update] = blended.astype(tile_data.dtype)
+        tile_score[update] = weight_new
+    elif rule in SCORE_BANDS:
+        update = chunk_valid & (chunk_score > tile_score)
+
+        tile_data[:, update] = chunk_data[:, update]
+        tile_score[update] = chunk_score[update]
+    else:
+        raise ValueError(f'Unknown composite rule {rule}, use one of {list(SCORE_BANDS.keys()) + ["feather"]}')
+
+def tile_paths(tile, mosaic_dir):
+    """Paths to the data and score rasters of a tile"""
+    ix, iy = tile
+    tile_name = f'tile_{ix}_{iy}'
+    return os.path.join(mosaic_dir, tile_name + '.tif'), os.path.join(mosaic_dir, tile_name + '_score.tif')
+
+def read_tile(tile, mosaic_dir, config_mosaic, count, dtype):
+    """Reads a tile and its score, or makes an empty one if it does not exist yet"""
+    data_path, score_path = tile_paths(tile, mosaic_dir)
+
+    if os.path.exists(data_path):
+        with rasterio.open(data_path) as src:
+            tile_data = src.read()
+        with rasterio.open(score_path) as src:
+            tile_score = src.read(1)
+    else:
+        tile_data = np.full((count, config_mosaic.tile_size, config_mosaic.tile_size), fill_value=config_mosaic.nodata, dtype=dtype)
+        empty_score = 0 if config_mosaic.composite_rule == 'feather' else -np.inf
+        tile_score = np.full((config_mosaic.tile_size, config_mosaic.tile_size), fill_value=empty_score, dtype=np.float64)
+
+    return tile_data, tile_score
+
+def write_tile(tile, mosaic_dir, config_mosaic, tile_data, tile_score, band_names):
+    """Writes a tile and its score as tiled and compressed GeoTIFFs"""
+    data_path, score_path = tile_paths(tile, mosaic_dir)
+
+    profile = {'driver': 'GTiff',
+               'height': config_mosaic.tile_size,
+               'width': config_mosaic.tile_size,
+               'crs': config_mosaic.crs,
+               'transform': tile_transform(tile, config_mosaic),
+               'tiled': True,
+               'compress': 'deflate'}
+
+    with rasterio.open(data_path, 'w', count=tile_data.shape[0], dtype=tile_data.dtype, nodata=config_mosaic.nodata, **profile) as dst:
+        dst.write(tile_data)
+        for i, band_name in enumerate(band_names):
+            if band_name is not None:
+                dst.set_band_description(i + 1, band_name)
+
+    with rasterio.open(score_path, 'w', count=1, dtype=tile_score.dtype, **profile) as dst:
+        dst.write(tile_score, 1)
+
+def mosaic_chunk(chunk, tiles, mosaic_dir, config_mosaic):
+    """Streams one orthorectified chunk into the tiles it covers
+
+    :param chunk: Entry from list_chunks
+    :type chunk: dict
+    :param tiles: The tiles to update
+    :type tiles: list
+    :param mosaic_dir: Where the tiles are written
+    :type mosaic_dir: string
+    :param config_mosaic: The mosaic settings
+    :type config_mosaic: SettingsMosaic
+    """
+    rule = config_mosaic.composite_rule
+
+    with rasterio.open(chunk['product']) as src:
+        src_nodata = src.nodata if src.nodata is not None else config_mosaic.nodata
+        dtype = src.dtypes[0]
+        band_names = list(src.descriptions)
+
+        if rule == 'feather':
+            # Computed once for the whole chunk, as the distance to the edge is not local to a tile
+            weights = feather_weights(src, config_mosaic.feather_distance)
+        else:
+            score_band_name, score_sign = SCORE_BANDS[rule]
+            anc_path = chunk['ancillary']
+            if anc_path is None:
+                anc_path = find_chunk_raster(chunk['ancillary_base'] + '_' + score_band_name)
+            if anc_path is None:
+                raise FileNotFoundError(f'The composite rule {rule} needs ancillary data, which was not found for {chunk["product"]}')
+            anc = rasterio.open(anc_path)
+            score_band_index = list(anc.descriptions).index(score_band_name) + 1
+
+        for tile in tiles:
+            chunk_data, chunk_valid = warp_to_tile(src, src.transform, src_nodata, tile, config_mosaic, dtype)
+
+            if not chunk_valid.any():
+                continue
+
+            if rule == 'feather':
+                chunk_score, _ = warp_to_tile(weights, src.transform, 0, tile, config_mosaic, np.float64)
+            else:
+                anc_nodata = anc.nodata if anc.nodata is not None else config_mosaic.nodata
+                chunk_score, score_valid = warp_to_tile(anc, anc.transform, anc_nodata, tile, config_mosaic, np.float64, band_indexes=[score_band_index])
+                chunk_valid &= score_valid
+                # Decodes scaled integers, as chunks may be encoded differently
+                chunk_score = anc.scales[score_band_index - 1]*chunk_score + anc.offsets[score_band_index - 1]
+                if score_band_name == 'theta_v':
+                    # The view angle is signed in some ancillary data
+                    chunk_score = np.abs(chunk_score)
+                chunk_score = score_sign*chunk_score
+
+            chunk_score = chunk_score[0]
+
+            tile_data, tile_score = read_tile(tile, mosaic_dir, config_mosaic, count=chunk_data.shape[0], dtype=dtype)
+
+            composite_tile(tile_data, tile_score, chunk_data, chunk_score, chunk_valid, rule)
+
+            write_tile(tile, mosaic_dir, config_mosaic, tile_data, tile_score, band_names)
+
+        if rule != 'feather':
+            anc.close()
+
+def build_vrt(mosaic_dir, vrt_path):
+    """Builds a virtual raster of all data tiles so that the mosaic can be opened as one file"""
+    tile_files = sorted([os.path.join(mosaic_dir, f) for f in os.listdir(mosaic_dir)
+                         if f.startswith('tile_') and f.endswith('.tif') and not f.endswith('_score.tif')])
+
+    if len(tile_files) == 0:
+        return
+
+    vrt = gdal.BuildVRT(vrt_path, tile_files)
+    vrt = None # Flushes to disk
+
+def main(iniPath):
+    config = configparser.ConfigParser()
+    config.read(iniPath)
+
+    # The [Mosaic] section is optional, in which case defaults are used
+    # The product to mosaic. Either 'rgb' (RGB composites) or 'datacube'
+    product = config_option(config, 'Mosaic', 'product', 'rgb')
+
+    if product == 'rgb':
+        product_dir = config['Absolute Paths']['rgb_composite_folder']
+    elif product == 'datacube':
+        product_dir = config['Absolute Paths']['orthorectified_cube_folder']
+    else:
+        raise ValueError(f'Unknown mosaic product {product}, use either rgb or datacube')
+
+    anc_dir = config['Absolute Paths']['anc_folder']
+    footprint_dir = config['Absolute Paths']['footprint_folder']
+
+    try:
+        mosaic_dir = config['Absolute Paths']['mosaic_folder']
+    except KeyError:
+        mosaic_dir = os.path.join(config['General']['mission_dir'], 'Output/GIS/Mosaic/')
+
+    mosaic_dir = os.path.join(mosaic_dir, product)
+    os.makedirs(mosaic_dir, exist_ok=True)
+
+    # Settings associated with the mosaic
+    SettingsMosaic = namedtuple('SettingsMosaic', ['crs',
+                                                   'resolution',
+                                                   'tile_size',
+                                                   'composite_rule',
+                                                   'feather_distance',
+                                                   'nodata'])
+
+    config_mosaic = SettingsMosaic(crs = 'EPSG:' + config['Coordinate Reference Systems']['proj_epsg'],
+                                   # The mosaic is made in the projected CRS of orthorectification
+                                   resolution = float(config_option(config, 'Mosaic', 'resolution', config_option(config, 'Orthorectification', 'resolutionhyperspectralmosaic'))),
+                                   # Defaults to the resolution of the orthorectified chunks
+                                   tile_size = int(config_option(config, 'Mosaic', 'tile_size', '1024')),
+                                   # Size of tiles in pixels. Datacube tiles hold tile_size^2 * n_bands values in memory.
+                                   composite_rule = config_option(config, 'Mosaic', 'composite_rule', 'min_theta_v'),
+                                   # How overlapping chunks are combined: 'min_theta_v' (most nadir view), 'latest' or 'feather'
+                                   feather_distance = float(config_option(config, 'Mosaic', 'feather_distance', '50')),
+                                   # Distance in pixels from the footprint edge over which the feathering weight increases to one
+                                   nodata = float(config['Orthorectification']['nodata'])
+                                   # Same fill value as the orthorectified chunks
+                                   )
+
+    # The manifest records which chunks are in the tiles, so that only new or modified chunks are added when rerunning
+    manifest_path = os.path.join(mosaic_dir, MANIFEST_NAME)
+    settings_dict = config_mosaic._asdict()
+
+    manifest = {'settings': settings_dict, 'chunks': {}}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            manifest_old = json.load(f)
+        # A changed tile grid or rule invalidates all tiles
+        if manifest_old['settings'] == settings_dict:
+            manifest = manifest_old
+        else:
+            print('Mosaic settings have changed, rebuilding all tiles')
+            for f in os.listdir(mosaic_dir):
+                if f.startswith('tile_'):
+                    os.remove(os.path.join(mosaic_dir, f))
+
+    chunks = list_chunks(product_dir=product_dir, anc_dir=anc_dir, footprint_dir=footprint_dir)
+
+    # Chunks that were modified or removed since the last run must be taken out of their tiles, which is done by rebuilding the tiles
+    tiles_rebuild = set()
+    for chunk_name, chunk_entry in list(manifest['chunks'].items()):
+        if chunk_name not in chunks or chunks[chunk_name]['mtime'] != chunk_entry['mtime']:
+            tiles_rebuild.update(tuple(tile) for tile in chunk_entry['tiles'])
+            manifest['chunks'].pop(chunk_name)
+
+    for tile in tiles_rebuild:
+        for path in tile_paths(tile, mosaic_dir):
+            if os.path.exists(path):
+                os.remove(path)
+
+    # The tiles to update for each chunk
+    chunk_tiles = defaultdict(list)
+    for chunk_name, chunk in chunks.items():
+        if chunk_name in manifest['chunks']:
+            # Unchanged chunks only contribute to rebuilt tiles
+            chunk_tiles[chunk_name] = [tuple(tile) for tile in manifest['chunks'][chunk_name]['tiles'] if tuple(tile) in tiles_rebuild]
+        else:
+            footprint = chunk_footprint(chunk, crs=config_mosaic.crs)
+            tiles = tiles_covering(footprint, config_mosaic)
+            chunk_tiles[chunk_name] = tiles
+
+    print("\n################ Mosaicking: ################")
+    chunk_names = [chunk_name for chunk_name in chunks.keys() if len(chunk_tiles[chunk_name]) > 0]
+    n_chunks = len(chunk_names)
+    for chunk_count, chunk_name in enumerate(chunk_names):
+        progress_perc = 100*chunk_count/n_chunks
+        print(f"Mosaicking chunk {chunk_count+1}/{n_chunks}, progress is {progress_perc} %")
+
+        mosaic_chunk(chunk=chunks[chunk_name],
+                     tiles=chunk_tiles[chunk_name],
+                     mosaic_dir=mosaic_dir,
+                     config_mosaic=config_mosaic)
+
+        if chunk_name not in manifest['chunks']:
+            manifest['chunks'][chunk_name] = {'mtime': chunks[chunk_name]['mtime'],
+                                              'tiles': [list(tile) for tile in chunk_tiles[chunk_name]]}
+
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=4)
+
+    build_vrt(mosaic_dir=mosaic_dir, vrt_path=os.path.join(mosaic_dir, 'mosaic.vrt'))
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    iniPath = args[0]
+    main(iniPath)
@@ -1,18 +1,32 @@
 import configparser
+from glob import glob
 import os
 import sys
 from collections import namedtuple
 
+import h5py
 import matplotlib.pyplot as plt
 import numpy as np
 
 # Local resources:
-from gref4hsi.utils.gis_tools import GeoSpatialAbstractionHSI
-from gref4hsi.utils.parsing_utils import Hyperspectral
+from gref4hsi.utils.gis_tools import GeoSpatialAbstractionHSI, ANCILLARY_ENCODING_DEFAULTS
+from gref4hsi.utils.band_math import read_band_math
+from gref4hsi.utils.spectral_binning import read_spectral_binning, wavelength_subset
+from gref4hsi.utils.parsing_utils import Hyperspectral, config_option, infer_transect_structure
+from gref4hsi.utils.footprint_index import footprint_index_path, update_footprint_index, read_aoi, chunks_in_aoi, is_chunk_in_aoi
+from gref4hsi.utils.parallel_utils import ChunkTask, estimate_orthorectification_cost, classify_phases, physical_memory_bytes, run_memory_budgeted
+from gref4hsi.utils.transform_utils import transform_points
 
 
 
-def main(iniPath):
+def _read_settings(iniPath):
+    """Reads the settings of orthorectification. Called by each worker process, as the settings (namedtuples defined here) can not be pickled.
+
+    :param iniPath: Path to the configuration file
+    :type iniPath: string
+    :return: Dictionary with settings
+    :rtype: dict
+    """
     config = configparser.ConfigParser()
     config.read(iniPath)
 
@@ -32,6 +46,29 @@ def main(iniPath):
     # 3) The footprints
     footprint_dir = config['Absolute Paths']['footprint_folder']
 
+    # 4) The band math products (e.g. spectral indices)
+    try:
+        band_math_dir = config['Absolute Paths']['band_math_folder']
+    except KeyError:
+        band_math_dir = os.path.join(config['General']['mission_dir'], 'Output/GIS/BandMath/')
+
+    # Expressions over wavelengths, from the optional [Band math] section
+    band_math = read_band_math(config)
+    if len(band_math) > 0:
+        os.makedirs(band_math_dir, exist_ok=True)
+
+    # 5) The resampling lookup tables, which allow skipping the geometry when re-running
+    try:
+        lut_dir = config['Absolute Paths']['lut_folder']
+    except KeyError:
+        lut_dir = os.path.join(config['General']['mission_dir'], 'Intermediate/LUT/')
+    os.makedirs(lut_dir, exist_ok=True)
+
+    try:
+        reuse_lut = eval(config_option(config, 'Orthorectification', 'reuse_lut'))
+    except KeyError:
+        reuse_lut = True
+
     
 
 
@@ -68,19 +105,82 @@ def main(iniPath):
         # Defaults to 'nn'
         pixel_mask_method = 'nn'
 
+    # Nearest picks the closest pixel for each cell, while Mean/Median aggregates all pixels in a cell (for resolutions coarser than the ground sampling distance)
+    try:
+        resampling_method = config_option(config, 'Orthorectification', 'resamplingmethod').lower()
+    except KeyError:
+        resampling_method = 'nearest'
+
+    if resampling_method not in ['nearest', 'mean', 'median']:
+        raise ValueError(f'Unknown resamplingmethod {resampling_method}, use one of nearest, mean or median')
+
+    # The output raster format. 'default' writes ENVI datacubes/ancillary data and GeoTIFF composites,
+    # while 'cog' writes cloud optimized GeoTIFFs (internal tiling and overviews) for composites and ancillary data
+    # and 'zarr' writes datacubes and ancillary data as chunked Zarr arrays (requires the zarr package)
+    try:
+        output_format = config_option(config, 'Orthorectification', 'output_format')
+    except KeyError:
+        output_format = 'default'
+
+    try:
+        # Datacubes are only written as COG if explicitly requested
+        cog_datacube = eval(config_option(config, 'Orthorectification', 'cog_datacube'))
+    except KeyError:
+        cog_datacube = False
+
+    # Creation options of the COG driver, see https://gdal.org/drivers/raster/cog.html
+    cog_options = {'compress': config_option(config, 'Orthorectification', 'cog_compress', 'DEFLATE'),
+                   'predictor': config_option(config, 'Orthorectification', 'cog_predictor', 'YES'),
+                   'blocksize': int(config_option(config, 'Orthorectification', 'cog_blocksize', '512')),
+                   'overview_resampling': config_option(config, 'Orthorectification', 'cog_overview_resampling', 'AVERAGE')}
+    
+    # Chunking and Blosc compression of Zarr outputs. Spatial chunks have the size of COG tiles
+    zarr_options = {'blocksize': int(config_option(config, 'Orthorectification', 'cog_blocksize', '512')),
+                    'band_chunk': int(config_option(config, 'Orthorectification', 'zarr_band_chunk', '32')),
+                    'compressor': config_option(config, 'Orthorectification', 'zarr_compressor', 'zstd'),
+                    'clevel': int(config_option(config, 'Orthorectification', 'zarr_clevel', '5'))}
+
 
 
+    # Optionally, only a wavelength range is orthorectified and the bands are binned
+    wavelength_range, spectral_bin_width, spectral_bin_centers = read_spectral_binning(config)
+
     # The necessary data (a dictionary) from H5 file for resampling ancillary data (uses the same grid as datacube)
     anc_dict = config['Ancillary']
 
+    # Ancillary layers are either written together as float64 or one file per layer with its own dtype and scale ('per_layer')
+    try:
+        ancillary_encoding = config_option(config, 'Orthorectification', 'ancillary_encoding')
+    except KeyError:
+        ancillary_encoding = 'float64'
+
+    if ancillary_encoding == 'per_layer':
+        anc_encoding = dict(ANCILLARY_ENCODING_DEFAULTS)
+        if config.has_section('Ancillary encoding'):
+            # Entries like "theta_v = int16, 0.01" (dtype and optionally scale)
+            for attribute_name, encoding in config['Ancillary encoding'].items():
+                encoding = [val.strip() for val in encoding.split('#')[0].split(',')]
+                anc_encoding[attribute_name] = (encoding[0], float(encoding[1]) if len(encoding) > 1 else 1)
+    else:
+        anc_encoding = None
+
     # Settings having to do with coordinate reference systems, described below
     SettingsCRS = namedtuple('SettingsOrthorectification', ['epsg_geocsc', 
-                                                              'epsg_proj'])
+                                                              'epsg_proj',
+                                                              'approx_transform_tolerance'])
+    
+    # The point cloud can be projected by a polynomial fitted per chunk, used only if its maximal residual is below the tolerance (in meters)
+    try:
+        approx_transform_tolerance = float(config_option(config, 'Coordinate Reference Systems', 'approx_transform_tolerance'))
+    except KeyError:
+        approx_transform_tolerance = 0 # Exact
     
     config_crs = SettingsCRS(epsg_geocsc=int(config['Coordinate Reference Systems']['geocsc_epsg_export']),
                              # The epsg code of the geocentric coordinate system (ECEF)
                              epsg_proj=int(config['Coordinate Reference Systems']['proj_epsg']),
                              # The epsg code of the projected coordinate system (e.g. UTM 32 has epsg 32632 for wgs 84 ellipsoid)
+                             approx_transform_tolerance=approx_transform_tolerance
+                             # Maximal residual of the approximate projection, where 0 disables it
                              )
 
     # Settings associated with orthorectification of datacube
@@ -96,7 +196,16 @@ def main(iniPath):
                                                                             'radiometric_unit',
                                                                             'sensor_type',
                                                                             'interleave',
-                                                                            'pixel_mask_method'])
+                                                                            'pixel_mask_method',
+                                                                            'resampling_method',
+                                                                            'output_format',
+                                                                            'cog_datacube',
+                                                                            'cog_options',
+                                                                            'zarr_options',
+                                                                            'band_math',
+                                                                            'wavelength_range',
+                                                                            'spectral_bin_width',
+                                                                            'spectral_bin_centers'])
     
     config_ortho = SettingsOrtho(ground_resolution = float(config['Orthorectification']['resolutionHyperspectralMosaic']), 
                                  # Rectified grid resolution in meters
@@ -127,85 +236,417 @@ def main(iniPath):
                               interleave = config['Orthorectification']['interleave'],
                               # ENVI interleave: either 'bsq', 'bip' or 'bil', see:
                               # https://envi.geoscene.cn/help/Subsystems/envi/Content/ExploreImagery/ENVIImageFiles.html
-                              pixel_mask_method = pixel_mask_method
+                              pixel_mask_method = pixel_mask_method,
                               # When resampling how to mask nodata pixels: either 'nn' or 'footprint
+                              resampling_method = resampling_method,
+                              # Either 'nearest' (one pixel per cell) or 'mean'/'median' (all pixels in a cell)
+                              output_format = output_format,
+                              # Either 'default' (ENVI and GeoTIFF), 'gtiff' (ancillary data as compressed GeoTIFF), 'cog' (cloud optimized GeoTIFF) or 'zarr'
+                              cog_datacube = cog_datacube,
+                              # Whether datacubes are also written as COG when output_format is 'cog'
+                              cog_options = cog_options,
+                              # Compression, predictor, tile size and overview resampling for COG outputs
+                              zarr_options = zarr_options,
+                              # Chunk sizes and compression of Zarr outputs
+                              band_math = band_math,
+                              # Expressions over wavelengths (e.g. ndvi = (R800 - R670)/(R800 + R670)) written as single band rasters
+                              wavelength_range = wavelength_range,
+                              # (min, max) wavelength of the bands to orthorectify, or None for all
+                              spectral_bin_width = spectral_bin_width,
+                              # Width of spectral bins of the datacube in <wavelength_unit>, or None
+                              spectral_bin_centers = spectral_bin_centers
+                              # Target wavelengths of spectral bins (used instead of the width), or None
                               )
 
 
+    # Timestamps of the scanlines
+    h5_folder_time_scanlines = config['HDF.processed_nav']['timestamp']
+
+    return {'config': config,
+            'h5_folder': h5_folder,
+            'envi_cube_dir': envi_cube_dir,
+            'rgb_composite_dir': rgb_composite_dir,
+            'anc_dir': anc_dir,
+            'footprint_dir': footprint_dir,
+            'band_math_dir': band_math_dir,
+            'lut_dir': lut_dir,
+            'reuse_lut': reuse_lut,
+            'h5_folder_point_cloud_ecef': h5_folder_point_cloud_ecef,
+            'is_calibrated': is_calibrated,
+            'h5_folder_radiance_cube': h5_folder_radiance_cube,
+            'h5_folder_wavelength_centers': h5_folder_wavelength_centers,
+            'h5_folder_wavelength_widths': h5_folder_wavelength_widths,
+            'h5_folder_time_scanlines': h5_folder_time_scanlines,
+            'anc_dict': anc_dict,
+            'anc_encoding': anc_encoding,
+            'config_crs': config_crs,
+            'config_ortho': config_ortho}
+
+def _orthorectify_chunk(iniPath, filename, aoi = None, transect_grid = None, transect_writers = None, neighbour_points = None):
+    """Orthorectifies one h5 file: the datacube and/or RGB composite and the ancillary data. Runs in a worker process when n_workers > 1,
+    so nothing shared between chunks (like the footprint index) is written here.
+
+    :param iniPath: Path to the configuration file
+    :type iniPath: string
+    :param filename: The h5 file name
+    :type filename: string
+    :param aoi: Optional area of interest, defaults to None
+    :type aoi: shapely geometry, optional
+    :param transect_grid: If given, the chunk is written into the grid of its transect (see _orthorectify_transect), defaults to None
+    :type transect_grid: TransectGrid, optional
+    :param transect_writers: The open writers of the transect, defaults to None
+    :type transect_writers: dict, optional
+    :param neighbour_points: Geocentric points of the adjacent lines of the neighbouring chunks of the transect, defaults to None
+    :type neighbour_points: ndarray(j, 3), optional
+    :return: The outcome ('done', 'failed' or 'outside_aoi') and the footprint and time range for the footprint index
+    :rtype: dict
+    """
+    settings = _read_settings(iniPath)
+
+    config = settings['config']
+    config_crs = settings['config_crs']
+    config_ortho = settings['config_ortho']
+
+    # Path to hierarchical file
+    h5_filename = settings['h5_folder'] + filename
+
+    result = {'filename': filename,
+              'h5_filename': h5_filename,
+              'status': 'failed'}
+
+    # Read the 3D point cloud, radiance cube 
+    # Extract the point cloud (if it was not georeferenced, it will throw an error)
+    try:
+        point_cloud_ecef = Hyperspectral.get_dataset(h5_filename=h5_filename,
+                                                 dataset_name=settings['h5_folder_point_cloud_ecef'])
+    except:
+        print('Because chunk failed ray tracing, it is not orthorectified')
+        return result # Move to next h5 file
+    # Need the radiance cube for resampling
+    if not settings['is_calibrated']:
+        # load_datacube will calibrate and write radiance data cube to h5 file (if not already there)
+        hyp = Hyperspectral(filename=h5_filename, config=config, load_datacube=True)
+        del hyp
+    
+    wavelengths = Hyperspectral.get_dataset(h5_filename=h5_filename,
+                                                    dataset_name=settings['h5_folder_wavelength_centers'])
+    try:
+        fwhm = Hyperspectral.get_dataset(h5_filename=h5_filename,
+                                                    dataset_name=settings['h5_folder_wavelength_widths'])
+    except KeyError:
+        fwhm = np.nan
+
+    # Only the bands within the wavelength range are read
+    band_subset = wavelength_subset(wavelengths, config_ortho.wavelength_range)
+    
+    # Todo, don't georeference actual cube, but use dataset
+    with h5py.File(h5_filename, 'r', libver='latest') as f:
+        radiance_cube = f[settings['h5_folder_radiance_cube']][:, :, band_subset]
+
+    wavelengths = wavelengths[band_subset]
+    if np.ndim(fwhm) > 0:
+        fwhm = fwhm[band_subset]
+
+
+    # The code below is independent of the h5 file format. The exception is the writing of ancillary data to a form of datacube
+    # Generates an object for dealing with GIS operations
+    gisHSI = GeoSpatialAbstractionHSI(point_cloud=point_cloud_ecef, 
+                                      transect_string=filename.split('.')[0],
+                                      config_crs=config_crs)
+
+    # The lookup table from the rectified grid to the raw data only depends on the georeferenced points and grid settings
+    lut_path = gisHSI.resampling_lut_path(lut_dir=settings['lut_dir'], config_ortho=config_ortho)
+
+    if transect_grid is not None:
+        # Within a transect, the lookup table also depends on the neighbouring chunks and is not persisted
+        gisHSI.transform_geocentric_to_projected(config_crs=config_crs)
+
+        gisHSI.compute_resampling_lut_in_transect(config_ortho=config_ortho, 
+                                                  transect_grid=transect_grid, 
+                                                  neighbour_points=neighbour_points)
+    elif settings['reuse_lut'] and os.path.exists(lut_path):
+        gisHSI.load_resampling_lut(lut_path=lut_path)
+    else:
+        # The point cloud is transformed to the projected system
+        gisHSI.transform_geocentric_to_projected(config_crs=config_crs)
+
+        gisHSI.compute_resampling_lut(config_ortho=config_ortho)
+
+        gisHSI.save_resampling_lut(lut_path=lut_path)
+
+    # Calculate the footprint of hyperspectral data
+    gisHSI.footprint_to_shape_file(footprint_dir=settings['footprint_dir'])
+    
+    time_scanlines = Hyperspectral.get_dataset(h5_filename=h5_filename,
+                                               dataset_name=settings['h5_folder_time_scanlines'])
+    
+    result['footprint'] = gisHSI.footprint_shp
+    result['crs'] = gisHSI.crs
+    result['t_start'] = time_scanlines.min()
+    result['t_end'] = time_scanlines.max()
+    
+    # Chunks that were not indexed before are checked now that the footprint is known
+    if aoi is not None:
+        if not gisHSI.footprint_shp.intersects(aoi):
+            print(f'Skipping transect chunk outside area of interest: {filename}')
+            result['status'] = 'outside_aoi'
+            return result
+    
+    
+    
+    # The ancilliary data is read from h5 files and resampled in the same pass as the imagery
+    if eval(config['Orthorectification']['resample_ancillary']): 
+        anc_dict = settings['anc_dict']
+    else:
+        anc_dict = None
+
+    # Resample imagery (RGB composite or both) and ancillary data
+    gisHSI.resample_products(radiance_cube=radiance_cube,
+                             wavelengths=wavelengths,
+                             fwhm=fwhm,
+                             envi_cube_dir=settings['envi_cube_dir'],
+                             rgb_composite_dir=settings['rgb_composite_dir'],
+                             config_ortho=config_ortho,
+                             h5_filename=h5_filename,
+                             anc_dir=settings['anc_dir'],
+                             anc_dict=anc_dict,
+                             anc_encoding=settings['anc_encoding'],
+                             band_math_dir=settings['band_math_dir'],
+                             transect_writers=transect_writers)
+    
+    result['status'] = 'done'
+
+    return result
+
+def _orthorectify_transect(iniPath, transect_name, filenames, aoi = None):
+    """Orthorectifies the chunks of one transect into one grid, so that each product is a single file per transect. The grid encloses the footprints of all chunks,
+    and the chunks are written in order into their windows of it (see GeoSpatialAbstractionHSI.compute_resampling_lut_in_transect). 
+    Only one chunk is held in memory at a time, and the files are created by the first chunk and closed after the last.
+
+    :param iniPath: Path to the configuration file
+    :type iniPath: string
+    :param transect_name: The name of the output files
+    :type transect_name: string
+    :param filenames: The h5 file names of the chunks, in chronological order
+    :type filenames: list of string
+    :param aoi: Optional area of interest, defaults to None
+    :type aoi: shapely geometry, optional
+    :return: The result of each chunk, see _orthorectify_chunk
+    :rtype: list of dict
+    """
+    settings = _read_settings(iniPath)
+
+    config_crs = settings['config_crs']
+    config_ortho = settings['config_ortho']
+
+    # The first and last line and the first and last pixel of each line of the georeferenced chunks
+    edges = {}
+    for filename in filenames:
+        try:
+            with h5py.File(settings['h5_folder'] + filename, 'r', libver='latest') as f:
+                point_cloud = f[settings['h5_folder_point_cloud_ecef']]
+                edges[filename] = {'first_line': point_cloud[0, :, :],
+                                   'last_line': point_cloud[-1, :, :],
+                                   'sides': np.vstack((point_cloud[:, 0, :], point_cloud[:, -1, :]))}
+        except KeyError:
+            # Failed ray tracing, which is reported by _orthorectify_chunk
+            pass
+    
+    if len(edges) == 0:
+        return [_orthorectify_chunk(iniPath, filename, aoi) for filename in filenames]
+
+    edge_points = np.vstack([np.vstack(list(chunk_edges.values())) for chunk_edges in edges.values()])
+    edge_coords = transform_points(edge_points, config_crs.epsg_geocsc, config_crs.epsg_proj)[:, 0:2]
+    edge_coords = edge_coords[np.all(np.isfinite(edge_coords), axis=1)]
+
+    transect_grid = GeoSpatialAbstractionHSI.define_transect_grid(edge_coords=edge_coords, 
+                                                                  name=transect_name, 
+                                                                  raster_transform_method=config_ortho.raster_transform_method, 
+                                                                  resolution=config_ortho.ground_resolution)
+    
+    print(f'Orthorectifying {len(filenames)} chunks into {transect_name}{transect_grid.suffix} ({transect_grid.height} x {transect_grid.width} cells)')
+
+    georeferenced = [filename for filename in filenames if filename in edges]
+
+    transect_writers = {}
+    results = []
+    for filename in filenames:
+        if filename in edges:
+            # Cells are assigned to the chunk or its neighbours by the nearest point, so the adjacent lines of the neighbours are needed
+            i = georeferenced.index(filename)
+            neighbour_lines = []
+            if i > 0:
+                neighbour_lines.append(edges[georeferenced[i - 1]]['last_line'])
+            if i < len(georeferenced) - 1:
+                neighbour_lines.append(edges[georeferenced[i + 1]]['first_line'])
+
+            neighbour_points = np.vstack(neighbour_lines) if len(neighbour_lines) > 0 else None
+        else:
+            neighbour_points = None
+
+        results.append(_orthorectify_chunk(iniPath, filename, aoi, 
+                                           transect_grid=transect_grid, 
+                                           transect_writers=transect_writers, 
+                                           neighbour_points=neighbour_points))
+    
+    for writer in transect_writers.values():
+        writer.close()
+
+    return results
+
+def main(iniPath):
+    settings = _read_settings(iniPath)
+
+    config = settings['config']
+    h5_folder = settings['h5_folder']
+    config_crs = settings['config_crs']
+    config_ortho = settings['config_ortho']
+
+    # Chunks can be orthorectified in parallel processes. Each chunk is admitted only if the estimated peak memory of all running chunks fits in the RAM budget
+    try:
+        n_workers = int(config_option(config, 'Orthorectification', 'n_workers'))
+    except KeyError:
+        n_workers = 1
+
+    try:
+        ram_budget_GB = float(config_option(config, 'Orthorectification', 'ram_budget_gb'))
+    except KeyError:
+        # Leave some memory for the operating system and the parent process
+        ram_budget_GB = 0.75*physical_memory_bytes()/1024**3
+
+    # The chunks of a transect can be written into one grid (one file per product and transect) rather than a grid per chunk
+    try:
+        per_transect = eval(config_option(config, 'Orthorectification', 'per_transect'))
+    except KeyError:
+        per_transect = False
+
+    # The footprints and time ranges of all chunks are indexed for the mission
+    index_path = footprint_index_path(config)
+
+    # Optional area of interest. Indexed chunks outside it are skipped without reading the point cloud
+    aoi = read_aoi(config, crs='EPSG:' + str(config_crs.epsg_proj))
+    if aoi is not None:
+        aoi_chunks, indexed_chunks = chunks_in_aoi(index_path, aoi)
+
     print("\n################ Orthorectifying: ################")
     files = sorted(os.listdir(h5_folder))
     # Filter out files that do not end with ".h5"
     h5_files = [file for file in files if file.endswith(".h5")]
+
+    if aoi is not None:
+        h5_files_aoi = [filename for filename in h5_files if is_chunk_in_aoi(filename.split('.')[0], aoi_chunks, indexed_chunks)]
+        print(f'Skipping {len(h5_files) - len(h5_files_aoi)} transect chunks outside area of interest')
+        h5_files = h5_files_aoi
+
     n_files= len(h5_files)    
     file_count = 0
-    for filename in h5_files:
-        if filename.endswith('h5') or filename.endswith('hdf'):
 
+    if per_transect:
+        # Consecutive chunks are grouped by their timestamps, and the files of each transect are named after its first chunk
+        transect_structure = infer_transect_structure(h5_dir=h5_folder, 
+                                                      h5_folder_time_scanlines=settings['h5_folder_time_scanlines'])
+        transects = {}
+        for h5_filepaths in transect_structure.values():
+            transect_files = [os.path.basename(h5_filepath) for h5_filepath in h5_filepaths if os.path.basename(h5_filepath) in h5_files]
+            if len(transect_files) > 0:
+                transects[transect_files[0].split('.')[0] + '_transect'] = transect_files
+
+    def on_result(result):
+        nonlocal file_count
+
+        # The parent process is the only writer of the footprint index
+        if 'footprint' in result:
+            update_footprint_index(index_path=index_path, 
+                                   chunk_name=result['filename'].split('.')[0], 
+                                   footprint=result['footprint'], 
+                                   crs=result['crs'], 
+                                   h5_filename=result['h5_filename'], 
+                                   t_start=result['t_start'], 
+                                   t_end=result['t_end'])
+        file_count+=1
+        if n_workers > 1:
             progress_perc = 100*file_count/n_files
-            print(f"Orthorectifying file {file_count+1}/{n_files}, progress is {progress_perc} %")
-            # Path to hierarchical file
-            h5_filename = h5_folder + filename
-
-            # Read the 3D point cloud, radiance cube 
-            # Extract the point cloud (if it was not georeferenced, it will throw an error)
-            try:
-                point_cloud_ecef = Hyperspectral.get_dataset(h5_filename=h5_filename,
-                                                         dataset_name=h5_folder_point_cloud_ecef)
-            except:
-                print('Because chunk failed ray tracing, it is not orthorectified')
-                continue # Move to next h5 file
-            # Need the radiance cube for resampling
-            if not is_calibrated:
-                # load_datacube will calibrate and write radiance data cube to h5 file (if not already there)
-                hyp = Hyperspectral(filename=h5_filename, config=config, load_datacube=True)
-                del hyp
-            
-            # Todo, don't georeference actual cube, but use dataset
-            radiance_cube = Hyperspectral.get_dataset(h5_filename=h5_filename,
-                                                            dataset_name = h5_folder_radiance_cube)
+            print(f"Orthorectified file {file_count}/{n_files} ({result['filename']}: {result['status']}), progress is {progress_perc} %")
 
+    if n_workers <= 1 and per_transect:
+        for transect_name, transect_files in transects.items():
+            progress_perc = 100*file_count/n_files
+            print(f"Orthorectifying files {file_count+1}-{file_count+len(transect_files)}/{n_files}, progress is {progress_perc} %")
+            for result in _orthorectify_transect(iniPath, transect_name, transect_files, aoi):
+                on_result(result)
+    elif n_workers <= 1:
+        for filename in h5_files:
+            progress_perc = 100*file_count/n_files
+            print(f"Orthorectifying file {file_count+1}/{n_files}, progress is {progress_perc} %")
+            on_result(_orthorectify_chunk(iniPath, filename, aoi))
+    else:
+        tasks = []
+        io_bytes_list = []
+        cpu_work_list = []
+        memory_list = []
+
+        h5_paths = {'point_cloud': settings['h5_folder_point_cloud_ecef'],
+                    'radiance_cube': settings['h5_folder_radiance_cube'],
+                    'raw_cube': config['HDF.hyperspectral']['datacube']}
         
-            wavelengths = Hyperspectral.get_dataset(h5_filename=h5_filename,
-                                                            dataset_name=h5_folder_wavelength_centers)
+        for filename in h5_files:
+            h5_filename = h5_folder + filename
             try:
-                fwhm = Hyperspectral.get_dataset(h5_filename=h5_filename,
-                                                            dataset_name=h5_folder_wavelength_widths)
+                # Estimate from dataset shapes, and whether the geometry is likely skipped (the exact lookup table key requires reading the point cloud)
+                lut_cached = settings['reuse_lut'] and not per_transect and len(glob(os.path.join(settings['lut_dir'], filename.split('.')[0] + '_*.npz'))) > 0
+
+                peak_bytes, io_bytes, cpu_work = estimate_orthorectification_cost(h5_filename=h5_filename, 
+                                                                                  h5_paths=h5_paths, 
+                                                                                  anc_dict=settings['anc_dict'], 
+                                                                                  config_ortho=config_ortho, 
+                                                                                  config_crs=config_crs, 
+                                                                                  lut_cached=lut_cached)
             except KeyError:
-                fwhm = np.nan
-
-
-            # The code below is independent of the h5 file format. The exception is the writing of ancillary data to a form of datacube
-            # Generates an object for dealing with GIS operations
-            gisHSI = GeoSpatialAbstractionHSI(point_cloud=point_cloud_ecef, 
-                                              transect_string=filename.split('.')[0],
-                                              config_crs=config_crs)
-
-            # The point cloud is transformed to the projected system
-            gisHSI.transform_geocentric_to_projected(config_crs=config_crs)
+                # Not georeferenced, which is handled (and reported) by the worker
+                peak_bytes, io_bytes, cpu_work = 0, 0, 0
 
-            # Calculate the footprint of hyperspectral data
-            gisHSI.footprint_to_shape_file(footprint_dir=footprint_dir)
+            memory_list.append(peak_bytes)
+            io_bytes_list.append(io_bytes)
+            cpu_work_list.append(cpu_work)
             
-            
-            
-            # Resample imagery (RGB composite or both)#!
-            gisHSI.resample_datacube(radiance_cube=radiance_cube,
-                                     wavelengths=wavelengths,
-                                     fwhm=fwhm,
-                                     envi_cube_dir=envi_cube_dir,
-                                     rgb_composite_dir=rgb_composite_dir,
-                                     config_ortho=config_ortho)
+        if per_transect:
+            # A transect is one task since its chunks write to the same files. The chunks are processed one at a time, so the peak is that of the largest
+            chunk_costs = dict(zip(h5_files, zip(memory_list, io_bytes_list, cpu_work_list)))
 
+            memory_list = [max(chunk_costs[filename][0] for filename in transect_files) for transect_files in transects.values()]
+            io_bytes_list = [sum(chunk_costs[filename][1] for filename in transect_files) for transect_files in transects.values()]
+            cpu_work_list = [sum(chunk_costs[filename][2] for filename in transect_files) for transect_files in transects.values()]
             
-
-            # The ancilliary data is read from h5 files and converted into a datacube
-            if eval(config['Orthorectification']['resample_ancillary']): 
-                gisHSI.resample_ancillary(h5_filename=h5_filename, 
-                                        anc_dict = anc_dict, 
-                                        anc_dir = anc_dir,
-                                        interleave=config_ortho.interleave)
+        phases = classify_phases(io_bytes_list, cpu_work_list)
+
+        if per_transect:
+            for (transect_name, transect_files), peak_bytes, phase in zip(transects.items(), memory_list, phases):
+                tasks.append(ChunkTask(key=transect_name, 
+                                       args=(iniPath, transect_name, transect_files, aoi), 
+                                       memory_bytes=peak_bytes, 
+                                       phase=phase))
+        else:
+            for filename, peak_bytes, phase in zip(h5_files, memory_list, phases):
+                tasks.append(ChunkTask(key=filename, 
+                                       args=(iniPath, filename, aoi), 
+                                       memory_bytes=peak_bytes, 
+                                       phase=phase))
         
-        file_count+=1
+        print(f'Orthorectifying with {n_workers} workers and a RAM budget of {ram_budget_GB:.1f} GB')
+
+        if per_transect:
+            run_memory_budgeted(worker_fn=_orthorectify_transect, 
+                                tasks=tasks, 
+                                n_workers=n_workers, 
+                                ram_budget_bytes=ram_budget_GB*1024**3, 
+                                on_result=lambda task, results: [on_result(result) for result in results])
+        else:
+            run_memory_budgeted(worker_fn=_orthorectify_chunk, 
+                                tasks=tasks, 
+                                n_workers=n_workers, 
+                                ram_budget_bytes=ram_budget_GB*1024**3, 
+                                on_result=lambda task, result: on_result(result))
+
 if __name__ == '__main__':
     args = sys.argv[1:]
     iniPath = args[0]
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from gref4hsi.utils.band_math import BandMathExpression
+
+
+WAVELENGTHS = np.arange(400, 1001, 10, dtype=np.float64)
+
+
+def test_ndvi():
+    ndvi = BandMathExpression('ndvi', '(R800 - R670)/(R800 + R670)', WAVELENGTHS)
+
+    rows = np.random.default_rng(0).uniform(0.1, 1, size=(100, WAVELENGTHS.size))
+    r800 = rows[:, np.argmin(np.abs(WAVELENGTHS - 800))]
+    r670 = rows[:, np.argmin(np.abs(WAVELENGTHS - 670))]
+
+    np.testing.assert_allclose(ndvi.evaluate(rows), (r800 - r670)/(r800 + r670))
+
+def test_functions():
+    rows = np.random.default_rng(1).uniform(0.1, 1, size=(10, WAVELENGTHS.size))
+    r800 = rows[:, np.argmin(np.abs(WAVELENGTHS - 800))].copy()
+    r670 = rows[:, np.argmin(np.abs(WAVELENGTHS - 670))].copy()
+
+    np.testing.assert_allclose(BandMathExpression('a', 'sqrt(R800) + maximum(R800, R670)', WAVELENGTHS).evaluate(rows), 
+                               np.sqrt(r800) + np.maximum(r800, r670))
+    np.testing.assert_allclose(BandMathExpression('b', 'mean(R800, R670, 2)', WAVELENGTHS).evaluate(rows), (r800 + r670 + 2)/3)
+
+    # The bands are not modified
+    np.testing.assert_array_equal(rows[:, np.argmin(np.abs(WAVELENGTHS - 670))], r670)
+
+def test_division_by_zero_is_nodata():
+    rows = np.zeros((3, WAVELENGTHS.size))
+    assert np.all(BandMathExpression('ratio', 'R800/R670', WAVELENGTHS).evaluate(rows, nodata=-9999) == -9999)
+
+@pytest.mark.parametrize('expression', ['R800.real',
+                                        'R800[0]',
+                                        '(lambda x: x)(R800)',
+                                        '__import__("os")',
+                                        'ndvi(R800)',
+                                        'foo + R800',
+                                        'sqrt(R800, R670)',
+                                        'log(R800, 2)',
+                                        'minimum(R800)',
+                                        'mean()',
+                                        'sqrt(*R800)',
+                                        'sqrt(x=R800)',
+                                        'R800 if R670 else R700',
+                                        'R2000',
+                                        'R800 +'])
+def test_rejected(expression):
+    with pytest.raises(ValueError):
+        BandMathExpression('product', expression, WAVELENGTHS)
@@ -0,0 +1,118 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.spatial.transform import Rotation as RotLib
+
+from gref4hsi.scripts.coregistration import (FeaturePack, interpolate_time_nodes, interpolation_weights, jacobian_reprojection_error,
+                                             jacobian_sparsity_pattern, objective_fun_reprojection_error)
+
+
+# rx, ry, rz, cx, f, k1, k2, k3, tx, ty, tz
+PARAM0 = np.array([0.01, -0.02, 0.03, 500, 1000, 1e-13, 1e-8, 1e-6, 0.1, 0.2, 0.3])
+
+# Finite difference steps of the intrinsic parameters, followed by the position [m] and orientation [deg] errors at the nodes
+STEPS_INTR = np.array([1e-6, 1e-6, 1e-6, 1e-3, 1e-3, 1e-15, 1e-10, 1e-8, 1e-3, 1e-3, 1e-3])
+STEP_POS = 1e-3
+STEP_ROT = 1e-4
+
+TIME_NODES = np.linspace(0, 100, 7)
+TIME_SCANLINES = np.linspace(0, 100, 500)
+
+
+def synthetic_features(n = 200, seed = 1):
+    """Features seen by a camera looking roughly down from 100 m"""
+    rng = np.random.default_rng(seed)
+
+    pos = np.array([3e6, 5e5, 5.5e6]) + rng.normal(0, 100, (n, 3))
+    rot_body_ned = RotLib.from_euler('ZYX', rng.normal(0, [30, 3, 3], (n, 3)), degrees=True)
+    rot_ned_ecef = RotLib.from_euler('ZYX', rng.normal(0, [5, 5, 5], (n, 3)), degrees=True)*RotLib.from_euler('Y', 90, degrees=True)
+
+    direction_body = np.array([0, 0, 1.0]) + np.c_[rng.normal(0, 0.3, n), rng.normal(0, 0.01, n), np.zeros(n)]
+    points = pos + (rot_ned_ecef*rot_body_ned).apply(direction_body*100)
+
+    quat_body_ned = rot_body_ned.as_quat()
+    quat_ned_ecef = rot_ned_ecef.as_quat()
+
+    return pd.DataFrame({'pixel_nr': rng.uniform(0, 1000, n),
+                         'unix_time': np.sort(rng.uniform(0, 100, n)),
+                         'position_x': pos[:, 0],
+                         'position_y': pos[:, 1],
+                         'position_z': pos[:, 2],
+                         'quat_body_to_ned_x': quat_body_ned[:, 0],
+                         'quat_body_to_ned_y': quat_body_ned[:, 1],
+                         'quat_body_to_ned_z': quat_body_ned[:, 2],
+                         'quat_body_to_ned_w': quat_body_ned[:, 3],
+                         'quat_ned_to_ecef_x': quat_ned_ecef[:, 0],
+                         'quat_ned_to_ecef_y': quat_ned_ecef[:, 1],
+                         'quat_ned_to_ecef_z': quat_ned_ecef[:, 2],
+                         'quat_ned_to_ecef_w': quat_ned_ecef[:, 3],
+                         'reference_points_x': points[:, 0],
+                         'reference_points_y': points[:, 1],
+                         'reference_points_z': points[:, 2]})
+
+def objective_kwargs(features, method, pos_err_ref_frame, is_variab_param_intr, is_variab_param_extr):
+    return {'features_df': features,
+            'param0': PARAM0,
+            'is_variab_param_intr': is_variab_param_intr,
+            'is_variab_param_extr': is_variab_param_extr,
+            'time_nodes': TIME_NODES,
+            'time_interpolation_method': method,
+            'pos_err_ref_frame': pos_err_ref_frame,
+            'sigma_obs': np.array([1, 1.0]),
+            'sigma_param': np.array([2, 2, 5, 0.1, 0.1, 1]),
+            'time_scanlines': TIME_SCANLINES}
+
+@pytest.mark.parametrize('method', ['linear', 'nearest', 'cubic', 'bspline'])
+@pytest.mark.parametrize('pos_err_ref_frame', ['ned', 'ecef'])
+def test_jacobian_matches_finite_differences(method, pos_err_ref_frame):
+    rng = np.random.default_rng(2)
+
+    is_variab_param_intr = np.ones(11, dtype=np.int64)
+    is_variab_param_extr = np.ones(6, dtype=np.int64)
+    kwargs = objective_kwargs(FeaturePack(synthetic_features()), method, pos_err_ref_frame, is_variab_param_intr, is_variab_param_extr)
+
+    n_nodes = TIME_NODES.size
+    param = np.concatenate((PARAM0, rng.normal(0, [0.5]*3*n_nodes + [0.1]*3*n_nodes)))
+    steps = np.concatenate((STEPS_INTR, [STEP_POS]*3*n_nodes, [STEP_ROT]*3*n_nodes))
+
+    jacobian = jacobian_reprojection_error(param, **kwargs).toarray()
+
+    jacobian_numerical = np.zeros(jacobian.shape)
+    for i in range(param.size):
+        step = np.zeros(param.size)
+        step[i] = steps[i]
+        jacobian_numerical[:, i] = (objective_fun_reprojection_error(param + step, **kwargs) -
+                                    objective_fun_reprojection_error(param - step, **kwargs))/(2*steps[i])
+
+    # Relative to the largest derivative of each parameter
+    error = np.abs(jacobian - jacobian_numerical).max(axis=0)/np.maximum(np.abs(jacobian_numerical).max(axis=0), 1e-12)
+    assert error.max() < 1e-4
+
+@pytest.mark.parametrize('method', ['linear', 'slinear', 'nearest', 'quadratic', 'cubic', 'bspline'])
+def test_interpolation_weights_match_interpolation(method):
+    rng = np.random.default_rng(3)
+
+    # Including times outside the nodes
+    time_to = np.concatenate(([-5], TIME_SCANLINES, [120]))
+    values = rng.normal(size=(6, TIME_NODES.size))
+
+    weights = interpolation_weights(TIME_NODES, time_to, method)
+
+    np.testing.assert_allclose((weights @ values.T).T, interpolate_time_nodes(TIME_NODES, values, time_to, method), atol=1e-12)
+
+@pytest.mark.parametrize('method', ['linear', 'nearest', 'cubic', 'bspline'])
+@pytest.mark.parametrize('is_variab_param_extr', [np.ones(6, dtype=np.int64), np.array([0, 0, 1, 0, 0, 1]), np.zeros(6, dtype=np.int64)])
+def test_sparsity_pattern_covers_jacobian(method, is_variab_param_extr):
+    rng = np.random.default_rng(4)
+
+    features = FeaturePack(synthetic_features())
+    is_variab_param_intr = np.r_[1, 1, 1, 0, 0, 0, 0, 0, 1, 1, 1]
+    kwargs = objective_kwargs(features, method, 'ned', is_variab_param_intr, is_variab_param_extr)
+
+    param = np.concatenate((PARAM0[is_variab_param_intr == 1], rng.normal(0, 0.1, TIME_NODES.size*is_variab_param_extr.sum())))
+
+    jacobian = jacobian_reprojection_error(param, **kwargs).toarray()
+    pattern = jacobian_sparsity_pattern(features, is_variab_param_intr, is_variab_param_extr, TIME_NODES, method, TIME_SCANLINES).toarray()
+
+    assert pattern.shape == jacobian.shape
+    assert not np.any((jacobian != 0) & (pattern == 0))
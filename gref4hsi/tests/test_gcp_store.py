@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+
+from gref4hsi.utils.gcp_store import GCP_COLUMNS, GCPStoreWriter, list_gcp_store, read_gcp_store
+
+
+def synthetic_gcps(file_count, n, rng):
+    """The GCPs of one chunk with the columns written by compare mode, 100 s per chunk"""
+    gcp_dict = {'file_count': np.ones(n)*file_count,
+                'h5_filename': np.repeat(f'/mission/processed/h5/chunk_{file_count}.h5', n)}
+    for column in GCP_COLUMNS:
+        gcp_dict[column] = rng.normal(size=n)*1e6
+    gcp_dict['unix_time'] = 1e9 + 100*file_count + np.sort(rng.uniform(0, 100, n))
+
+    return pd.DataFrame(gcp_dict)
+
+def write_store(path):
+    rng = np.random.default_rng(0)
+    gcp_df_list = [synthetic_gcps(file_count, n, rng) for file_count, n in enumerate([50, 0, 80, 30])]
+
+    with GCPStoreWriter(path) as gcp_store:
+        for gcp_df in gcp_df_list:
+            gcp_store.append(gcp_df)
+
+    return pd.concat(gcp_df_list, ignore_index=True)
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / 'gcp.h5')
+    gcp_df_all = write_store(path)
+
+    gcp_df_read = read_gcp_store(path)
+
+    assert list(gcp_df_read.columns) == list(gcp_df_all.columns)
+    assert gcp_df_read.shape == gcp_df_all.shape
+    np.testing.assert_array_equal(gcp_df_read['file_count'], gcp_df_all['file_count'])
+    np.testing.assert_array_equal(gcp_df_read['h5_filename'], gcp_df_all['h5_filename'])
+    for column in GCP_COLUMNS:
+        # Full precision, unlike the csv
+        np.testing.assert_array_equal(gcp_df_read[column], gcp_df_all[column])
+
+    # Empty chunks are not stored
+    chunks = list_gcp_store(path)
+    assert list(chunks['file_count']) == [0, 2, 3]
+    assert list(chunks['chunk_name']) == ['chunk_0', 'chunk_2', 'chunk_3']
+    assert list(chunks['n']) == [50, 80, 30]
+
+def test_predicates(tmp_path):
+    path = str(tmp_path / 'gcp.h5')
+    gcp_df_all = write_store(path)
+
+    gcp_df = read_gcp_store(path, file_counts=[2, 3])
+    assert gcp_df.shape[0] == 110 and set(gcp_df['file_count']) == {2, 3}
+
+    gcp_df = read_gcp_store(path, chunk_names=['chunk_3'])
+    assert gcp_df.shape[0] == 30 and set(gcp_df['file_count']) == {3}
+
+    time_range = (1e9 + 250, 1e9 + 320)
+    gcp_df = read_gcp_store(path, time_range=time_range, columns=['unix_time', 'diff_u'])
+    is_in_range = (gcp_df_all['unix_time'] >= time_range[0]) & (gcp_df_all['unix_time'] <= time_range[1])
+    assert list(gcp_df.columns) == ['file_count', 'h5_filename', 'unix_time', 'diff_u']
+    np.testing.assert_array_equal(gcp_df['unix_time'], gcp_df_all['unix_time'][is_in_range])
+    np.testing.assert_array_equal(gcp_df['diff_u'], gcp_df_all['diff_u'][is_in_range])
+
+    # Predicates are combined
+    gcp_df = read_gcp_store(path, file_counts=[0, 2], chunk_names=['chunk_2'], time_range=time_range)
+    assert set(gcp_df['file_count']) == {2}
+
+def test_empty_result(tmp_path):
+    path = str(tmp_path / 'gcp.h5')
+    write_store(path)
+
+    for gcp_df in [read_gcp_store(path, file_counts=[7]), read_gcp_store(path, chunk_names=[]), read_gcp_store(path, time_range=(0, 1))]:
+        assert gcp_df.shape == (0, 2 + len(GCP_COLUMNS))
+
+def test_failed_write_keeps_store(tmp_path):
+    path = str(tmp_path / 'gcp.h5')
+    write_store(path)
+
+    try:
+        with GCPStoreWriter(path) as gcp_store:
+            gcp_store.append(synthetic_gcps(5, 10, np.random.default_rng(1)))
+            raise RuntimeError
+    except RuntimeError:
+        pass
+
+    assert read_gcp_store(path).shape[0] == 160
+    assert not (tmp_path / 'gcp.h5.tmp').exists()
@@ -0,0 +1,139 @@
+import ast
+import re
+
+import numpy as np
+
+
+# Bands are referenced by wavelength as R<wavelength>, e.g. R800 or R531_5 for 531.5 (in the wavelength unit of the data), and resolve to the nearest band
+_BAND_PATTERN = re.compile(r'^R(\d+)(?:_(\d+))?$')
+
+# The functions that may be called in expressions, with their minimal and maximal number of arguments (None for any number).
+# NumPy takes further positional arguments as e.g. out=, so the number of arguments must be checked
+_FUNCTIONS = {'abs': (np.abs, 1, 1),
+              'sqrt': (np.sqrt, 1, 1),
+              'log': (np.log, 1, 1),
+              'log10': (np.log10, 1, 1),
+              'exp': (np.exp, 1, 1),
+              'minimum': (np.minimum, 2, 2),
+              'maximum': (np.maximum, 2, 2),
+              'mean': (lambda *bands: np.mean(np.stack(np.broadcast_arrays(*bands), axis=0), axis=0), 1, None)}
+
+_BINARY_OPERATORS = {ast.Add: np.add,
+                     ast.Sub: np.subtract,
+                     ast.Mult: np.multiply,
+                     ast.Div: np.divide,
+                     ast.Pow: np.power}
+
+_UNARY_OPERATORS = {ast.USub: np.negative,
+                    ast.UAdd: np.positive}
+
+
+class BandMathExpression():
+    """A band math product, e.g. NDVI as "(R800 - R670)/(R800 + R670)". The expression is parsed once into a syntax tree, which may only hold
+    numbers, band references, arithmetic operators and the functions in _FUNCTIONS, so that no arbitrary code is evaluated."""
+    def __init__(self, name, expression, wavelengths):
+        """
+        :param name: Name of the product, e.g. 'ndvi'
+        :type name: string
+        :param expression: The expression
+        :type expression: string
+        :param wavelengths: The band's centre wavelengths
+        :type wavelengths: ndarray(k,)
+        """
+        self.name = name
+        self.expression = expression
+
+        wavelengths = np.array(wavelengths, dtype=np.float64).reshape(-1)
+
+        try:
+            self.tree = ast.parse(expression.strip(), mode='eval').body
+        except SyntaxError as e:
+            raise ValueError(f'The band math expression {name} = {expression} is not valid: {e.msg}')
+
+        # The band index of each band reference
+        self.bands = {}
+        self._validate(self.tree, wavelengths)
+
+    def _validate(self, node, wavelengths):
+        if isinstance(node, ast.BinOp):
+            if type(node.op) not in _BINARY_OPERATORS:
+                raise ValueError(f'The operator {type(node.op).__name__} is not allowed in band math ({self.name})')
+            self._validate(node.left, wavelengths)
+            self._validate(node.right, wavelengths)
+        elif isinstance(node, ast.UnaryOp):
+            if type(node.op) not in _UNARY_OPERATORS:
+                raise ValueError(f'The operator {type(node.op).__name__} is not allowed in band math ({self.name})')
+            self._validate(node.operand, wavelengths)
+        elif isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or node.func.id not in _FUNCTIONS or len(node.keywords) > 0:
+                raise ValueError(f'Only the functions {", ".join(_FUNCTIONS)} can be called in band math ({self.name})')
+            _, min_args, max_args = _FUNCTIONS[node.func.id]
+            if len(node.args) < min_args or (max_args is not None and len(node.args) > max_args) or any(isinstance(arg, ast.Starred) for arg in node.args):
+                n_args = str(min_args) if min_args == max_args else f'at least {min_args}'
+                raise ValueError(f'The function {node.func.id} takes {n_args} argument(s), not {len(node.args)}, in band math ({self.name})')
+            for arg in node.args:
+                self._validate(arg, wavelengths)
+        elif isinstance(node, ast.Constant):
+            if not isinstance(node.value, (int, float)) or isinstance(node.value, bool):
+                raise ValueError(f'Only numbers are allowed as constants in band math ({self.name})')
+        elif isinstance(node, ast.Name):
+            match = _BAND_PATTERN.match(node.id)
+            if match is None:
+                raise ValueError(f'Unknown name {node.id} in band math ({self.name}). Bands are referenced like R800 or R531_5 (531.5)')
+
+            wavelength = float(match.group(1) + '.' + (match.group(2) or '0'))
+
+            # References outside the spectral range by more than a band width are most likely errors
+            band_width = np.max(np.diff(np.sort(wavelengths))) if wavelengths.size > 1 else np.inf
+            if wavelength < wavelengths.min() - band_width or wavelength > wavelengths.max() + band_width:
+                raise ValueError(f'The wavelength {wavelength} of band math ({self.name}) is outside the range {wavelengths.min()}-{wavelengths.max()} of the data')
+
+            self.bands[node.id] = int(np.argmin(np.abs(wavelengths - wavelength)))
+        else:
+            raise ValueError(f'The expression {self.expression} holds the element {type(node).__name__}, which is not allowed in band math ({self.name})')
+
+    def evaluate(self, rows, nodata = np.nan):
+        """Evaluates the expression for each row of a (collapsed) datacube
+
+        :param rows: Spectra, e.g. the gathered rows of one block of the ortho grid
+        :type rows: ndarray(n, k)
+        :param nodata: The value where the product is undefined (e.g. division by zero), defaults to np.nan
+        :type nodata: float, optional
+        :return: The product
+        :rtype: ndarray(n,)
+        """
+        # Only the referenced bands are converted
+        bands = {band_name: rows[:, band].astype(np.float64) for band_name, band in self.bands.items()}
+
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            values = np.broadcast_to(self._evaluate(self.tree, bands), (rows.shape[0],)).astype(np.float64)
+
+        values[~np.isfinite(values)] = nodata
+
+        return values
+
+    def _evaluate(self, node, bands):
+        if isinstance(node, ast.BinOp):
+            return _BINARY_OPERATORS[type(node.op)](self._evaluate(node.left, bands), self._evaluate(node.right, bands))
+        elif isinstance(node, ast.UnaryOp):
+            return _UNARY_OPERATORS[type(node.op)](self._evaluate(node.operand, bands))
+        elif isinstance(node, ast.Call):
+            return _FUNCTIONS[node.func.id][0](*[self._evaluate(arg, bands) for arg in node.args])
+        elif isinstance(node, ast.Constant):
+            return float(node.value)
+        else:
+            return bands[node.id]
+
+def read_band_math(config):
+    """Reads the band math products from the [Band math] section, as entries like "ndvi = (R800 - R670)/(R800 + R670)"
+
+    :param config: The mission configuration
+    :type config: configparser.ConfigParser
+    :return: The expression of each product name (empty if there is no such section)
+    :rtype: dict
+    """
+    if not config.has_section('Band math'):
+        return {}
+
+    # Allows inline comments as in the configuration template
+    return {name: expression.split('#')[0].strip() for name, expression in config['Band math'].items()}
@@ -0,0 +1,136 @@
+from contextlib import closing
+import os
+import sqlite3
+
+import geopandas as gpd
+from shapely.geometry import box, LineString, Point
+
+from gref4hsi.utils.transform_utils import transform_points
+
+
+# The index is one layer in a GeoPackage, which maintains an R-tree over the footprints
+INDEX_NAME = 'footprint_index.gpkg'
+INDEX_LAYER = 'footprints'
+
+
+def footprint_index_path(config):
+    """The mission footprint index lives next to the footprint shape files
+
+    :param config: The mission configuration
+    :type config: configparser.ConfigParser
+    :return: Path to the GeoPackage
+    :rtype: string
+    """
+    return os.path.join(config['Absolute Paths']['footprint_folder'], INDEX_NAME)
+
+def update_footprint_index(index_path, chunk_name, footprint, crs, h5_filename, t_start, t_end):
+    """Adds or replaces the footprint of one chunk in the mission index
+
+    :param index_path: Path to the GeoPackage
+    :type index_path: string
+    :param chunk_name: Name of the chunk (h5 file name without extension)
+    :type chunk_name: string
+    :param footprint: The ground footprint in the projected CRS
+    :type footprint: shapely geometry
+    :param crs: The projected CRS, e.g. 'EPSG:25832'
+    :type crs: string
+    :param h5_filename: Path to the h5 file of the chunk
+    :type h5_filename: string
+    :param t_start: Time of first scanline
+    :type t_start: float
+    :param t_end: Time of last scanline
+    :type t_end: float
+    """
+    row = gpd.GeoDataFrame({'chunk': [chunk_name],
+                            'h5_filename': [h5_filename],
+                            't_start': [float(t_start)],
+                            't_end': [float(t_end)]},
+                            geometry=[footprint], crs=crs)
+
+    if os.path.exists(index_path):
+        # An earlier footprint of the chunk is deleted in place (the R-tree is maintained by the triggers of the GeoPackage), 
+        # and the new one is appended, so that the index is not rewritten for every chunk
+        with closing(sqlite3.connect(index_path)) as connection, connection:
+            connection.execute(f'DELETE FROM "{INDEX_LAYER}" WHERE chunk = ?', (chunk_name,))
+
+        crs_index = gpd.read_file(index_path, layer=INDEX_LAYER, rows=1).crs
+        row.to_crs(crs_index).to_file(index_path, layer=INDEX_LAYER, driver='GPKG', mode='a')
+    else:
+        row.to_file(index_path, layer=INDEX_LAYER, driver='GPKG')
+
+def read_aoi(config, crs):
+    """Reads the area of interest from [General] aoi. It is either the path to a vector file (e.g. *.shp, *.gpkg, *.geojson)
+    or a bounding box "min_x, min_y, max_x, max_y" in the projected CRS.
+
+    :param config: The mission configuration
+    :type config: configparser.ConfigParser
+    :param crs: The projected CRS, e.g. 'EPSG:25832'
+    :type crs: string
+    :return: The area of interest in the projected CRS, or None if all chunks are to be processed
+    :rtype: shapely geometry
+    """
+    try:
+        # Allows inline comments as in the configuration template
+        aoi = config['General']['aoi'].split('#')[0].strip()
+    except KeyError:
+        return None
+
+    if aoi in ['', 'None']:
+        return None
+
+    if os.path.exists(aoi):
+        gdf = gpd.read_file(aoi).to_crs(crs)
+        return gdf.union_all()
+    else:
+        try:
+            min_x, min_y, max_x, max_y = [float(val) for val in aoi.split(',')]
+        except ValueError:
+            raise ValueError(f'The aoi {aoi} is neither an existing file nor a bounding box "min_x, min_y, max_x, max_y"')
+        return box(min_x, min_y, max_x, max_y)
+
+def chunks_in_aoi(index_path, aoi):
+    """Queries the index for chunks whose footprint intersects the area of interest.
+    The bounding box query uses the R-tree of the GeoPackage, so only candidate footprints are read.
+
+    :param index_path: Path to the GeoPackage
+    :type index_path: string
+    :param aoi: The area of interest in the CRS of the index
+    :type aoi: shapely geometry
+    :return: Names of intersecting chunks and names of all indexed chunks
+    :rtype: set, set
+    """
+    if not os.path.exists(index_path):
+        return set(), set()
+
+    # Only the attributes are needed to know which chunks are indexed
+    gdf_all = gpd.read_file(index_path, layer=INDEX_LAYER, ignore_geometry=True)
+
+    gdf = gpd.read_file(index_path, layer=INDEX_LAYER, bbox=aoi.bounds)
+    gdf = gdf[gdf.intersects(aoi)]
+
+    return set(gdf['chunk']), set(gdf_all['chunk'])
+
+def is_chunk_in_aoi(chunk_name, aoi_chunks, indexed_chunks):
+    """Chunks are processed if they intersect the area of interest, or if they are not yet indexed (footprint unknown)"""
+    return (chunk_name in aoi_chunks) or (chunk_name not in indexed_chunks)
+
+def pose_track_footprint(position_ecef, epsg_geocsc, epsg_proj, buffer_distance):
+    """A conservative footprint before georeferencing: the track of the vehicle buffered by the maximal ray length
+
+    :param position_ecef: Positions of the vehicle/imager
+    :type position_ecef: ndarray(n, 3)
+    :param epsg_geocsc: The epsg code of the geocentric coordinate system (ECEF)
+    :type epsg_geocsc: int
+    :param epsg_proj: The epsg code of the projected coordinate system
+    :type epsg_proj: int
+    :param buffer_distance: The buffer, e.g. max_ray_length
+    :type buffer_distance: float
+    :return: The footprint in the projected CRS
+    :rtype: shapely geometry
+    """
+    track = transform_points(position_ecef, epsg_geocsc, epsg_proj)[:, 0:2]
+
+    if track.shape[0] == 1:
+        return Point(track[0]).buffer(buffer_distance)
+
+    return LineString(track).buffer(buffer_distance)
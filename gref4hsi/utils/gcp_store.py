@@ -0,0 +1,168 @@
+import os
+
+import h5py
+import numpy as np
+import pandas as pd
+
+
+# The GCPs of a mission are stored in one h5 file with one group per chunk (composite), named by its file count. Each column is a typed dataset,
+# while the file count and the h5 file of the chunk are attributes of the group, so that chunks can be selected without reading their features
+GCP_COLUMNS = {'pixel_nr': np.float64,
+               'unix_time': np.float64,
+               'position_x': np.float64,
+               'position_y': np.float64,
+               'position_z': np.float64,
+               'quat_body_to_ned_x': np.float64,
+               'quat_body_to_ned_y': np.float64,
+               'quat_body_to_ned_z': np.float64,
+               'quat_body_to_ned_w': np.float64,
+               'quat_ned_to_ecef_x': np.float64,
+               'quat_ned_to_ecef_y': np.float64,
+               'quat_ned_to_ecef_z': np.float64,
+               'quat_ned_to_ecef_w': np.float64,
+               'reference_points_x': np.float64,
+               'reference_points_y': np.float64,
+               'reference_points_z': np.float64,
+               'diff_absolute_error': np.float64,
+               'diff_u': np.float64,
+               'diff_v': np.float64}
+
+
+def gcp_store_path(ref_gcp_path, is_calibrated):
+    """The store lives next to the GCP table (csv), with the same suffix for calibrated data
+
+    :param ref_gcp_path: Path to the GCP table, e.g. gcp.csv
+    :type ref_gcp_path: string
+    :param is_calibrated: Whether the GCPs are from the calibrated (coregistered) data
+    :type is_calibrated: bool
+    :return: Path to the h5 file
+    :rtype: string
+    """
+    return os.path.splitext(ref_gcp_path)[0] + ('_coreg' if is_calibrated else '') + '.h5'
+
+def _chunk_name(h5_filename):
+    """The name of a chunk as used for the area of interest"""
+    return os.path.basename(h5_filename).split('.')[0]
+
+
+class GCPStoreWriter():
+    """Appends the GCPs of one chunk at a time to a new store. The chunks are written to a temporary file which replaces the store when closed,
+    so that a failed comparison does not leave a partial store behind. Used as a context manager"""
+    def __init__(self, path):
+        """
+        :param path: Path to the h5 file
+        :type path: string
+        """
+        self.path = path
+        self.tmp_path = path + '.tmp'
+        self.file = h5py.File(self.tmp_path, 'w')
+
+    def append(self, gcp_df):
+        """Appends the GCPs of a chunk
+
+        :param gcp_df: The GCPs of a chunk, as returned by _compare_chunk
+        :type gcp_df: pandas.DataFrame
+        """
+        if gcp_df.shape[0] == 0:
+            return
+
+        file_count = int(gcp_df['file_count'].iloc[0])
+        group = self.file.create_group(f'{file_count:06d}')
+
+        group.attrs['file_count'] = file_count
+        group.attrs['h5_filename'] = str(gcp_df['h5_filename'].iloc[0])
+        group.attrs['n'] = gcp_df.shape[0]
+        group.attrs['time_min'] = gcp_df['unix_time'].min()
+        group.attrs['time_max'] = gcp_df['unix_time'].max()
+
+        for column, dtype in GCP_COLUMNS.items():
+            group.create_dataset(column, data=gcp_df[column].to_numpy(dtype=dtype))
+
+    def close(self):
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+            os.remove(self.tmp_path)
+
+
+def list_gcp_store(path):
+    """Lists the chunks of a store without reading their GCPs
+
+    :param path: Path to the h5 file
+    :type path: string
+    :return: One row per chunk with file_count, h5_filename, chunk_name, n, time_min and time_max
+    :rtype: pandas.DataFrame
+    """
+    with h5py.File(path, 'r') as f:
+        chunks = [{'file_count': int(group.attrs['file_count']),
+                   'h5_filename': str(group.attrs['h5_filename']),
+                   'chunk_name': _chunk_name(str(group.attrs['h5_filename'])),
+                   'n': int(group.attrs['n']),
+                   'time_min': float(group.attrs['time_min']),
+                   'time_max': float(group.attrs['time_max'])} for group in f.values()]
+
+    return pd.DataFrame(chunks, columns=['file_count', 'h5_filename', 'chunk_name', 'n', 'time_min', 'time_max'])
+
+def read_gcp_store(path, file_counts = None, chunk_names = None, time_range = None, columns = None):
+    """Reads the GCPs of a store as one table, with the same columns as the csv written in compare mode.
+    Chunks that do not satisfy the predicates are skipped without reading their GCPs
+
+    :param path: Path to the h5 file
+    :type path: string
+    :param file_counts: The file counts (transects) to read, defaults to None (all)
+    :type file_counts: iterable of int, optional
+    :param chunk_names: The chunks to read, by the name of their h5 file without extension, defaults to None (all)
+    :type chunk_names: iterable of string, optional
+    :param time_range: The (start, stop) unix time of the GCPs to read, defaults to None (all)
+    :type time_range: tuple, optional
+    :param columns: The columns of GCP_COLUMNS to read, defaults to None (all)
+    :type columns: list of string, optional
+    :return: The GCPs
+    :rtype: pandas.DataFrame
+    """
+    columns = list(GCP_COLUMNS) if columns is None else list(columns)
+    file_counts = None if file_counts is None else set(file_counts)
+    chunk_names = None if chunk_names is None else set(chunk_names)
+
+    file_count_list = []
+    h5_filename_list = []
+    column_lists = {column: [] for column in columns}
+
+    with h5py.File(path, 'r') as f:
+        for group in f.values():
+            file_count = int(group.attrs['file_count'])
+            h5_filename = str(group.attrs['h5_filename'])
+
+            if file_counts is not None and file_count not in file_counts:
+                continue
+            if chunk_names is not None and _chunk_name(h5_filename) not in chunk_names:
+                continue
+            if time_range is not None and (group.attrs['time_max'] < time_range[0] or group.attrs['time_min'] > time_range[1]):
+                continue
+
+            if time_range is not None:
+                unix_time = group['unix_time'][()]
+                mask = (unix_time >= time_range[0]) & (unix_time <= time_range[1])
+            else:
+                mask = np.ones(int(group.attrs['n']), dtype=bool)
+
+            n = int(mask.sum())
+            file_count_list.append(np.full(n, file_count, dtype=np.int64))
+            h5_filename_list.append(np.repeat(h5_filename, n).astype(object))
+            for column in columns:
+                column_lists[column].append(group[column][()][mask])
+
+    gcp_dict = {'file_count': np.concatenate(file_count_list) if file_count_list else np.zeros(0, dtype=np.int64),
+                'h5_filename': np.concatenate(h5_filename_list) if h5_filename_list else np.zeros(0, dtype=object)}
+    for column in columns:
+        gcp_dict[column] = np.concatenate(column_lists[column]) if column_lists[column] else np.zeros(0, dtype=GCP_COLUMNS[column])
+
+    return pd.DataFrame(gcp_dict)
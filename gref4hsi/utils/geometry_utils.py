@@ -4,13 +4,12 @@ import numpy as np
 import numpy.matlib
 from osgeo import gdal, osr
 import psutil
-import pyproj
 import rasterio
 from scipy.spatial.transform import Rotation as RotLib
 from scipy.spatial.transform import Slerp
 import open3d as o3d
 import xmltodict
-from pyproj import CRS, Transformer
+from pyproj import CRS
 import pymap3d as pm
 import ephem
 import pandas as pd
@@ -31,6 +30,7 @@ import json
 
 # Internals:
 from gref4hsi.utils.gis_tools import GeoSpatialAbstractionHSI as geohsi
+from gref4hsi.utils.transform_utils import get_transformer, transform_points
 
 # A file were we define geometry and geometric transforms
 class CalibHSI:
@@ -544,11 +544,7 @@ class CameraGeometry():
         
         with rasterio.open(geoid_path) as src:
 
-            source_crs = CRS.from_epsg(source_epsg)
-                
-            target_crs = src.crs
-
-            transformer = Transformer.from_crs(source_crs, target_crs)
+            transformer = get_transformer(source_epsg, src.crs)
 
             (lat, lon, alt_ell) = transformer.transform(xx=x_ecef, yy=y_ecef, zz=z_ecef)
 
@@ -859,17 +855,11 @@ def reproject_world_points_to_hsi_plane(trans_hsi_body, rot_hsi_body, pos_body,
     # Given the positions, the hsi-point vector can be expressed in ECEF
     hsi_to_feature_global = points_world - position_hsi
 
-    # Number of features to iterate
-    n = hsi_to_feature_global.shape[0]
-
-    # We can now express the hsi-point vector in the HSI frame and normalize by the z component to find the image plane projection
-    hsi_to_feature_local = np.zeros(hsi_to_feature_global.shape)
-    for i in range(n):
-        # The vector expressed in HSI frame
-        hsi_to_feature_local[i, :] = (rotation_hsi[i].inv()).apply(hsi_to_feature_global[i, :])
+    # We can now express the hsi-point vector in the HSI frame (all features at once)
+    hsi_to_feature_local = rotation_hsi.apply(hsi_to_feature_global, inverse=True)
 
-        # The vector normalized to lie on the virtual plane
-        hsi_to_feature_local[i, :] /= hsi_to_feature_local[i, 2]
+    # The vector normalized by the z component to lie on the virtual plane
+    hsi_to_feature_local /= hsi_to_feature_local[:, 2:3]
     
     return hsi_to_feature_local
 
@@ -1037,20 +1027,12 @@ class GeoPose:
             EPSG code of the transformed geodetic coordinate system
         """
         # If geocentric position has not been defined.
-        from_CRS = CRS.from_epsg(self.epsg)
-        geod_CRS = CRS.from_epsg(epsg_geod)
-        transformer = Transformer.from_crs(from_CRS, geod_CRS)
-
-        x = self.position[:, 0].reshape((-1, 1))
-        y = self.position[:, 1].reshape((-1, 1))
-        z = self.position[:, 2].reshape((-1, 1))
-
-        (lat, lon, hei) = transformer.transform(xx=x, yy=y, zz=z)
+        lat_lon_hei = transform_points(self.position, self.epsg, epsg_geod)
 
         self.epsg_geod = epsg_geod
-        self.lat = lat.reshape((self.position.shape[0], 1))
-        self.lon = lon.reshape((self.position.shape[0], 1))
-        self.hei = hei.reshape((self.position.shape[0], 1))
+        self.lat = lat_lon_hei[:, 0].reshape((self.position.shape[0], 1))
+        self.lon = lat_lon_hei[:, 1].reshape((self.position.shape[0], 1))
+        self.hei = lat_lon_hei[:, 2].reshape((self.position.shape[0], 1))
 
     def compute_geocentric_position(self, epsg_geocsc):
         """
@@ -1059,17 +1041,7 @@ class GeoPose:
             EPSG code of the transformed geodetic coordinate system
         """
 
-        from_CRS = CRS.from_epsg(self.epsg)
-        geod_CRS = CRS.from_epsg(epsg_geocsc)
-        transformer = Transformer.from_crs(from_CRS, geod_CRS)
-
-        x = self.position[:, 0].reshape((-1, 1))
-        y = self.position[:, 1].reshape((-1, 1))
-        z = self.position[:, 2].reshape((-1, 1))
-
-        (x, y, z) = transformer.transform(xx=x, yy=y, zz=z)
-
-        self.pos_geocsc = np.concatenate((x, y, z), axis = 1)
+        self.pos_geocsc = transform_points(self.position, self.epsg, epsg_geocsc)
 
     def compute_geocentric_orientation(self):
         if self.rot_obj_ecef == None:
@@ -1368,7 +1340,7 @@ def dem_2_mesh(path_dem, model_path, config, dem_ref_is_geoid = False, path_geoi
 
     
 
-    transformer = Transformer.from_crs(proj, geocsc)
+    transformer = get_transformer(proj, geocsc)
 
     # Convert to proper coordinates
     points_proj = mesh.points + points_offset
@@ -1446,7 +1418,7 @@ def crop_geoid_to_pose(path_dem, config, geoid_path = 'data/world/geoids/egm08_2
     # Transform points to DEM CRS
     geocsc = CRS.from_epsg(epsg_geocsc)
     proj = ds.GetProjection()
-    transformer = Transformer.from_crs(geocsc, proj)
+    transformer = get_transformer(geocsc, proj)
 
     x_ecef = df_pose[' X'].values.reshape((-1, 1))
     y_ecef = df_pose[' Y'].values.reshape((-1, 1))
@@ -1541,20 +1513,7 @@ def position_transform_ecef_2_llh(position_ecef, epsg_from, epsg_to, config):
     :return lat_lon_hei: numpy array floats (n,3)
     latitude, longitude ellipsoid height.
     """
-    geocsc = CRS.from_epsg(epsg_from)
-    geod = CRS.from_epsg(epsg_to)
-    transformer = Transformer.from_crs(geocsc, geod)
-
-    x_ecef = position_ecef[:, 0].reshape((-1, 1))
-    y_ecef = position_ecef[:, 1].reshape((-1, 1))
-    z_ecef = position_ecef[:, 2].reshape((-1, 1))
-
-    (lat, lon, hei) = transformer.transform(xx=x_ecef, yy=y_ecef, zz=z_ecef)
-
-    lat_lon_hei = np.zeros(position_ecef.shape)
-    lat_lon_hei[:, 0] = lat.reshape((position_ecef.shape[0], 1))
-    lat_lon_hei[:, 1] = lon.reshape((position_ecef.shape[0], 1))
-    lat_lon_hei[:, 2] = hei.reshape((position_ecef.shape[0], 1))
+    lat_lon_hei = transform_points(position_ecef, epsg_from, epsg_to)
 
     return lat_lon_hei
 
@@ -1670,11 +1629,11 @@ def _extract_ecef_corners(raster_path, ecef_epsg = "EPSG:4979"):
 
         if corners_only:
             # Convert to ECEF coordinates using pyproj
-            ecef_corners = []
-            transformer = pyproj.Transformer.from_crs(crs, ecef_epsg, always_xy=True)
-            for xy, elevation in zip(corners, elevations):
-                x, y, z = transformer.transform(xy[0], xy[1], elevation)
-                ecef_corners.append((x, y, z))
+            transformer = get_transformer(crs, ecef_epsg, always_xy=True)
+            x, y, z = transformer.transform(np.array([xy[0] for xy in corners]),
+                                            np.array([xy[1] for xy in corners]),
+                                            np.array(elevations, dtype=np.float64))
+            ecef_corners = list(zip(x, y, z))
 
         else:
             edge_point_spacing = 50 # m
@@ -1694,7 +1653,7 @@ def _extract_ecef_corners(raster_path, ecef_epsg = "EPSG:4979"):
 
 
             ecef_corners = []
-            transformer = pyproj.Transformer.from_crs(crs, ecef_epsg, always_xy=True)
+            transformer = get_transformer(crs, ecef_epsg, always_xy=True)
             for i in range(4):
 
                 if i == 0: # left-right top
@@ -1715,9 +1674,9 @@ def _extract_ecef_corners(raster_path, ecef_epsg = "EPSG:4979"):
                     y = y_new#top-bottom
                     z = interp1d(np.array([top, bottom]), np.array([z_urc, z_lrc]))(y)
                 
-                for j in range(z.size):
-                    xp, yp, zp = transformer.transform(x[j], y[j], z[j])
-                    ecef_corners.append((xp, yp, zp))
+                # One call per edge rather than per point
+                xp, yp, zp = transformer.transform(x, y, z)
+                ecef_corners.extend(zip(xp, yp, zp))
 
 
 
@@ -1,6 +1,7 @@
 # Python standard lib
+from collections import namedtuple
+import hashlib
 import os
-from concurrent.futures import ThreadPoolExecutor
 import sys
 
 # Third party
@@ -8,12 +9,13 @@ import cv2 as cv
 import geopandas as gpd
 import matplotlib.pyplot as plt
 import numpy as np
-from pyproj import CRS, Transformer
 import pyproj
 import rasterio
 from rasterio.features import geometry_mask
+import rasterio.shutil
 from rasterio.warp import calculate_default_transform, reproject, Resampling
-from osgeo import gdal, osr
+from rasterio.windows import Window
+from osgeo import gdal
 from shapely.geometry import Polygon, mapping, MultiPoint
 from sklearn.neighbors import NearestNeighbors
 from spectral import envi
@@ -22,7 +24,10 @@ import h5py
 from scipy.spatial.transform import Rotation as RotLib
 
 # Lib modules
+from gref4hsi.utils.band_math import BandMathExpression
 from gref4hsi.utils.colours import Image as Imcol
+from gref4hsi.utils.spectral_binning import spectral_bins, wavelength_subset
+from gref4hsi.utils.transform_utils import transform_points, transform_points_approximate
 
 # ENVI datatype conversion dictionary
 dtype_dict = {1:np.uint8,
@@ -35,6 +40,31 @@ dtype_dict = {1:np.uint8,
              14:np.int64,
              15:np.uint64}
 
+# Encodings of ancillary layers written one file per layer (ancillary_encoding = per_layer), as numpy dtype and scale.
+# Integer types store round(value/scale) and reserve their minimum (signed) or maximum (unsigned) value for nodata.
+# Layers that are not listed are written as float32, and all can be overridden in the [Ancillary encoding] section.
+ANCILLARY_ENCODING_DEFAULTS = {'pixel_nr_grid': ('uint16', 1),
+                               'frame_nr_grid': ('uint32', 1), # Frame numbers may exceed the range of uint16 for long transects
+                               'sample_count': ('uint16', 1),
+                               'theta_v': ('int16', 0.01), # Degrees, so that 0.01 degree steps cover +-327 degrees
+                               'theta_s': ('int16', 0.01),
+                               'phi_v': ('int16', 0.02), # Azimuths range up to 360 degrees
+                               'phi_s': ('int16', 0.02),
+                               'unix_time_grid': ('float64', 1),
+                               'position_ecef': ('float64', 1), # ECEF coordinates need float64 for sub-meter precision
+                               'points_ecef_crs': ('float64', 1),
+                               'quaternion_ecef': ('float32', 1),
+                               'hsi_alts_msl': ('float32', 1),
+                               'hsi_tide_gridded': ('float32', 1)}
+
+ANCILLARY_ENCODING_FALLBACK = ('float32', 1)
+
+# The encoding of one ancillary file
+AncillaryEncoding = namedtuple('AncillaryEncoding', ['dtype', 'scale', 'nodata'])
+
+# The grid shared by the chunks of a transect, see GeoSpatialAbstractionHSI.define_transect_grid
+TransectGrid = namedtuple('TransectGrid', ['name', 'Taff', 'transform', 'height', 'width', 'suffix'])
+
 class GeoSpatialAbstractionHSI():
     def __init__(self, point_cloud, transect_string, config_crs):
         self.name = transect_string
@@ -42,10 +72,28 @@ class GeoSpatialAbstractionHSI():
 
         self.epsg_geocsc = config_crs.epsg_geocsc
         
+        # Known up front, since the projection itself is skipped when a lookup table is loaded
+        self.epsg_proj = config_crs.epsg_proj
+        self.crs = 'EPSG:' + str(self.epsg_proj)
+        
+        # Maximal residual (in meters) accepted for the approximate projection of the point cloud, where 0 means exact
+        self.approx_transform_tolerance = config_crs.approx_transform_tolerance
+        
         self.n_lines = point_cloud.shape[0]
         self.n_pixels = point_cloud.shape[1]
         self.n_bands = point_cloud.shape[1]
 
+        # The resampling lookup table and footprint are either computed or loaded from disk
+        self.indexes = None
+        self.hull_line = None
+
+        # Only used by the binning resampler (resamplingmethod mean or median)
+        self.bin_cells = None
+
+        # Only used when the chunk is resampled into the grid of its transect, where the lookup table covers a window of that grid
+        self.transect_grid = None
+        self.window_offset = None
+
         # A clean way of doing things would be to define 
     def transform_geocentric_to_projected(self, config_crs):
 
@@ -56,23 +104,21 @@ class GeoSpatialAbstractionHSI():
         
         
 
-        self.points_proj  = np.zeros(self.points_geocsc.shape) # Remains same if it is local
-        
-        geocsc = CRS.from_epsg(self.epsg_geocsc)
-        proj = CRS.from_epsg(self.epsg_proj)
-        transformer = Transformer.from_crs(geocsc, proj)
-
-        x_ecef = self.points_geocsc[:,:,0].reshape((-1, 1))
-        y_ecef = self.points_geocsc[:, :, 1].reshape((-1, 1))
-        z_ecef = self.points_geocsc[:, :, 2].reshape((-1, 1))
-
-        
-
-        (east, north, hei) = transformer.transform(xx=x_ecef, yy=y_ecef, zz=z_ecef)
-
-        self.points_proj[:,:,0] = east.reshape((self.points_proj.shape[0], self.points_proj.shape[1]))
-        self.points_proj[:, :, 1] = north.reshape((self.points_proj.shape[0], self.points_proj.shape[1]))
-        self.points_proj[:, :, 2] = hei.reshape((self.points_proj.shape[0], self.points_proj.shape[1]))
+        # The transformer is cached for the process, so repeated chunks do not rebuild the pipeline
+        if self.approx_transform_tolerance > 0:
+            # A chunk covers a small area where the projection is smooth, and a polynomial fitted to the exact transform is used if accurate enough
+            self.points_proj, approx, is_approximate = transform_points_approximate(self.points_geocsc, 
+                                                                                    self.epsg_geocsc, 
+                                                                                    self.epsg_proj, 
+                                                                                    tolerance=self.approx_transform_tolerance)
+            if is_approximate:
+                print(f'{self.name}: approximate projection max residual {approx.max_residual:.3g} m')
+            elif approx is None:
+                print(f'{self.name}: approximate projection could not be fitted, using exact transform')
+            else:
+                print(f'{self.name}: approximate projection max residual {approx.max_residual:.3g} m exceeds the tolerance of {self.approx_transform_tolerance} m, using exact transform')
+        else:
+            self.points_proj = transform_points(self.points_geocsc, self.epsg_geocsc, self.epsg_proj)
 
 
         
@@ -84,6 +130,18 @@ class GeoSpatialAbstractionHSI():
         :param footprint_dir: Where to put the shape files describing the footprint
         :type footprint_dir: string
         """
+        # The footprint is part of a loaded lookup table
+        if self.hull_line is None:
+            self.compute_footprint()
+
+        gdf = gpd.GeoDataFrame(geometry=[self.footprint_shp], crs=self.crs)
+
+        shape_path = footprint_dir + self.name + '.shp'
+
+        gdf.to_file(shape_path, driver='ESRI Shapefile')
+
+    def compute_footprint(self):
+        """Describes the footprint as a polygon from the edges of the georeferenced data points (in projected form)"""
         self.edge_start = self.points_proj[0, :, 0:2].reshape((-1,2))
         self.edge_end = self.points_proj[-1, :, 0:2].reshape((-1,2))
         self.side_1 = self.points_proj[:, 0, 0:2].reshape((-1,2))
@@ -102,11 +160,212 @@ class GeoSpatialAbstractionHSI():
         # The swiped ground area is defined by the convex hull
         self.footprint_shp = Polygon(self.hull_line)
 
-        gdf = gpd.GeoDataFrame(geometry=[self.footprint_shp], crs=self.crs)
+    def compute_resampling_lut(self, config_ortho):
+        """Computes the lookup table from the rectified grid to the raw datacube, i.e. the index of the nearest intersection point for each grid cell,
+        the mask and the grid definition. The lookup table only depends on the georeferencing, so it can be persisted and reused for any product.
 
-        shape_path = footprint_dir + self.name + '.shp'
+        :param config_ortho: The relevant configurations for orthorectification
+        :type config_ortho: Dictionary
+        """
+        if self.hull_line is None:
+            self.compute_footprint()
 
-        gdf.to_file(shape_path, driver='ESRI Shapefile')
+        # Horizontal coordinates of intersections in projected CRS
+        coords = self.points_proj[:, :, 0:2].reshape((-1, 2))
+
+        # The raster can be rotated optimally (which saves loads of memory) for transects that are long compared to width. 
+        # However, north-east oriented rasters is more supported by image visualization
+        if config_ortho.resampling_method in ['mean', 'median']:
+            # For resolutions coarser than the ground sampling distance, all pixels in a cell are aggregated
+            transform, height, width, indexes, suffix, mask_nn, bin_cells = GeoSpatialAbstractionHSI.cube_to_raster_bins(coords, config_ortho.raster_transform_method, resolution = config_ortho.ground_resolution)
+            self.bin_cells = bin_cells
+        else:
+            transform, height, width, indexes, suffix, mask_nn = GeoSpatialAbstractionHSI.cube_to_raster_grid(coords, config_ortho.raster_transform_method, resolution = config_ortho.ground_resolution)
+
+        # Make accessible as attribute because it can be to write ancillary data
+        self.indexes = indexes.copy()
+        self.transform = transform
+        self.width = width
+        self.height = height
+        self.suffix = suffix
+
+        # Create raster mask from the polygon describing the footprint (currently not used for anything)
+        
+        # Recommend using the nearest neighbor if transects has turns
+        # the footprint method will render a mosaic without holes, but may lead to a lot of interpolation in rugged terrain
+        mask_method = config_ortho.pixel_mask_method       
+        
+        geoms = [mapping(self.footprint_shp)]
+        mask_footprint = geometry_mask(geoms, out_shape=(height, width), transform=transform)
+
+        if mask_method == 'nn':
+            mask = mask_nn.reshape((height, width))
+        elif mask_method == 'footprint':
+            mask = mask_footprint.reshape((height, width))
+
+        self.mask = mask
+
+    @staticmethod
+    def define_transect_grid(edge_coords, name, raster_transform_method, resolution):
+        """Defines the grid of a whole transect, which is the grid enclosing the footprints of its chunks
+
+        :param edge_coords: Projected coordinates of the edges of all chunks (the first and last pixel of each line and the first and last line)
+        :type edge_coords: ndarray(n, 2)
+        :param name: The name of the output files of the transect
+        :type name: string
+        :param raster_transform_method: How the raster grid is calculated, either "north_east" or "minimal_rectangle"
+        :type raster_transform_method: string
+        :param resolution: The ground resolution in meters
+        :type resolution: float
+        :return: The grid
+        :rtype: TransectGrid
+        """
+        Taff, transform, height, width, suffix = GeoSpatialAbstractionHSI.raster_grid_definition(edge_coords, raster_transform_method, resolution)
+
+        return TransectGrid(name=name, Taff=Taff, transform=transform, height=height, width=width, suffix=suffix)
+
+    def compute_resampling_lut_in_transect(self, config_ortho, transect_grid, neighbour_points = None):
+        """Computes the lookup table of the chunk within the grid of its transect. The lookup table covers the window of the grid enclosing the chunk,
+        and a cell is resampled from the chunk only if its nearest intersection point among the chunk and the adjacent lines of the neighbouring chunks belongs to the chunk.
+        Consecutive chunks thereby meet without seams or duplicated cells.
+
+        :param config_ortho: The relevant configurations for orthorectification
+        :type config_ortho: Dictionary
+        :param transect_grid: The grid of the transect
+        :type transect_grid: TransectGrid
+        :param neighbour_points: Geocentric intersection points of the last line of the previous chunk and the first line of the next chunk, defaults to None
+        :type neighbour_points: ndarray(j, 3), optional
+        """
+        if config_ortho.resampling_method != 'nearest':
+            raise ValueError(f'Orthorectification per transect requires resamplingmethod nearest, not {config_ortho.resampling_method}')
+        
+        if self.hull_line is None:
+            self.compute_footprint()
+
+        resolution = config_ortho.ground_resolution
+
+        coords = self.points_proj[:, :, 0:2].reshape((-1, 2))
+        n_own = coords.shape[0]
+
+        # Grid coordinates (column, row) of the points
+        grid_coords = np.linalg.solve(transect_grid.Taff, np.vstack((coords.T, np.ones(n_own))))[0:2, :]
+
+        # The window enclosing the points, with a margin of the masking radius (2x the resolution)
+        margin = 3
+        col_start = int(np.clip(np.floor(grid_coords[0].min()) - margin, 0, transect_grid.width))
+        col_stop = int(np.clip(np.ceil(grid_coords[0].max()) + margin, 0, transect_grid.width))
+        row_start = int(np.clip(np.floor(grid_coords[1].min()) - margin, 0, transect_grid.height))
+        row_stop = int(np.clip(np.ceil(grid_coords[1].max()) + margin, 0, transect_grid.height))
+
+        if neighbour_points is not None:
+            neighbour_coords = transform_points(neighbour_points, self.epsg_geocsc, self.epsg_proj)[:, 0:2]
+            coords = np.vstack((coords, neighbour_coords))
+
+        dist, indexes = GeoSpatialAbstractionHSI.nearest_in_window(coords, transect_grid.Taff, row_start, row_stop, col_start, col_stop, resolution)
+
+        height = row_stop - row_start
+        width = col_stop - col_start
+
+        # Cells nearest to a neighbouring chunk are resampled from that chunk
+        is_neighbour = (indexes >= n_own).reshape((height, width))
+        indexes[indexes >= n_own] = 0
+
+        self.indexes = indexes.copy()
+        self.transform = transect_grid.transform * rasterio.Affine.translation(col_start, row_start)
+        self.width = width
+        self.height = height
+        self.suffix = transect_grid.suffix
+
+        self.transect_grid = transect_grid
+        self.window_offset = (row_start, col_start)
+
+        if config_ortho.pixel_mask_method == 'nn':
+            mask = (dist > 2*resolution).reshape((height, width))
+        elif config_ortho.pixel_mask_method == 'footprint':
+            geoms = [mapping(self.footprint_shp)]
+            mask = geometry_mask(geoms, out_shape=(height, width), transform=self.transform)
+
+        self.mask = mask | is_neighbour
+
+    def output_grid(self):
+        """The name, suffix, transform, height and width of the output files. For a chunk resampled into the grid of its transect, these are of the transect.
+
+        :return: The name, suffix, transform, height and width
+        :rtype: string, string, Affine, int, int
+        """
+        if self.transect_grid is None:
+            return self.name, self.suffix, self.transform, self.height, self.width
+        
+        grid = self.transect_grid
+        return grid.name, grid.suffix, grid.transform, grid.height, grid.width
+
+    def resampling_lut_path(self, lut_dir, config_ortho):
+        """The path of the persisted lookup table. The file name holds a hash of the georeferenced points and the grid settings,
+        so that a lookup table is never reused after re-georeferencing or changing the grid.
+
+        :param lut_dir: Folder with lookup tables
+        :type lut_dir: string
+        :param config_ortho: The relevant configurations for orthorectification
+        :type config_ortho: Dictionary
+        :return: Path to the lookup table (*.npz)
+        :rtype: string
+        """
+        lut_hash = hashlib.sha1(np.ascontiguousarray(self.points_geocsc).tobytes())
+
+        grid_settings = (config_ortho.ground_resolution, 
+                         config_ortho.raster_transform_method, 
+                         config_ortho.pixel_mask_method, 
+                         self.epsg_proj,
+                         config_ortho.resampling_method in ['mean', 'median'],
+                         self.approx_transform_tolerance)
+        
+        lut_hash.update(repr(grid_settings).encode())
+
+        return os.path.join(lut_dir, self.name + '_' + lut_hash.hexdigest()[0:16] + '.npz')
+
+    def save_resampling_lut(self, lut_path):
+        """Writes the lookup table, grid definition and footprint to a *.npz file
+
+        :param lut_path: Path to the lookup table
+        :type lut_path: string
+        """
+        indexes = self.indexes
+        # Halves the size for all but enormous chunks
+        if self.n_lines*self.n_pixels < np.iinfo(np.int32).max:
+            indexes = indexes.astype(np.int32)
+
+        lut = {'indexes': indexes,
+               'mask': self.mask,
+               'transform': np.array(self.transform)[0:6],
+               'height': self.height,
+               'width': self.width,
+               'suffix': self.suffix,
+               'hull_line': self.hull_line}
+        
+        if self.bin_cells is not None:
+            lut['bin_cells'] = self.bin_cells
+
+        np.savez(lut_path, **lut)
+
+    def load_resampling_lut(self, lut_path):
+        """Reads a lookup table written by save_resampling_lut. Makes the projection of the point cloud and the nearest neighbour search superfluous.
+
+        :param lut_path: Path to the lookup table
+        :type lut_path: string
+        """
+        with np.load(lut_path) as lut:
+            self.indexes = lut['indexes'].astype(np.int64)
+            self.mask = lut['mask']
+            self.transform = rasterio.Affine(*lut['transform'])
+            self.height = int(lut['height'])
+            self.width = int(lut['width'])
+            self.suffix = str(lut['suffix'])
+            self.hull_line = lut['hull_line']
+
+            if 'bin_cells' in lut.files:
+                self.bin_cells = lut['bin_cells']
+
+        self.footprint_shp = Polygon(self.hull_line)
 
     def resample_datacube(self, radiance_cube, wavelengths, fwhm, envi_cube_dir, rgb_composite_dir, config_ortho):
         """Resamples the radiance cube into a geographic grid based on the georeferencing
@@ -124,27 +383,62 @@ class GeoSpatialAbstractionHSI():
         :param config_ortho: The relevant configurations for orthorectification
         :type config_ortho: Dictionary
         """
+        self.resample_products(radiance_cube=radiance_cube, 
+                               wavelengths=wavelengths, 
+                               fwhm=fwhm, 
+                               envi_cube_dir=envi_cube_dir, 
+                               rgb_composite_dir=rgb_composite_dir, 
+                               config_ortho=config_ortho)
+
+    def resample_products(self, radiance_cube, wavelengths, fwhm, envi_cube_dir, rgb_composite_dir, config_ortho, h5_filename = None, anc_dir = None, anc_dict = None, anc_encoding = None, band_math_dir = None, transect_writers = None):
+        """Resamples the datacube, the RGB composite and optionally the band math products and ancillary data in one pass over the grid (see ProductPlan).
+        The source pixel of each cell is looked up once per block of the grid, and the datacube rows gathered for a block are shared by the datacube, composite and band math.
+
+        :param radiance_cube: The data cube of radiance with the corresponding radiometric_unit of the data
+        :type radiance_cube: Often an ndarray(n, m, k) where n-number of lines, m- number of pixels, and k-number of spectral bands
+        :param wavelengths: The band's centre wavelengths
+        :type wavelengths: ndarray(k, 1)
+        :param fwhm: Full Width Half Maximum, descibing the band's widths (often in nanometers)
+        :type fwhm: ndarray(k, 1)
+        :param envi_cube_dir: Directory to write data cubes
+        :type envi_cube_dir: string, path
+        :param rgb_composite_dir: Directory to write data cubes
+        :type rgb_composite_dir: string, path
+        :param config_ortho: The relevant configurations for orthorectification
+        :type config_ortho: Dictionary
+        :param h5_filename: The h5 file with the ancillary layers, defaults to None
+        :type h5_filename: string, optional
+        :param anc_dir: Where the ancillary data is written, defaults to None
+        :type anc_dir: string, optional
+        :param anc_dict: The ancillary layers, as attribute name: h5 path. If None, no ancillary data is written, defaults to None
+        :type anc_dict: dict, optional
+        :param anc_encoding: The encoding of each ancillary layer, see resample_ancillary, defaults to None
+        :type anc_encoding: dict, optional
+        :param band_math_dir: Where the band math products (config_ortho.band_math) are written. If None, none are written, defaults to None
+        :type band_math_dir: string, optional
+        :param transect_writers: The open writers of the transect, shared by its chunks (see compute_resampling_lut_in_transect). 
+                                 Writers are created as needed and are closed by the caller when all chunks are written, defaults to None
+        :type transect_writers: dict, optional
+        """
 
 
 
         
+        # Only the bands within the wavelength range are resampled (nothing is removed if only those bands were read)
+        band_subset = wavelength_subset(wavelengths, config_ortho.wavelength_range)
+        radiance_cube = radiance_cube[:, :, band_subset]
+        wavelengths = wavelengths[band_subset]
+        if np.ndim(fwhm) > 0:
+            fwhm = fwhm[band_subset]
+
         n_bands = len(wavelengths)
         #
         n = radiance_cube.shape[0]
         m = radiance_cube.shape[1]
         k = radiance_cube.shape[2] # Number of bands
 
-        bytes_per_entry = radiance_cube.itemsize
-        chunk_size_GB = config_ortho.chunk_size_cube_GB
-
-        # If chunking is to be applied, we can use square chunks
-        chunk_square_length = np.sqrt((chunk_size_GB*1024**3) / (k*bytes_per_entry))
-        self.chunk_square_length = int(np.round(chunk_square_length/1000)*1000)
-
-        if self.chunk_square_length == 0:
-            self.chunk_square_length = 1000
-
-        self.chunk_area = self.chunk_square_length**2
+        # For large files, the grid is processed in blocks of columns of about this size
+        self.block_size_GB = config_ortho.chunk_size_cube_GB
 
         self.res = config_ortho.ground_resolution
 
@@ -152,8 +446,6 @@ class GeoSpatialAbstractionHSI():
         wl_green = config_ortho.wl_green
         wl_blue = config_ortho.wl_blue
         
-        # North-east or memory optimal
-        raster_transform_method = config_ortho.raster_transform_method
 
         # Set nodata value for ortho-products
         
@@ -180,8 +472,25 @@ class GeoSpatialAbstractionHSI():
         band_ind_G = np.argmin(np.abs(wl_green - wavelengths))
         band_ind_B = np.argmin(np.abs(wl_blue - wavelengths))
 
+        # The datacube is optionally binned spectrally, which is applied to the gathered rows of each block
+        spectral_binning = spectral_bins(wavelengths = wavelengths, 
+                                         fwhm = fwhm, 
+                                         bin_width = config_ortho.spectral_bin_width, 
+                                         bin_centers = config_ortho.spectral_bin_centers)
+        
+        if spectral_binning is None:
+            wavelengths_cube = wavelengths
+            fwhm_cube = fwhm
+            n_bands_cube = n_bands
+            default_bands = [band_ind_R, band_ind_G, band_ind_B]
+        else:
+            wavelengths_cube = spectral_binning.wavelengths
+            fwhm_cube = spectral_binning.fwhm
+            n_bands_cube = wavelengths_cube.size
+            default_bands = [np.argmin(np.abs(wl - wavelengths_cube)) for wl in [wl_red, wl_green, wl_blue]]
+
         # To let ENVI pick up on which bands are used for red-green-blue vizualization
-        self.default_bands_string = '{ '+' , '.join([str(band_ind_R), str(band_ind_G), str(band_ind_B)]) + ' }'
+        self.default_bands_string = '{ '+' , '.join([str(band_ind) for band_ind in default_bands]) + ' }'
 
         # Some relevant metadata.
         # See https://www.nv5geospatialsoftware.com/docs/ENVIHeaderFiles.html for documentation of the entries
@@ -192,20 +501,20 @@ class GeoSpatialAbstractionHSI():
             'sensor type': config_ortho.sensor_type,
             'default bands': self.default_bands_string,
             'interleave': config_ortho.interleave,
-            'wavelength': wavelengths
+            'wavelength': wavelengths_cube
         }
         try:
             # If vector form is avai
-            if fwhm.any() == np.nan:
+            if fwhm_cube.any() == np.nan:
                 pass
             else:
-                metadata_ENVI['fwhm'] = fwhm
+                metadata_ENVI['fwhm'] = fwhm_cube
         except AttributeError:
             # If scalar
-            if fwhm == np.nan:
+            if fwhm_cube == np.nan:
                 pass
             else:
-                metadata_ENVI['fwhm'] = fwhm
+                metadata_ENVI['fwhm'] = fwhm_cube
 
             
         
@@ -215,293 +524,388 @@ class GeoSpatialAbstractionHSI():
 
         
 
-        # Horizontal coordinates of intersections in projected CRS
-        coords = self.points_proj[:, :, 0:2].reshape((-1, 2))
-
         del radiance_cube
         
-        # The raster can be rotated optimally (which saves loads of memory) for transects that are long compared to width. 
-        # However, north-east oriented rasters is more supported by image visualization
-        transform, height, width, indexes, suffix, mask_nn = GeoSpatialAbstractionHSI.cube_to_raster_grid(coords, raster_transform_method, resolution = self.res)
-
-        # Make accessible as attribute because it can be to write ancillary data
-        self.indexes = indexes.copy()
-        self.transform = transform
-        self.width = width
-        self.height = height
-        self.suffix = suffix
-
-        # Create raster mask from the polygon describing the footprint (currently not used for anything)
-        
-        # Recommend using the nearest neighbor if transects has turns
-        # the footprint method will render a mosaic without holes, but may lead to a lot of interpolation in rugged terrain
-        mask_method = config_ortho.pixel_mask_method       
-        
-        geoms = [mapping(self.footprint_shp)]
-        mask_footprint = geometry_mask(geoms, out_shape=(height, width), transform=transform)
-
-        if mask_method == 'nn':
-            mask = mask_nn.reshape((height, width))
-        elif mask_method == 'footprint':
-            mask = mask_footprint.reshape((height, width))
+        # Geometry is only needed if the lookup table was not loaded from disk
+        if self.indexes is None:
+            self.compute_resampling_lut(config_ortho)
+
+        if self.bin_cells is not None:
+            # All pixels in a cell are aggregated, so that row i of the aggregated datacube belongs to cell i of the grid
+            datacube = GeoSpatialAbstractionHSI.aggregate_bins(datacube = datacube, 
+                                                               bin_cells = self.bin_cells, 
+                                                               n_cells = self.height*self.width, 
+                                                               method = config_ortho.resampling_method)
+            cube_per_cell = True
+        else:
+            cube_per_cell = False
 
+        # The output files are of the chunk, or of the transect
+        output_name, suffix, transform, height, width = self.output_grid()
 
-        
-        
-        
-        self.mask = mask
+        plan = self.product_plan()
 
         # Build datacube
         if not rgb_composite_only:
-
-            # For the later processing, storing the mapping from the rectified grid to the raw datacube makes sense:
-            indexes_grid_unmasked = indexes.reshape((height, width))
-            
-            # Mask indexes
-            indexes_grid_unmasked[mask == 1] = self.nodata
-
-            # Make masked indices accessible as these allow orthorectification of ancilliary data
-            self.index_grid_masked = indexes_grid_unmasked
-
-            # To do the writing of the rasters we use a memory map, and writes chunks at a time.
-            # For this writing process, we need to know all the below
-            memmap_gen_params = {
-                'indexes': indexes,
-                'index_grid_masked': self.index_grid_masked,
-                'mask': mask,
-                'nodata': self.nodata,
-                'height': height,
-                'width': width,
-                'datacube': datacube,
-                'chunk_area': self.chunk_area
-            }
-
-            GeoSpatialAbstractionHSI.write_datacube_ENVI(memmap_gen_params, 
-                                self.nodata, 
-                                transform, 
-                                datacube_path = envi_cube_dir + self.name + suffix, 
-                                wavelengths=wavelengths,
-                                fwhm=fwhm,
-                                metadata = metadata_ENVI,
-                                crs=self.crs,
-                                interleave = config_ortho.interleave)
-
+            if spectral_binning is None:
+                gather_cube = lambda block: block.cube_rows(datacube, cube_per_cell)
+            else:
+                gather_cube = lambda block: block.cube_rows(datacube, cube_per_cell) @ spectral_binning.weights
+
+            if config_ortho.output_format == 'cog' and config_ortho.cog_datacube:
+                # Tiled, compressed datacube with overviews. Wavelengths go to the band descriptions
+                writer = _open_writer(transect_writers, _GTiffWriter, 
+                                      path = envi_cube_dir + output_name + suffix, 
+                                      height = height, 
+                                      width = width, 
+                                      n_bands = n_bands_cube, 
+                                      dtype = datacube.dtype, 
+                                      nodata = self.nodata, 
+                                      transform = transform, 
+                                      crs = self.crs,
+                                      band_names = [str(wl) for wl in np.array(wavelengths_cube).reshape(-1)],
+                                      tags = {key: str(value) for key, value in metadata_ENVI.items() if key not in ['band names', 'interleave']},
+                                      cog_options = config_ortho.cog_options,
+                                      is_cog = True)
+            elif config_ortho.output_format == 'zarr':
+                # Chunked spatially and spectrally, with the ENVI metadata as attributes
+                writer = _open_writer(transect_writers, _ZarrWriter, 
+                                      path = envi_cube_dir + output_name + suffix, 
+                                      height = height, 
+                                      width = width, 
+                                      n_bands = n_bands_cube, 
+                                      dtype = datacube.dtype, 
+                                      nodata = self.nodata, 
+                                      transform = transform, 
+                                      crs = self.crs,
+                                      zarr_options = config_ortho.zarr_options,
+                                      band_names = [str(wl) for wl in np.array(wavelengths_cube).reshape(-1)],
+                                      attrs = {key: value for key, value in metadata_ENVI.items() if key not in ['band names', 'interleave']})
+            else:
+                writer = _open_writer(transect_writers, _ENVIWriter, 
+                                      path = envi_cube_dir + output_name + suffix, 
+                                      height = height, 
+                                      width = width, 
+                                      n_bands = n_bands_cube, 
+                                      dtype = datacube.dtype, 
+                                      nodata = self.nodata, 
+                                      transform = transform, 
+                                      crs = self.crs, 
+                                      metadata = metadata_ENVI, 
+                                      interleave = config_ortho.interleave,
+                                      prefill = transect_writers is not None)
+
+            plan.add_product(name = 'datacube',
+                             n_bands = n_bands_cube,
+                             dtype = datacube.dtype,
+                             nodata = self.nodata,
+                             gather = gather_cube,
+                             writer = writer)
             
-        
-        # RBG Composite as list
-        rgb_cube = datacube[:, [band_ind_R, band_ind_G, band_ind_B]].reshape((-1, 3))
-        
-        # Resample RGB image data 
-        ortho_rgb = rgb_cube[self.indexes, :].flatten()
-
-        # Reshape image
-        ortho_rgb = ortho_rgb.reshape((height, width, 3))
-    
-        # Mask RGB
-        ortho_rgb[mask == 1, :] = self.nodata
-
-        # Arange composite in rasterio-friendly structure
-        ortho_rgb = np.transpose(ortho_rgb, axes = [2, 0, 1])
+        # RGB composite, taken from the same gathered rows as the datacube
+        rgb_bands = [band_ind_R, band_ind_G, band_ind_B]
         
         # Write pseudo-RGB composite to composite folder ../GIS/RGBComposites
-        with rasterio.open(rgb_composite_dir + self.name + suffix + '.tif', 'w', driver='GTiff',
-                                height=height, width=width, count=3, dtype=ortho_rgb.dtype,
-                                crs=self.crs, transform=transform, nodata=self.nodata) as dst:
-
-            dst.write(ortho_rgb)
-        
-    @staticmethod
-    def write_datacube_memmap(memmap_array, indexes, index_grid_masked, mask, nodata, height, width, datacube, chunk_area):  
-        """Function for writing data cube arrays to memory maps, effectively avoiding memory issues.
-
-        :param memmap_array: _description_
-        :type memmap_array: _type_
-        :param indexes: _description_
-        :type indexes: _type_
-        :param index_grid_masked: _description_
-        :type index_grid_masked: _type_
-        :param mask: _description_
-        :type mask: _type_
-        :param nodata: _description_
-        :type nodata: _type_
-        :param height: _description_
-        :type height: _type_
-        :param width: _description_
-        :type width: _type_
-        :param datacube: _description_
-        :type datacube: _type_
-        :param chunk_area: _description_
-        :type chunk_area: _type_
-        """
-
-        # How the hell is this logical?
-        n_bands = datacube.shape[1]
-
-        # In grid form, identify whether partitioning is needed
-        area_idx_grid = width*height
-
-        if area_idx_grid > chunk_area:
-            
-            # Subdivide along horizontal axis:
-            delta_width = int(chunk_area/height)
-            # Number of slices
-            num_delta_widths = int(width/delta_width) + 1
-            # Iterate slices
-            for i in range(num_delta_widths):
-                # Last slice has different thickness
-                if i != num_delta_widths-1:
-                    sub_indices = index_grid_masked[:, i*delta_width:(i+1)*delta_width].reshape((-1,1))
-                    dw = delta_width
-                    
-                else:
-                    sub_indices = index_grid_masked[:, i*delta_width:width].reshape((-1,1))
-                    dw = np.arange(i*delta_width, width).size
-                
-                # Only extraxt valid data:
-                sub_ortho_cube = np.ones((sub_indices.shape[0]*sub_indices.shape[1], n_bands))*nodata
-                
-                # From the grid, the only valid pixels are
-                valid_pixels = (sub_indices != nodata).reshape(-1)
-                valid_pixels_raw = sub_indices[valid_pixels].reshape(-1)
-                valid_pixels_geo = np.arange(sub_indices.size)[valid_pixels]
-
-                sub_ortho_cube[valid_pixels_geo, :] = datacube[valid_pixels_raw, :]
-
-                sub_ortho_cube = sub_ortho_cube.reshape((height, dw, n_bands))
-
-                # Form to Rasterio friendly
-                #sub_ortho_cube = np.transpose(sub_ortho_cube, axes=[2, 0, 1])
-
-                memmap_array[:, i*delta_width:i*delta_width + dw, :] = sub_ortho_cube
-            # Free memory
-            del datacube
-            del sub_ortho_cube
+        if config_ortho.output_format == 'cog':
+            rgb_cog_options = config_ortho.cog_options
         else:
-            # Resample
-            ortho_datacube = datacube[indexes, :]
-
-            # Free memory
-            del datacube
-
-            # Reshape to datacube form
-            ortho_datacube = ortho_datacube.reshape((height, width, n_bands))
-
-            # Mask
-            ortho_datacube[mask == 1, :] = nodata
-
-            # Form to Rasterio friendly
-            #ortho_datacube = np.transpose(ortho_datacube, axes=[2, 0, 1])
-
-            # Write to memory map
-            memmap_array[:] = ortho_datacube
-
-            # Free memory
-            del ortho_datacube
-
-        return  
-
-    def resample_ancillary(self, h5_filename, anc_dir, anc_dict, interleave = 'bsq'):
+            rgb_cog_options = None
+
+        writer = _open_writer(transect_writers, _GTiffWriter, 
+                              path = rgb_composite_dir + output_name + suffix, 
+                              height = height, 
+                              width = width, 
+                              n_bands = 3, 
+                              dtype = datacube.dtype, 
+                              nodata = self.nodata, 
+                              transform = transform, 
+                              crs = self.crs,
+                              cog_options = rgb_cog_options,
+                              is_cog = config_ortho.output_format == 'cog')
+        
+        plan.add_product(name = 'rgb_composite',
+                         n_bands = 3,
+                         dtype = datacube.dtype,
+                         nodata = self.nodata,
+                         gather = lambda block: block.cube_rows(datacube, cube_per_cell)[:, rgb_bands],
+                         writer = writer)
+        
+        # Band math products, e.g. spectral indices, as single band rasters
+        if band_math_dir is not None:
+            for name, expression in config_ortho.band_math.items():
+                band_math = BandMathExpression(name = name, expression = expression, wavelengths = wavelengths)
+
+                writer = _open_writer(transect_writers, _GTiffWriter, 
+                                      path = band_math_dir + output_name + suffix + '_' + name, 
+                                      height = height, 
+                                      width = width, 
+                                      n_bands = 1, 
+                                      dtype = np.float32, 
+                                      nodata = self.nodata, 
+                                      transform = transform, 
+                                      crs = self.crs,
+                                      band_names = [name],
+                                      tags = {'expression': expression},
+                                      cog_options = config_ortho.cog_options if config_ortho.output_format in ['cog', 'gtiff'] else None,
+                                      is_cog = config_ortho.output_format == 'cog',
+                                      compress = True)
+                
+                plan.add_product(name = name,
+                                 n_bands = 1,
+                                 dtype = np.float32,
+                                 nodata = self.nodata,
+                                 gather = lambda block, band_math=band_math: band_math.evaluate(block.cube_rows(datacube, cube_per_cell), nodata = self.nodata).reshape((-1, 1)),
+                                 writer = writer)
+        
+        if anc_dict is not None:
+            self.add_ancillary_products(plan = plan,
+                                        h5_filename = h5_filename,
+                                        anc_dir = anc_dir,
+                                        anc_dict = anc_dict,
+                                        interleave = config_ortho.interleave,
+                                        output_format = config_ortho.output_format,
+                                        cog_options = config_ortho.cog_options,
+                                        anc_encoding = anc_encoding,
+                                        zarr_options = config_ortho.zarr_options,
+                                        transect_writers = transect_writers)
+            
+        plan.run()
 
-        band_counter = 0
-        band_names = []
+    def product_plan(self):
+        """An empty product plan over the grid of the lookup table"""
+        # Make masked indices accessible as these allow orthorectification of ancilliary data
+        indexes_grid_unmasked = self.indexes.copy().reshape((self.height, self.width))
+        indexes_grid_unmasked[self.mask == 1] = self.nodata
+        self.index_grid_masked = indexes_grid_unmasked
 
-        # Define one hyperspectral data to 
+        try:
+            block_size_GB = self.block_size_GB
+        except AttributeError:
+            block_size_GB = 1
+
+        return ProductPlan(index_grid = self.indexes.reshape((self.height, self.width)), 
+                           mask = self.mask, 
+                           n_pixels = self.n_pixels, 
+                           block_size_GB = block_size_GB,
+                           window_offset = self.window_offset)
+        
+    def resample_ancillary(self, h5_filename, anc_dir, anc_dict, interleave = 'bsq', output_format = 'default', cog_options = None, anc_encoding = None, zarr_options = None):
+        """Orthorectifies the ancillary layers (e.g. positions, angles, time) to the grid of the datacube, in a pass of their own. 
+        Usually they are written in the same pass as the datacube by resample_products.
+
+        :param h5_filename: Path to the h5 file of the chunk
+        :type h5_filename: string
+        :param anc_dir: Where the ancillary data is written
+        :type anc_dir: string
+        :param anc_dict: The ancillary layers, as attribute name: h5 path
+        :type anc_dict: dict
+        :param interleave: ENVI interleave, defaults to 'bsq'
+        :type interleave: str, optional
+        :param output_format: 'default' (ENVI), 'gtiff' (compressed GeoTIFF), 'cog' or 'zarr', defaults to 'default'
+        :type output_format: str, optional
+        :param cog_options: Creation options of the COG driver, also used for compression of 'gtiff', defaults to None
+        :type cog_options: dict, optional
+        :param anc_encoding: If given, each layer is written to its own file with the (dtype, scale) of its attribute name, see ANCILLARY_ENCODING_DEFAULTS. 
+                             Otherwise all layers are written to one float64 file, defaults to None
+        :type anc_encoding: dict, optional
+        :param zarr_options: Chunking and compression of 'zarr', defaults to None
+        :type zarr_options: dict, optional
+        """
+        plan = self.product_plan()
+
+        self.add_ancillary_products(plan = plan,
+                                    h5_filename = h5_filename,
+                                    anc_dir = anc_dir,
+                                    anc_dict = anc_dict,
+                                    interleave = interleave,
+                                    output_format = output_format,
+                                    cog_options = cog_options,
+                                    anc_encoding = anc_encoding,
+                                    zarr_options = zarr_options)
+
+        plan.run()
+
+    def add_ancillary_products(self, plan, h5_filename, anc_dir, anc_dict, interleave, output_format, cog_options, anc_encoding, zarr_options = None, transect_writers = None):
+        """Adds the ancillary data to a product plan. Each cell takes the value of its source pixel in the lookup table. Per-line layers 
+        (e.g. positions and quaternions of shape n_lines x j) are kept as line vectors and gathered through the source line of each cell, 
+        so that no layer is broadcast to all pixels. Layers are held in their stored dtype until gathered.
+
+        :param plan: The product plan
+        :type plan: ProductPlan
+        :param h5_filename: Path to the h5 file of the chunk
+        :type h5_filename: string
+        :param anc_dir: Where the ancillary data is written
+        :type anc_dir: string
+        :param anc_dict: The ancillary layers, as attribute name: h5 path
+        :type anc_dict: dict
+        :param interleave: ENVI interleave
+        :type interleave: str
+        :param output_format: 'default' (ENVI), 'gtiff' (compressed GeoTIFF), 'cog' or 'zarr'
+        :type output_format: str
+        :param cog_options: Creation options of the COG driver, also used for compression of 'gtiff'
+        :type cog_options: dict
+        :param anc_encoding: (dtype, scale) per attribute name, or None for one float64 file
+        :type anc_encoding: dict
+        :param zarr_options: Chunking and compression of 'zarr', defaults to None
+        :type zarr_options: dict, optional
+        :param transect_writers: The open writers of the transect by path, see resample_products, defaults to None
+        :type transect_writers: dict, optional
+        """
+        # Each layer is described by its attribute name, data, whether it is per line and its band names
+        layers = []
         with h5py.File(h5_filename, 'r', libver='latest') as f:
             for attribute_name, h5_hierarchy_item_path in anc_dict.items():
                 if attribute_name != 'folder':
                     data = f[h5_hierarchy_item_path][()]
 
+                    is_per_line = data.ndim == 1 or (data.ndim == 2 and data.shape[1] != self.n_pixels)
 
-                    if data.ndim == 2:
-                        if data.shape[1]  != self.n_pixels:
-                            # For data of shape n_lines x j, for example camera positions, reshape to n_lines x n_pixels x j
-                            j = data.shape[1]
-                            data = np.einsum('ijk, ik -> ijk', np.ones((self.n_lines, self.n_pixels, j), dtype=np.float64), data)
-                        else:
-                            # For data with dimension n_lines x n_pixels, add third dimension
-                            data = data.reshape((data.shape[0], data.shape[1], 1))
-
-                    data = data.astype(dtype = np.float64)
-                    
-                    # For first layer
-                    if band_counter == 0:
-                        anc_data_array = data
-                    # For other layers, concatenate with existing layers
+                    if data.ndim == 1 or (data.ndim == 2 and not is_per_line):
+                        k = 1
                     else:
-                        anc_data_array = np.concatenate((anc_data_array, data), axis = 2)
+                        k = data.shape[-1]
 
                     # Necessary to modify for data with multiple bands
-                    k = data.shape[2]
-                    # If data has more than one band:
                     if k > 1:
-                        for i in range(k):
-                            band_name_data = attribute_name + '_' + str(i)
-                            band_names.append(band_name_data)
+                        band_names = [attribute_name + '_' + str(i) for i in range(k)]
                     else:
-                        band_name_data = attribute_name
-                        band_names.append(band_name_data)
-                    
-                    band_counter += k
-                    
-                    
-            
-        
-        
-        metadata_anc = {
-            'description': 'Ancillary data',
-            'band names': '{ '+' , '.join(band_names) + ' }'
-        }
-        n_bands = band_counter
+                        band_names = [attribute_name]
 
-        # Resample
-        anc_data_array = anc_data_array.reshape((-1, n_bands))
-        
-        # Grid of indices
-        indexes_grid_unmasked = self.indexes.copy().reshape((self.height, self.width))
+                    layers.append((attribute_name, data, is_per_line, band_names))
 
-        # Mask indexes
-        indexes_grid_unmasked[self.mask == 1] = self.nodata
+        if self.bin_cells is not None:
+            # The number of aggregated pixels per cell
+            sample_count = np.bincount(self.bin_cells[self.bin_cells >= 0], minlength=self.height*self.width)
+            layers.append(('sample_count', sample_count, None, ['sample_count']))
 
-        # Make masked indices accessible as these allow orthorectification of ancilliary data
-        self.index_grid_masked = indexes_grid_unmasked
-
-        # Alternative 2
-        memmap_gen_params = {
-            'indexes': self.indexes,
-            'index_grid_masked': self.index_grid_masked,
-            'mask': self.mask,
-            'nodata': self.nodata,
-            'height': self.height,
-            'width': self.width,
-            'datacube': anc_data_array,
-            'chunk_area': self.chunk_area
-        }
+        def gather_layer(block, data, is_per_line):
+            if is_per_line is None:
+                # Already defined on the grid
+                return block.cell_values(data)
+            return block.layer_values(data, is_per_line)
         
-        GeoSpatialAbstractionHSI.write_ancillary_ENVI_envi(nodata = self.nodata, 
-                                                    transform = self.transform, 
-                                                    crs = self.crs,
-                                                    anc_path = anc_dir + self.name + self.suffix,
-                                                    metadata = metadata_anc,
-                                                    interleave=interleave,
-                                                    memmap_gen_params=memmap_gen_params)
+        output_name, suffix, transform, height, width = self.output_grid()
 
-        
+        anc_path = anc_dir + output_name + suffix
 
-    @staticmethod
-    def cube_to_raster_grid(coords, raster_transform_method, resolution):
-        """Function that takes projected coordinates (e.g. UTM 32 east and north) of ray intersections and computes an image grid
+        # Each file is described by its path, its layers and the encoding
+        if anc_encoding is None:
+            anc_files = [(anc_path, layers, AncillaryEncoding(dtype=np.dtype(np.float64), scale=1.0, nodata=self.nodata))]
+        else:
+            anc_files = [(anc_path + '_' + layer[0], 
+                          [layer], 
+                          GeoSpatialAbstractionHSI.ancillary_encoding(layer[0], anc_encoding, self.nodata)) 
+                          for layer in layers]
+
+        for anc_file_path, anc_file_layers, encoding in anc_files:
+            band_names = [band_name for layer in anc_file_layers for band_name in layer[3]]
+            n_bands = len(band_names)
+
+            metadata_anc = {
+                'description': 'Ancillary data',
+                'band names': '{ '+' , '.join(band_names) + ' }'
+            }
 
-        :param coords: _description_
-        :type coords: _type_
-        :param raster_transform_method: How the raster grid is calculated. "north_east" is standard and defines a rectangle along north/east. "minimal_rectangle" is memory optimal as it finds the smallest enclosing rectangle that wraps the points.
-        :type raster_transform_method: _type_
-        :param resolution: _description_
-        :type resolution: _type_
-        :return: _description_
-        :rtype: _type_
+            if encoding.scale != 1:
+                # The stored integers are decoded as value = gain*stored + offset
+                metadata_anc['data gain values'] = '{ ' + ' , '.join([str(encoding.scale)]*n_bands) + ' }'
+                metadata_anc['data offset values'] = '{ ' + ' , '.join(['0']*n_bands) + ' }'
+            
+            if output_format in ['cog', 'gtiff']:
+                # Averaging angles, times or pixel numbers with nodata makes little sense, so overviews use nearest
+                cog_options_anc = dict(cog_options)
+                cog_options_anc['overview_resampling'] = 'NEAREST'
+
+                writer = _open_writer(transect_writers, _GTiffWriter, 
+                                      path = anc_file_path, 
+                                      height = height, 
+                                      width = width, 
+                                      n_bands = n_bands, 
+                                      dtype = encoding.dtype, 
+                                      nodata = encoding.nodata, 
+                                      transform = transform, 
+                                      crs = self.crs,
+                                      band_names = band_names,
+                                      tags = {key: str(value) for key, value in metadata_anc.items() if key not in ['band names', 'interleave', 'data gain values', 'data offset values']},
+                                      scale = encoding.scale,
+                                      cog_options = cog_options_anc,
+                                      is_cog = output_format == 'cog',
+                                      compress = True)
+            elif output_format == 'zarr':
+                writer = _open_writer(transect_writers, _ZarrWriter, 
+                                      path = anc_file_path, 
+                                      height = height, 
+                                      width = width, 
+                                      n_bands = n_bands, 
+                                      dtype = encoding.dtype, 
+                                      nodata = encoding.nodata, 
+                                      transform = transform, 
+                                      crs = self.crs,
+                                      zarr_options = zarr_options,
+                                      band_names = band_names,
+                                      attrs = {'description': metadata_anc['description']},
+                                      scale = encoding.scale)
+            else:
+                writer = _open_writer(transect_writers, _ENVIWriter, 
+                                      path = anc_file_path, 
+                                      height = height, 
+                                      width = width, 
+                                      n_bands = n_bands, 
+                                      dtype = encoding.dtype, 
+                                      nodata = encoding.nodata, 
+                                      transform = transform, 
+                                      crs = self.crs, 
+                                      metadata = metadata_anc, 
+                                      interleave = interleave,
+                                      prefill = transect_writers is not None)
+
+            plan.add_product(name = os.path.basename(anc_file_path),
+                             n_bands = n_bands,
+                             dtype = encoding.dtype,
+                             nodata = encoding.nodata,
+                             gather = lambda block, anc_file_layers=anc_file_layers: np.hstack([gather_layer(block, layer[1], layer[2]).astype(np.float64) 
+                                                                                                for layer in anc_file_layers]),
+                             writer = writer,
+                             scale = encoding.scale)
+        
+    @staticmethod
+    def ancillary_encoding(attribute_name, anc_encoding, nodata):
+        """The encoding of an ancillary layer
+
+        :param attribute_name: Name of the layer, e.g. 'theta_v'
+        :type attribute_name: string
+        :param anc_encoding: (dtype, scale) per attribute name. Names that are not listed use ANCILLARY_ENCODING_FALLBACK
+        :type anc_encoding: dict
+        :param nodata: The nodata value of float layers
+        :type nodata: float
+        :return: The dtype, scale and nodata value
+        :rtype: AncillaryEncoding
         """
+        dtype, scale = anc_encoding.get(attribute_name, ANCILLARY_ENCODING_FALLBACK)
+        dtype = np.dtype(dtype)
+
+        if np.issubdtype(dtype, np.signedinteger):
+            nodata_encoded = np.iinfo(dtype).min
+        elif np.issubdtype(dtype, np.unsignedinteger):
+            nodata_encoded = np.iinfo(dtype).max
+        else:
+            nodata_encoded = nodata
 
+        return AncillaryEncoding(dtype=dtype, scale=float(scale), nodata=nodata_encoded)
 
+    @staticmethod
+    def raster_grid_definition(coords, raster_transform_method, resolution):
+        """Defines the raster grid (affine transform and size) enclosing projected coordinates of ray intersections
+
+        :param coords: Projected coordinates (e.g. UTM 32 east and north) of ray intersections
+        :type coords: ndarray(n, 2)
+        :param raster_transform_method: How the raster grid is calculated, either "north_east" or "minimal_rectangle"
+        :type raster_transform_method: string
+        :param resolution: The ground resolution in meters
+        :type resolution: float
+        :return: The transform as 3x3 matrix and as rasterio Affine, height, width and file suffix
+        :rtype: ndarray(3, 3), Affine, int, int, string
+        """
         if raster_transform_method == 'north_east':
             # Creates the minimal area (and thus memory) rectangle around points
             polygon = MultiPoint(coords).envelope
@@ -582,286 +986,279 @@ class GeoSpatialAbstractionHSI():
         a, b, c, d, e, f = Taff[0,0], Taff[0,1], Taff[0,2], Taff[1,0], Taff[1,1], Taff[1,2]
         transform = rasterio.Affine(a, b, c, d, e, f)
 
-        # Define local orthographic pixel grid. Pixel centers reside at half coordinates.
-        xi, yi = np.meshgrid(np.arange(width) + 0.5, 
-                                np.arange(height) + 0.5)
-        # To get homogeneous vector (not an actual z coordinate)
-        zi = np.ones(xi.shape)
-
-        # Form homogeneous vectors (allows translation by multiplication)
-        x_r = np.vstack((xi.flatten(), yi.flatten(), zi.flatten())).T
-
-        # Map orthographic pixels to projected system
-        x_p = np.matmul(Taff, x_r.T).T 
-
-        # Make a point vector of grid points to be used in nearest neighbor
-        xy = np.vstack((x_p[:,0].flatten(), x_p[:,1].flatten())).T
-        
-        # Define NN search tree from intersection points
-        tree = NearestNeighbors(radius=resolution).fit(coords)
-
-        # Calculate the nearest intersection point (in "coords") for each grid cell ("xy").
-        
-        # Here we only use one neighbor, and indexes is a vector of len(xy) where an element indexes(i)
-        # says that the closest point to xy[i] is coords[indexes[i]]. Since coords is just a flattened/reshaped version of intersection points
-        #, the data cube can be resampled by datacube_flat=datacube.reshape((dim1*dim2, dim3)) and 
-        # geographic_datacube_flat = datacube.reshape((dim1_geo*dim2_geo, dim3)) so that geographic_datacube_flat = datacube_flat[indexes,:]
-        n_neighbors = 1
-        dist, indexes = tree.kneighbors(xy, n_neighbors)
-
-        # We can mask the data by allowing points within a radius of 2x the resolution
-        mask_nn = dist > 2*resolution
-        
-        return transform, height, width, indexes, suffix, mask_nn
+        return Taff, transform, height, width, suffix
 
     @staticmethod
-    def write_datacube_ENVI(memmap_gen_params, nodata, transform, datacube_path, wavelengths, fwhm, metadata, interleave, crs):
-        """_summary_
-
-        :param ortho_datacube: _description_
-        :type ortho_datacube: _type_
-        :param nodata: _description_
-        :type nodata: _type_
-        :param transform: _description_
-        :type transform: _type_
-        :param datacube_path: _description_
-        :type datacube_path: _type_
-        :param wavelengths: _description_
-        :type wavelengths: _type_
-        :param fwhm: _description_
-        :type fwhm: _type_
-        :param envi_hdr_dict: _description_
-        :type envi_hdr_dict: _type_
+    def cube_to_raster_bins(coords, raster_transform_method, resolution):
+        """Alternative to cube_to_raster_grid for resolutions coarser than the ground sampling distance. Instead of picking the nearest
+        intersection for each cell, each intersection is assigned to the cell it falls in (one linear pass over the points), so that
+        all pixels can be aggregated with aggregate_bins. No search tree is needed.
+
+        :param coords: Projected coordinates (e.g. UTM 32 east and north) of ray intersections
+        :type coords: ndarray(n, 2)
+        :param raster_transform_method: How the raster grid is calculated, either "north_east" or "minimal_rectangle"
+        :type raster_transform_method: string
+        :param resolution: The ground resolution in meters
+        :type resolution: float
+        :return: transform, height, width, indexes of the intersection closest to each cell centre (used for ancillary data), suffix, mask of empty cells and the cell of each intersection (-1 if outside)
+        :rtype: Affine, int, int, ndarray(height*width, 1), string, ndarray(height*width, 1), ndarray(n)
         """
+        Taff, transform, height, width, suffix = GeoSpatialAbstractionHSI.raster_grid_definition(coords, raster_transform_method, resolution)
 
-        nx = memmap_gen_params['height']
-        mx = memmap_gen_params['width']
-        k = memmap_gen_params['datacube'].shape[1] # is collapsed datacube
+        # Map intersections to the orthographic pixel grid
+        x_p = np.vstack((coords[:, 0], coords[:, 1], np.ones(coords.shape[0])))
+        x_r = np.linalg.solve(Taff, x_p)
 
-        dtype_cube = memmap_gen_params['datacube'].dtype # is collapsed datacube
+        col = np.floor(x_r[0, :]).astype(np.int64)
+        row = np.floor(x_r[1, :]).astype(np.int64)
 
-        # Make some simple modifications
-        data_file_path = datacube_path + '.' + interleave
-        header_file_path = datacube_path + '.hdr'
-        
+        inside = (col >= 0) & (col < width) & (row >= 0) & (row < height)
 
-        if os.path.exists(data_file_path):
-            os.remove(data_file_path)
-            os.remove(header_file_path)
+        bin_cells = np.where(inside, row*width + col, -1)
 
-        
-        # Create metadata for the output raster dataset
-        crs_gdal = osr.SpatialReference()
-        
-        crs_gdal.ImportFromEPSG(int(crs.split(':')[1]))
+        n_cells = height*width
 
-        # Create 1x1x1 dummy file to exploit builtin driver
-        with rasterio.open(data_file_path, 'w', driver='ENVI', height=1, width=1, count=1, crs=crs, dtype=dtype_cube, transform=transform, nodata=nodata) as dst:
-            pass
+        count = np.bincount(bin_cells[inside], minlength=n_cells)
 
-        # Then remove 
-        os.remove(data_file_path)
+        mask_bins = (count == 0).reshape((-1, 1))
 
-        header = sp.io.envi.read_envi_header(datacube_path + '.hdr') # Open for extraction
-        
-        # Since dummy image was made as 1x1x1 data cube
-        metadata_dim = {
-            'lines': nx,
-            'samples': mx,
-            'bands': k
-        }
+        # The intersection closest to the cell centre represents the cell for the ancillary data (e.g. pixel number, time)
+        dist_centre = (x_r[0, :] - col - 0.5)**2 + (x_r[1, :] - row - 0.5)**2
+        point_idx = np.arange(coords.shape[0])[inside]
+        order = np.lexsort((dist_centre[inside], bin_cells[inside]))
+        cells_sorted = bin_cells[inside][order]
+        is_first = np.concatenate(([True], cells_sorted[1:] != cells_sorted[:-1]))
 
-        # Write all meta data to header
-        for meta_key, value in metadata_dim.items():
-            header[meta_key] = value
-
-        # Reshape the ortho_datacube to (nx, mx, k)
-        #ortho_datacube_reshaped = ortho_datacube.transpose(1, 2, 0)
-
-        # Create the output raster dataset
-        # Create ENVI image without using a context manager
-        dst = envi.create_image(datacube_path + '.hdr', interleave='bsq', metadata=header, force=True)
-
-        mm = dst.open_memmap(writable=True)
-
-        GeoSpatialAbstractionHSI.write_datacube_memmap(memmap_array=mm, **memmap_gen_params)
-        
-        header = sp.io.envi.read_envi_header(datacube_path + '.hdr') # Open for extraction
-        header.pop('band names')
-
-        # Nobody in the history of the world could have come up with a more annoying bug.
-        # Apparently, the CRS string is written with white spaces by rasterio/GDAL, wheras it should have none.
-        header['coordinate system string'] = '{' + ",".join(header['coordinate system string']) + '}'
-        
-        # Write all meta_data to header
-        for meta_key, value in metadata.items():
-            header[meta_key] = value
-
-        sp.io.envi.write_envi_header(fileName=header_file_path, header_dict=header)
-
-    @staticmethod
-    def write_ancillary_ENVI(anc_data, nodata, transform, anc_path, metadata, interleave, crs):
-        """_summary_
-
-        :param anc_data: An ancilliary data cube 
-        :type anc_data: j x m x n where j are the number of bands, and m, n are the raster dimensions 
-        :param nodata: _description_
-        :type nodata: _type_
-        :param transform: _description_
-        :type transform: _type_
-        :param datacube_path: _description_
-        :type datacube_path: _type_
-        :param metadata: _description_
-        :type metadata: _type_
-        :param interleave: _description_
-        :type interleave: _type_
-        :param crs: _description_
-        :type crs: _type_
-        """
-        nx = anc_data.shape[1]
-        mx = anc_data.shape[2]
-        k = anc_data.shape[0]
-
-        # Make some simple modifications
-        data_file_path = anc_path + '.' + interleave
-        header_file_path = anc_path + '.hdr'
-
-        if os.path.exists(data_file_path):
-            os.remove(data_file_path)
-            os.remove(header_file_path)
-
-        # Hack to exploit rasterio's generation of map info
-
-        # Clean the files generated by rasterio
-        def write_band(args):
-            band_data, index, dst = args
-            dst.write(band_data, index + 1)
-
-        # Assuming ortho_datacube is a 3D NumPy array with shape (k, nx, mx)
-        with rasterio.open(data_file_path, 'w', driver='ENVI', height=nx, width=mx, count=k, crs=crs, dtype=anc_data.dtype, transform=transform, nodata=nodata) as dst:
-            # Create a ThreadPoolExecutor with as many threads as bands
-            with ThreadPoolExecutor(max_workers=k) as executor:
-                # Use executor.map to parallelize the band writing process
-                executor.map(write_band, [(band_data, i, dst) for i, band_data in enumerate(anc_data)])
-            
-        
-        header = sp.io.envi.read_envi_header(anc_path + '.hdr') # Open for modif
-
-        header.pop('band names') # Remove defaults
+        indexes = np.zeros(n_cells, dtype=np.int64)
+        indexes[cells_sorted[is_first]] = point_idx[order[is_first]]
 
-        for meta_key, value in metadata.items():
-            header[meta_key] = value
-
-        sp.io.envi.write_envi_header(fileName=header_file_path, header_dict=header)
+        return transform, height, width, indexes.reshape((-1, 1)), suffix, mask_bins, bin_cells
 
     @staticmethod
-    def write_ancillary_ENVI_envi(nodata, transform, anc_path, metadata, interleave, crs, memmap_gen_params):
-        """_summary_
-
-        :param anc_data: An ancilliary data cube 
-        :type anc_data: j x m x n where j are the number of bands, and m, n are the raster dimensions 
-        :param nodata: _description_
-        :type nodata: _type_
-        :param transform: _description_
-        :type transform: _type_
-        :param datacube_path: _description_
-        :type datacube_path: _type_
-        :param metadata: _description_
-        :type metadata: _type_
-        :param interleave: _description_
-        :type interleave: _type_
-        :param crs: _description_
-        :type crs: _type_
+    def aggregate_bins(datacube, bin_cells, n_cells, method):
+        """Aggregates all pixels falling in each cell, one band at a time
+
+        :param datacube: Collapsed datacube
+        :type datacube: ndarray(n, k)
+        :param bin_cells: The cell of each pixel (-1 if outside grid)
+        :type bin_cells: ndarray(n)
+        :param n_cells: Number of cells (height*width)
+        :type n_cells: int
+        :param method: 'mean' or 'median'
+        :type method: string
+        :return: The aggregated datacube, zero in empty cells
+        :rtype: ndarray(n_cells, k)
         """
-        nx = memmap_gen_params['height']
-        mx = memmap_gen_params['width']
-        k = memmap_gen_params['datacube'].shape[1] # is collapsed datacube
-
-        dtype_cube = memmap_gen_params['datacube'].dtype # is collapsed datacube
-        # Make some simple modifications
-        data_file_path = anc_path + '.' + interleave
-        header_file_path = anc_path + '.hdr'
-
-        #if os.path.exists(header_file_path):
-        #    return
-        
-
-        if os.path.exists(data_file_path):
-            os.remove(data_file_path)
-            os.remove(header_file_path)
+        k = datacube.shape[1]
+        inside = bin_cells >= 0
+        cells = bin_cells[inside]
+
+        count = np.bincount(cells, minlength=n_cells)
+
+        datacube_agg = np.zeros((n_cells, k), dtype=datacube.dtype)
+
+        if method == 'mean':
+            for band in range(k):
+                band_sum = np.bincount(cells, weights=datacube[:, band][inside], minlength=n_cells)
+                band_mean = band_sum/np.maximum(count, 1)
+                if np.issubdtype(datacube.dtype, np.integer):
+                    band_mean = np.round(band_mean)
+                datacube_agg[:, band] = band_mean
+
+        elif method == 'median':
+            # Pixels of a cell are consecutive after sorting by cell, and the median is in the middle of each run
+            start = np.concatenate(([0], np.cumsum(count)[:-1]))
+            nonempty = count > 0
+            idx_low = (start + (count - 1)//2)[nonempty]
+            idx_high = (start + count//2)[nonempty]
+            for band in range(k):
+                band_values = datacube[:, band][inside]
+                band_sorted = band_values[np.lexsort((band_values, cells))]
+                band_median = 0.5*(band_sorted[idx_low].astype(np.float64) + band_sorted[idx_high])
+                if np.issubdtype(datacube.dtype, np.integer):
+                    band_median = np.round(band_median)
+                datacube_agg[nonempty, band] = band_median
+        else:
+            raise ValueError(f'Unknown aggregation method {method}, use either mean or median')
 
+        return datacube_agg
 
-        # Create metadata for the output raster dataset
-        crs_gdal = osr.SpatialReference()
-        
-        crs_gdal.ImportFromEPSG(int(crs.split(':')[1]))
+    @staticmethod
+    def cube_to_raster_grid(coords, raster_transform_method, resolution):
+        """Function that takes projected coordinates (e.g. UTM 32 east and north) of ray intersections and computes an image grid
 
-        # Create 1x1x1 dummy file to exploit builtin driver
-        with rasterio.open(data_file_path, 'w', driver='ENVI', height=1, width=1, count=1, crs=crs, dtype=dtype_cube, transform=transform, nodata=nodata) as dst:
-            pass
+        :param coords: _description_
+        :type coords: _type_
+        :param raster_transform_method: How the raster grid is calculated. "north_east" is standard and defines a rectangle along north/east. "minimal_rectangle" is memory optimal as it finds the smallest enclosing rectangle that wraps the points.
+        :type raster_transform_method: _type_
+        :param resolution: _description_
+        :type resolution: _type_
+        :return: _description_
+        :rtype: _type_
+        """
 
-        # Then remove 
-        os.remove(data_file_path)
 
-        # Open for extraction
-        header = sp.io.envi.read_envi_header(anc_path + '.hdr')
+        Taff, transform, height, width, suffix = GeoSpatialAbstractionHSI.raster_grid_definition(coords, raster_transform_method, resolution)
 
-        # Since dummy image was made as 1x1x1 data cube
-        metadata_dim = {
-            'lines': nx,
-            'samples': mx,
-            'bands': k
-        }
+        dist, indexes = GeoSpatialAbstractionHSI.nearest_in_window(coords, Taff, 0, height, 0, width, resolution)
 
-        # Write all dimensions to header
-        for meta_key, value in metadata_dim.items():
-            header[meta_key] = value
+        # We can mask the data by allowing points within a radius of 2x the resolution
+        mask_nn = dist > 2*resolution
         
-        # Create ENVI image without using a context manager
-        dst = envi.create_image(anc_path + '.hdr', interleave='bsq', metadata=header, force=True)
+        return transform, height, width, indexes, suffix, mask_nn
+
+    @staticmethod
+    def nearest_in_window(coords, Taff, row_start, row_stop, col_start, col_stop, resolution):
+        """Finds the nearest intersection point of each cell in a window of a raster grid
+
+        :param coords: Projected coordinates (e.g. UTM 32 east and north) of ray intersections
+        :type coords: ndarray(n, 2)
+        :param Taff: The affine transform of the grid as 3x3 matrix, see raster_grid_definition
+        :type Taff: ndarray(3, 3)
+        :param row_start: First row of the window
+        :type row_start: int
+        :param row_stop: Row after the window
+        :type row_stop: int
+        :param col_start: First column of the window
+        :type col_start: int
+        :param col_stop: Column after the window
+        :type col_stop: int
+        :param resolution: The ground resolution in meters
+        :type resolution: float
+        :return: The distance to and index (in coords) of the nearest point of each cell of the window, row by row
+        :rtype: ndarray(h*w, 1), ndarray(h*w, 1)
+        """
+        # Define local orthographic pixel grid. Pixel centers reside at half coordinates.
+        xi, yi = np.meshgrid(np.arange(col_start, col_stop) + 0.5, 
+                                np.arange(row_start, row_stop) + 0.5)
+        # To get homogeneous vector (not an actual z coordinate)
+        zi = np.ones(xi.shape)
+
+        # Form homogeneous vectors (allows translation by multiplication)
+        x_r = np.vstack((xi.flatten(), yi.flatten(), zi.flatten())).T
 
-        mm = dst.open_memmap(writable=True)
+        # Map orthographic pixels to projected system
+        x_p = np.matmul(Taff, x_r.T).T 
 
-        # Write to the memory map
-        GeoSpatialAbstractionHSI.write_datacube_memmap(memmap_array=mm, **memmap_gen_params)
+        # Make a point vector of grid points to be used in nearest neighbor
+        xy = np.vstack((x_p[:,0].flatten(), x_p[:,1].flatten())).T
         
-        header = sp.io.envi.read_envi_header(anc_path + '.hdr') # Open for extraction
-        header.pop('band names')
+        # Define NN search tree from intersection points
+        tree = NearestNeighbors(radius=resolution).fit(coords)
 
-        # Nobody in the history of the world could have come up with a more annoying bug.
-        # Apparently, the CRS string is written with white spaces by rasterio/GDAL, wheras it should have none.
-        header['coordinate system string'] = '{' + ",".join(header['coordinate system string']) + '}'
+        # Calculate the nearest intersection point (in "coords") for each grid cell ("xy").
         
-        # Write all meta_data to header
-        for meta_key, value in metadata.items():
-            header[meta_key] = value
+        # Here we only use one neighbor, and indexes is a vector of len(xy) where an element indexes(i)
+        # says that the closest point to xy[i] is coords[indexes[i]]. Since coords is just a flattened/reshaped version of intersection points
+        #, the data cube can be resampled by datacube_flat=datacube.reshape((dim1*dim2, dim3)) and 
+        # geographic_datacube_flat = datacube.reshape((dim1_geo*dim2_geo, dim3)) so that geographic_datacube_flat = datacube_flat[indexes,:]
+        n_neighbors = 1
+        dist, indexes = tree.kneighbors(xy, n_neighbors)
 
-        sp.io.envi.write_envi_header(fileName=header_file_path, header_dict=header)
+        return dist, indexes
 
+    @staticmethod
+    def _set_descriptions_and_tags(dst, band_names, tags):
+        if band_names is not None:
+            for i, band_name in enumerate(band_names):
+                dst.set_band_description(i + 1, band_name)
+        if tags is not None:
+            dst.update_tags(**tags)
 
+    @staticmethod
+    def _copy_to_COG(src, cog_path, cog_options):
+        """Translates a dataset (or path) to a COG using GDAL's COG driver (requires GDAL>=3.1)"""
+        if os.path.exists(cog_path):
+            os.remove(cog_path)
+
+        rasterio.shutil.copy(src, cog_path, driver='COG',
+                             COMPRESS=cog_options['compress'],
+                             PREDICTOR=cog_options['predictor'],
+                             BLOCKSIZE=int(cog_options['blocksize']),
+                             OVERVIEW_RESAMPLING=cog_options['overview_resampling'],
+                             BIGTIFF='IF_SAFER')
 
     @staticmethod
-    def compare_hsi_composite_with_rgb_mosaic(hsi_composite_path, ref_ortho_reshaped_path):
-        """Compares an HSI orthomosaic """
-        
-        
+    def read_ancillary_band(anc_path, band_name):
+        """Reads one named band of the orthorectified ancillary data, written either as ENVI, GeoTIFF/COG or Zarr. The layers are either in one file,
+        or in one file per layer (ancillary_encoding = per_layer) in which case scaled integers are decoded.
+
+        :param anc_path: Path to the ancillary data without extension
+        :type anc_path: string
+        :param band_name: The band name, e.g. 'pixel_nr_grid'
+        :type band_name: string
+        :return: The band (float64) and the nodata value
+        :rtype: ndarray(h, w), float
+        """
+        # Bands of multi-band layers are named <layer>_<i>
+        layer_name, _, band_number = band_name.rpartition('_')
+        if not band_number.isdigit():
+            layer_name = band_name
+
+        for path in [anc_path, anc_path + '_' + band_name, anc_path + '_' + layer_name]:
+            if os.path.exists(path + '.hdr'):
+                anc_image_object = sp.io.envi.open(path + '.hdr')
+                anc_band_list = anc_image_object.metadata['band names']
+                if band_name not in anc_band_list:
+                    continue
+                band_index = anc_band_list.index(band_name)
+
+                anc_nodata = float(anc_image_object.metadata['data ignore value'])
+                gain = float(anc_image_object.metadata.get('data gain values', ['1']*len(anc_band_list))[band_index])
+                offset = float(anc_image_object.metadata.get('data offset values', ['0']*len(anc_band_list))[band_index])
+
+                band = anc_image_object[:,:, band_index].squeeze()
+            elif os.path.exists(path + '.tif'):
+                with rasterio.open(path + '.tif') as src:
+                    anc_band_list = list(src.descriptions)
+                    if band_name not in anc_band_list:
+                        continue
+                    band_index = anc_band_list.index(band_name)
+
+                    anc_nodata = float(src.nodata)
+                    gain = src.scales[band_index]
+                    offset = src.offsets[band_index]
+
+                    band = src.read(band_index + 1)
+            elif os.path.exists(path + '.zarr'):
+                import zarr
+                
+                # Only the chunks of the band are read
+                array = zarr.open_array(path + '.zarr', mode='r')
+                anc_band_list = array.attrs['band_names']
+                if band_name not in anc_band_list:
+                    continue
+                band_index = anc_band_list.index(band_name)
+
+                anc_nodata = float(array.fill_value)
+                gain = array.attrs.get('scale_factor', 1)
+                offset = array.attrs.get('add_offset', 0)
+
+                band = array[band_index]
+            else:
+                continue
 
+            band = band.astype(np.float64)
+            if gain != 1 or offset != 0:
+                valid = band != anc_nodata
+                band[valid] = gain*band[valid] + offset
+
+            return band, anc_nodata
         
-        # The RGB orthomosaic after reshaping (the reference)
-        raster_rgb = gdal.Open(ref_ortho_reshaped_path, gdal.GA_Update)
-        xoff1, a1, b1, yoff1, d1, e1 = raster_rgb.GetGeoTransform()  # This should be equal
-        raster_rgb_array = np.array(raster_rgb.ReadAsArray())
-        R = raster_rgb_array[0, :, :].reshape((raster_rgb_array.shape[1], raster_rgb_array.shape[2], 1))
-        G = raster_rgb_array[1, :, :].reshape((raster_rgb_array.shape[1], raster_rgb_array.shape[2], 1))
-        B = raster_rgb_array[2, :, :].reshape((raster_rgb_array.shape[1], raster_rgb_array.shape[2], 1))
-        # del raster_array1
-        ortho_rgb = np.concatenate((R, G, B), axis=2)
-        rgb_image = Imcol(ortho_rgb)
+        raise FileNotFoundError(f'No ancillary data with the band {band_name} was found for {anc_path}')
 
-        # The HSI composite raster (the match)
+    @staticmethod
+    def hsi_composite_luma(hsi_composite_path):
+        """Reads an HSI composite and enhances it for matching with RGB data. The colours are stretched to the 95th percentile, 
+        converted to luma with an inverse gamma and equalized with CLAHE.
+        
+        :param hsi_composite_path: Path to the composite
+        :type hsi_composite_path: string
+        :return: The luma and the geotransform of the composite
+        :rtype: ndarray(h, w, 1), tuple
+        """
         raster_hsi = gdal.Open(hsi_composite_path)
         raster_hsi_array = np.array(raster_hsi.ReadAsArray())
-        xoff2, a2, b2, yoff2, d2, e2 = raster_hsi.GetGeoTransform()
         transform_pixel_projected = raster_hsi.GetGeoTransform()
         R = raster_hsi_array[0, :, :].reshape((raster_hsi_array.shape[1], raster_hsi_array.shape[2], 1))
         G = raster_hsi_array[1, :, :].reshape((raster_hsi_array.shape[1], raster_hsi_array.shape[2], 1))
@@ -893,10 +1290,6 @@ class GeoSpatialAbstractionHSI():
         ortho_hsi[ortho_hsi == 0] = 255
         hsi_image = Imcol(ortho_hsi)
 
-        # Adjust Clahe
-        #hsi_image.clahe_adjustment()
-        rgb_image.clahe_adjustment()
-
         # Radiance is equivalent to a linear "color space". We run it through an inverse gamma to match the RGB data
         hsi_image.to_luma(gamma=False, 
                           image_array = hsi_image.image_array, 
@@ -905,11 +1298,43 @@ class GeoSpatialAbstractionHSI():
         
         hsi_image.clahe_adjustment(is_luma = True)
 
+        return hsi_image.luma_array, transform_pixel_projected
+
+    @staticmethod
+    def compare_hsi_composite_with_rgb_mosaic(hsi_composite_path, ref_ortho_reshaped, tile_size = None, max_keypoints_per_tile = None):
+        """Compares an HSI orthomosaic with the reference orthomosaic resampled to its grid, given as a path or as an array (3, h, w) 
+        (see ReferenceRasterService). See compute_sift_difference for the tiling options"""
+        
+        # The RGB orthomosaic after reshaping (the reference)
+        if isinstance(ref_ortho_reshaped, str):
+            raster_rgb = gdal.Open(ref_ortho_reshaped, gdal.GA_Update)
+            raster_rgb_array = np.array(raster_rgb.ReadAsArray())
+        else:
+            raster_rgb_array = ref_ortho_reshaped
+        R = raster_rgb_array[0, :, :].reshape((raster_rgb_array.shape[1], raster_rgb_array.shape[2], 1))
+        G = raster_rgb_array[1, :, :].reshape((raster_rgb_array.shape[1], raster_rgb_array.shape[2], 1))
+        B = raster_rgb_array[2, :, :].reshape((raster_rgb_array.shape[1], raster_rgb_array.shape[2], 1))
+        # del raster_array1
+        ortho_rgb = np.concatenate((R, G, B), axis=2)
+        rgb_image = Imcol(ortho_rgb)
+
+        # The HSI composite raster (the match)
+        hsi_luma, transform_pixel_projected = GeoSpatialAbstractionHSI.hsi_composite_luma(hsi_composite_path)
+        xoff2, a2, b2, yoff2, d2, e2 = transform_pixel_projected
+
+        # Adjust Clahe
+        rgb_image.clahe_adjustment()
+
         # Tendency that RGB images are already transformed
         rgb_image.to_luma(gamma=False, image_array= rgb_image.clahe_adjusted)
 
-        uv_vec_hsi, uv_vec_rgb, diff_AE_pixels = GeoSpatialAbstractionHSI.compute_sift_difference(hsi_image.luma_array, rgb_image.luma_array)
+        uv_vec_hsi, uv_vec_rgb, diff_AE_pixels = GeoSpatialAbstractionHSI.compute_sift_difference(hsi_luma, 
+                                                                                                  rgb_image.luma_array, 
+                                                                                                  tile_size=tile_size, 
+                                                                                                  max_keypoints_per_tile=max_keypoints_per_tile)
+
 
+        print(f'{os.path.basename(hsi_composite_path)}: {uv_vec_hsi.shape[0]} matches')
 
         image_resolution = a2
         diff_AE_meters = diff_AE_pixels*image_resolution
@@ -995,7 +1420,8 @@ class GeoSpatialAbstractionHSI():
                 # calculate the output transform matrix
 
                 if src.crs.is_geographic:
-                    tmp_file = 'tmp.tif'
+                    # Named after the output, so that chunks can be resampled in parallel
+                    tmp_file = os.path.splitext(outfile)[0] + '_tmp.tif'
 
                     # calculate the output transform matrix
                     dst_transform, dst_width, dst_height = calculate_default_transform(
@@ -1067,21 +1493,58 @@ class GeoSpatialAbstractionHSI():
                         resampling=Resampling.cubic)
 
     @staticmethod
-    def compute_sift_difference(gray1, gray2):
-        """Simply matches two grayscale images using SIFT"""
+    def match_sift(gray1, gray2, max_keypoints = 0):
+        """Matches two uint8 grayscale images with SIFT and FLANN, keeping matches that pass Lowe's ratio test
+
+        :param gray1: The match image (query)
+        :type gray1: ndarray(h1, w1) uint8
+        :param gray2: The reference image (train)
+        :type gray2: ndarray(h2, w2) uint8
+        :param max_keypoints: The number of strongest keypoints to retain per image, where 0 retains all, defaults to 0
+        :type max_keypoints: int, optional
+        :return: The matched pixel coordinates (u, v) in gray1 and gray2
+        :rtype: ndarray(n, 2), ndarray(n, 2)
+        """
+        uv_kp1, des1 = GeoSpatialAbstractionHSI.detect_sift(gray1, max_keypoints)
+        uv_kp2, des2 = GeoSpatialAbstractionHSI.detect_sift(gray2, max_keypoints)
 
-        gray1 = (gray1 - np.min(gray1)) / (np.max(gray1) - np.min(gray1))
-        gray2 = (gray2 - np.min(gray2)) / (np.max(gray2) - np.min(gray2))
+        idx1, idx2 = GeoSpatialAbstractionHSI.match_descriptors(des1, des2)
 
-        gray1 = (gray1 * 255).astype(np.uint8)
-        gray2 = (gray2 * 255).astype(np.uint8)
+        return uv_kp1[idx1], uv_kp2[idx2]
 
+    @staticmethod
+    def detect_sift(gray, max_keypoints = 0):
+        """Detects SIFT keypoints and computes their descriptors
+
+        :param gray: The image
+        :type gray: ndarray(h, w) uint8
+        :param max_keypoints: The number of strongest keypoints to retain, where 0 retains all, defaults to 0
+        :type max_keypoints: int, optional
+        :return: The pixel coordinates (u, v) and descriptors of the keypoints
+        :rtype: ndarray(n, 2), ndarray(n, 128) float32
+        """
+        sift = cv.SIFT_create(nfeatures=max_keypoints)
+        kp, des = sift.detectAndCompute(gray, None)
 
-        # Find the keypoints and descriptors with SIFT
-        sift = cv.SIFT_create()
-        kp2, des2 = sift.detectAndCompute(gray2, None)
-        kp1, des1 = sift.detectAndCompute(gray1, None)
+        if des is None:
+            return np.zeros((0, 2)), np.zeros((0, 128), dtype=np.float32)
+        
+        return np.array([k.pt for k in kp]).reshape((-1, 2)), des
 
+    @staticmethod
+    def match_descriptors(des1, des2):
+        """Matches SIFT descriptors with FLANN, keeping matches that pass Lowe's ratio test
+
+        :param des1: The descriptors of the match image (query)
+        :type des1: ndarray(n1, 128) float32
+        :param des2: The descriptors of the reference image (train)
+        :type des2: ndarray(n2, 128) float32
+        :return: The indices of the matched descriptors in des1 and des2
+        :rtype: ndarray(n,) int, ndarray(n,) int
+        """
+        # FLANN needs at least two candidates per keypoint for the ratio test
+        if des1.shape[0] < 2 or des2.shape[0] < 2:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
 
         FLANN_INDEX_KDTREE = 1
         index_params = dict(algorithm=FLANN_INDEX_KDTREE, trees=5)
@@ -1089,76 +1552,213 @@ class GeoSpatialAbstractionHSI():
         flann = cv.FlannBasedMatcher(index_params, search_params)
         matches = flann.knnMatch(des1, des2, k=2)
         
-        good = []
         # https://docs.opencv.org/4.x/dc/dc3/tutorial_py_matcher.html
         # store all the good matches as per Lowe's ratio test (0.7). 
         # Cranking up gives more. We changed 0.8 to 0.85 to get more matches
-        for m, n in matches:
-            if m.distance < 0.75 * n.distance:
-                good.append(m)
-
-        draw_params = dict(matchColor=(0, 255, 0),  # draw matches in green color
-                           flags=2)
-
-        diff_u = np.zeros(len(good))
-        diff_v = np.zeros(len(good))
-        uv_vec_hsi = np.zeros((len(good), 2))
-        uv_vec_rgb = np.zeros((len(good), 2))
-        for i in range(len(good)):
-            idx2 = good[i].trainIdx
-            idx1 = good[i].queryIdx
-            uv1 = kp1[idx1].pt  # Slit image
-            uv2 = kp2[idx2].pt  # Orthomosaic
-            uv_vec_hsi[i,:] = uv1
-            uv_vec_rgb[i,:] = uv2
-
-            ## Conversion to global coordinates
-            diff_u[i] = uv2[0] - uv1[0]
-            diff_v[i] = uv2[1] - uv1[1]
-
-        img3 = cv.drawMatches(gray1, kp1, gray2, kp2, good, None, **draw_params)
-        """plt.imshow(img3, 'gray')
-        plt.show()"""
-        print(len(good))
-##
+        good = [match[0] for match in matches if len(match) == 2 and match[0].distance < 0.75 * match[1].distance]
+
+        idx1 = np.array([m.queryIdx for m in good], dtype=np.int64) # Slit image
+        idx2 = np.array([m.trainIdx for m in good], dtype=np.int64) # Orthomosaic
+
+        return idx1, idx2
+
+    @staticmethod
+    def normalize_gray(gray):
+        """Stretches a single band image (h, w) or (h, w, 1) to the range of uint8, as needed by SIFT"""
+        gray = gray.reshape((gray.shape[0], gray.shape[1])).astype(np.float64)
+
+        gray = (gray - np.min(gray)) / (np.max(gray) - np.min(gray))
+
+        return (gray * 255).astype(np.uint8)
+
+    @staticmethod
+    def compute_sift_difference(gray1, gray2, tile_size = None, max_keypoints_per_tile = None):
+        """Matches two grayscale images of the same grid using SIFT. Without tile_size, the full images are matched at once.
+        With tile_size, the matching is coarse-to-fine: The images are reduced on a pyramid until they fit in one tile, where the global shift
+        between them is estimated. The match image is then divided into tiles, each matched to the shifted window of the reference image 
+        (with a margin of a quarter tile), so that the cost of a tile does not grow with the size of the images.
+
+        :param gray1: The match image (HSI composite)
+        :type gray1: ndarray(h, w)
+        :param gray2: The reference image
+        :type gray2: ndarray(h, w)
+        :param tile_size: The size of tiles in pixels, defaults to None
+        :type tile_size: int, optional
+        :param max_keypoints_per_tile: The number of strongest keypoints to retain per tile (or image), defaults to None (all)
+        :type max_keypoints_per_tile: int, optional
+        :return: The matched pixel coordinates (u, v) in gray1 and gray2 and the absolute difference in pixels
+        :rtype: ndarray(n, 2), ndarray(n, 2), ndarray(n,)
+        """
+
+        gray1 = GeoSpatialAbstractionHSI.normalize_gray(gray1)
+        gray2 = GeoSpatialAbstractionHSI.normalize_gray(gray2)
+
+        max_keypoints = 0 if max_keypoints_per_tile is None else int(max_keypoints_per_tile)
+
+        if tile_size is None:
+            uv_vec_hsi, uv_vec_rgb = GeoSpatialAbstractionHSI.match_sift(gray1, gray2, max_keypoints)
+        else:
+            tile_size = int(tile_size)
+            h, w = gray1.shape
+
+            # The coarsest level of the pyramid fits in one tile
+            n_levels = max(0, int(np.ceil(np.log2(max(h, w)/tile_size))))
+            coarse1, coarse2 = gray1, gray2
+            for _ in range(n_levels):
+                coarse1, coarse2 = cv.pyrDown(coarse1), cv.pyrDown(coarse2)
+
+            uv1_coarse, uv2_coarse = GeoSpatialAbstractionHSI.match_sift(coarse1, coarse2, max_keypoints)
+        
+            # The median is robust to mismatches. With too few matches, no shift is assumed
+            if uv1_coarse.shape[0] >= 4:
+                shift = np.round(np.median(uv2_coarse - uv1_coarse, axis=0)*2**n_levels).astype(np.int64)
+            else:
+                shift = np.zeros(2, dtype=np.int64)
+
+            margin = tile_size // 4
+
+            # No matches if the shifted windows of all tiles are outside the reference image
+            uv1_list = [np.zeros((0, 2))]
+            uv2_list = [np.zeros((0, 2))]
+            for row_start in range(0, h, tile_size):
+                for col_start in range(0, w, tile_size):
+                    tile1 = gray1[row_start:row_start + tile_size, col_start:col_start + tile_size]
+
+                    # The window of the reference image where the tile's features are expected
+                    row_start_2 = int(np.clip(row_start + shift[1] - margin, 0, h))
+                    row_stop_2 = int(np.clip(row_start + shift[1] + tile1.shape[0] + margin, 0, h))
+                    col_start_2 = int(np.clip(col_start + shift[0] - margin, 0, w))
+                    col_stop_2 = int(np.clip(col_start + shift[0] + tile1.shape[1] + margin, 0, w))
+
+                    if row_stop_2 - row_start_2 < 2 or col_stop_2 - col_start_2 < 2:
+                        continue
+
+                    tile2 = gray2[row_start_2:row_stop_2, col_start_2:col_stop_2]
+
+                    uv1, uv2 = GeoSpatialAbstractionHSI.match_sift(tile1, tile2, max_keypoints)
+
+                    uv1_list.append(uv1 + np.array([col_start, row_start]))
+                    uv2_list.append(uv2 + np.array([col_start_2, row_start_2]))
+
+            uv_vec_hsi = np.concatenate(uv1_list, axis=0)
+            uv_vec_rgb = np.concatenate(uv2_list, axis=0)
+
         # The absolute errors
+        diff_u = uv_vec_rgb[:, 0] - uv_vec_hsi[:, 0]
+        diff_v = uv_vec_rgb[:, 1] - uv_vec_hsi[:, 1]
         diff_AE = np.sqrt(diff_u ** 2 + diff_v ** 2)
         
         return uv_vec_hsi, uv_vec_rgb, diff_AE
 
 
-    def compute_reference_points_ecef(uv_vec_ref, transform_pixel_projected, dem_resampled_path, epsg_proj, epsg_geocsc=4978):
-    
-    
-        """Computes ECEF reference points from a features detected on the orthomosaic and the DEM"""
+    @staticmethod
+    def compute_reference_points_ecef(uv_vec_ref, transform_pixel_projected, dem_resampled, epsg_proj, epsg_geocsc=4978, dem_nodata=0):
+        """Computes ECEF reference points from a features detected on the orthomosaic and the DEM, given as a path to the resampled DEM 
+        or as an array (h, w) in the grid of the orthomosaic (see ReferenceRasterService). The DEM is read once and sampled with bilinear 
+        interpolation for all features, and all points are transformed in one call. Next to nodata (dem_nodata for an array, as filled by 
+        ReferenceRasterService.resample_to_grid, or the nodata of the file) the nearest cell is used"""
         x = uv_vec_ref[:, 0] # In range 0 -> w
         y = uv_vec_ref[:, 1] # In range 0 -> h
 
-        # Sample the terrain raster to get a projected position of data 
-        raster_dem = rasterio.open(dem_resampled_path)
         xoff, a, b, yoff, d, e = transform_pixel_projected
 
         # Convert the pixel coordinates into true coordinates (e.g. UTM N/E)
         xp = a * x + b * y + xoff
         yp = d * x + e * y + yoff
-        zp = np.zeros(yp.shape)
-        for i in range(xp.shape[0]):
-            temp = [x for x in raster_dem.sample([(xp[i], yp[i])])]
-            zp[i] = float(temp[0])
+
+        # Sample the terrain raster to get a projected position of data 
+        if isinstance(dem_resampled, str):
+            zp = GeoSpatialAbstractionHSI.sample_raster_bilinear(dem_resampled, xp, yp)
+        else:
+            # Pixel centers are at integer positions in the array
+            zp = GeoSpatialAbstractionHSI.bilinear_interpolate_valid(dem_resampled, x = x - 0.5, y = y - 0.5, nodata = dem_nodata)
 
         # Transform points to true 3D via pyproj
-        geocsc = CRS.from_epsg(epsg_geocsc)
-        proj = CRS.from_epsg(epsg_proj)
-        transformer = Transformer.from_crs(proj, geocsc)
-        ref_points_ecef = np.zeros((xp.shape[0], 3))
-        (x_ecef, y_ecef, z_ecef) = transformer.transform(xx=xp, yy=yp, zz=zp)
-
-        ref_points_ecef[:, 0] = x_ecef
-        ref_points_ecef[:, 1] = y_ecef
-        ref_points_ecef[:, 2] = z_ecef
+        ref_points_ecef = transform_points(np.vstack((xp, yp, zp)).T, epsg_proj, epsg_geocsc)
         
         return ref_points_ecef
 
+    @staticmethod
+    def sample_raster_bilinear(raster_path, xp, yp, band = 1):
+        """Samples a raster at points in its CRS with bilinear interpolation. Only the window covering the points is read (once)
+
+        :param raster_path: Path to the raster
+        :type raster_path: string
+        :param xp: The x coordinates (e.g. easting)
+        :type xp: ndarray(n,)
+        :param yp: The y coordinates (e.g. northing)
+        :type yp: ndarray(n,)
+        :param band: The band, defaults to 1
+        :type band: int, optional
+        :return: The sampled values
+        :rtype: ndarray(n,)
+        """
+        with rasterio.open(raster_path) as src:
+            c, a, b, f, d, e = src.transform.to_gdal()
+
+            # Fractional pixel coordinates with pixel centers at integer positions
+            det = a * e - b * d
+            cols = (e * (xp - c) - b * (yp - f)) / det - 0.5
+            rows = (a * (yp - f) - d * (xp - c)) / det - 0.5
+
+            col_start = int(np.clip(np.floor(cols.min()), 0, src.width - 1))
+            col_stop = int(np.clip(np.floor(cols.max()) + 2, col_start + 1, src.width))
+            row_start = int(np.clip(np.floor(rows.min()), 0, src.height - 1))
+            row_stop = int(np.clip(np.floor(rows.max()) + 2, row_start + 1, src.height))
+
+            window = Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+            data = src.read(band, window=window)
+            nodata = src.nodata
+
+        return GeoSpatialAbstractionHSI.bilinear_interpolate_valid(data, x = cols - col_start, y = rows - row_start, nodata = nodata)
+
+    @staticmethod
+    def bilinear_interpolate_valid(im, x, y, nodata = None):
+        """Bilinear interpolation of an image at fractional pixel positions (pixel centers at integer positions), clamped at the edges. 
+        Where any of the 4 neighbours is nodata, the nearest valid neighbour is used instead (nodata if there is none)
+
+        :param im: The image
+        :type im: ndarray(h, w)
+        :param x: The column positions
+        :type x: ndarray(n,)
+        :param y: The row positions
+        :type y: ndarray(n,)
+        :param nodata: The nodata value of the image, defaults to None
+        :type nodata: float, optional
+        :return: The interpolated values
+        :rtype: ndarray(n,)
+        """
+        x = np.clip(np.asarray(x, dtype=np.float64), 0, im.shape[1] - 1)
+        y = np.clip(np.asarray(y, dtype=np.float64), 0, im.shape[0] - 1)
+
+        x0 = np.clip(np.floor(x).astype(np.int64), 0, max(im.shape[1] - 2, 0))
+        y0 = np.clip(np.floor(y).astype(np.int64), 0, max(im.shape[0] - 2, 0))
+        x1 = np.minimum(x0 + 1, im.shape[1] - 1)
+        y1 = np.minimum(y0 + 1, im.shape[0] - 1)
+
+        fx = x - x0
+        fy = y - y0
+
+        Ia = im[y0, x0].astype(np.float64)
+        Ib = im[y1, x0].astype(np.float64)
+        Ic = im[y0, x1].astype(np.float64)
+        Id = im[y1, x1].astype(np.float64)
+
+        neighbours = np.stack((Ia, Ib, Ic, Id), axis=1)
+        weights = np.stack(((1 - fx) * (1 - fy), (1 - fx) * fy, fx * (1 - fy), fx * fy), axis=1)
+
+        values = np.sum(weights * neighbours, axis=1)
+
+        if nodata is not None:
+            is_valid_neighbour = neighbours != nodata
+            is_invalid = ~np.all(is_valid_neighbour, axis=1)
+            if np.any(is_invalid):
+                # The valid neighbour with the largest weight is the nearest one
+                nearest = np.argmax(np.where(is_valid_neighbour[is_invalid], weights[is_invalid], -1), axis=1)
+                values[is_invalid] = neighbours[is_invalid][np.arange(nearest.size), nearest]
+
+        return values
+
     def compute_position_orientation_features(uv_vec_hsi, pixel_nr_image, unix_time_image, position_ecef, quaternion_ecef, time_pose, nodata):
         """Returns the positions, orientations and pixel numbers corresponding to the features. 
         Also computes a feature mask identifying features that are invalid"""
@@ -1237,6 +1837,378 @@ class GeoSpatialAbstractionHSI():
 
     
 
+# One output of a ProductPlan. gather(block) returns the values of the valid cells of a block as (n_valid, n_bands), 
+# which are encoded as round(value/scale) to dtype and written with writer[rows, cols, bands] = grid
+PlannedProduct = namedtuple('PlannedProduct', ['name', 'n_bands', 'dtype', 'nodata', 'gather', 'writer', 'scale'])
+
+class ProductPlan():
+    """The products resampled from one lookup table (datacube, RGB composite, ancillary layers, ...). Rather than each product traversing 
+    the lookup table on its own, the grid is traversed once in blocks of columns, and all products are gathered from the source pixels of the block
+    while these are in memory. Each product is written to its own file."""
+    def __init__(self, index_grid, mask, n_pixels, block_size_GB, window_offset = None):
+        """
+        :param index_grid: The source pixel of each cell, as line*n_pixels + pixel
+        :type index_grid: ndarray(height, width)
+        :param mask: Cells without data (1)
+        :type mask: ndarray(height, width)
+        :param n_pixels: Number of pixels per line of the source
+        :type n_pixels: int
+        :param block_size_GB: Approximate memory of the gathered values and grids of one block
+        :type block_size_GB: float
+        :param window_offset: If given, the grid is a window at (row, column) of the files, which are shared with other chunks of a transect. 
+                              Only the valid cells are then written, and the writers are left open, defaults to None
+        :type window_offset: tuple, optional
+        """
+        self.index_grid = index_grid
+        self.mask = mask
+        self.n_pixels = n_pixels
+        self.block_size_GB = block_size_GB
+        self.window_offset = window_offset
+        self.products = []
+
+    def add_product(self, name, n_bands, dtype, nodata, gather, writer, scale = 1):
+        """Adds an output to the plan
+
+        :param name: Name of the product, used in messages
+        :type name: string
+        :param n_bands: Number of bands
+        :type n_bands: int
+        :param dtype: The data type written to file
+        :type dtype: numpy dtype
+        :param nodata: The value of cells without data
+        :type nodata: number
+        :param gather: Returns the values of the valid cells of a _GatherBlock as (n_valid, n_bands)
+        :type gather: function
+        :param writer: Assigned to as writer[rows, cols, bands] = grid (or merged into, see window_offset), and closed when the plan has run
+        :type writer: _ENVIWriter, _GTiffWriter or _ZarrWriter
+        :param scale: Values are stored as round(value/scale), defaults to 1
+        :type scale: float, optional
+        """
+        self.products.append(PlannedProduct(name=name, n_bands=n_bands, dtype=np.dtype(dtype), nodata=nodata, 
+                                            gather=gather, writer=writer, scale=scale))
+
+    def block_width(self):
+        """The number of columns per block, such that the gathered values and grids of all products fit in the block size"""
+        height, width = self.index_grid.shape
+
+        # Gathered values are at most float64, in addition to the grid in the dtype of the product
+        bytes_per_cell = sum(product.n_bands*(8 + product.dtype.itemsize) for product in self.products) + 3*8
+
+        block_width = int(np.clip((self.block_size_GB*1024**3) / (height*bytes_per_cell), 1, width))
+
+        # Blocks aligned with the chunks of chunked stores (e.g. Zarr) write whole chunks
+        chunk_width = max([getattr(product.writer, 'chunk_width', 1) for product in self.products], default=1)
+        if block_width < width:
+            block_width = max(chunk_width, block_width - block_width % chunk_width)
+
+        return block_width
+
+    def run(self):
+        """Gathers and writes all products, one block of columns at a time"""
+        height, width = self.index_grid.shape
+
+        block_width = self.block_width()
+
+        for col_start in range(0, width, block_width):
+            col_end = min(col_start + block_width, width)
+
+            valid = self.mask[:, col_start:col_end] != 1
+            rows, cols = np.nonzero(valid)
+
+            block = _GatherBlock(source_pixel = self.index_grid[:, col_start:col_end][valid].astype(np.int64), 
+                                 n_pixels = self.n_pixels, 
+                                 cell = rows*width + cols + col_start)
+
+            for product in self.products:
+                grid = np.full((height, col_end - col_start, product.n_bands), product.nodata, dtype=product.dtype)
+
+                grid[valid] = _encode_values(product.gather(block), product.dtype, product.scale, product.nodata)
+
+                if self.window_offset is None:
+                    product.writer[:, col_start:col_end, :] = grid
+                else:
+                    # Cells of the window that belong to other chunks are left as they are
+                    row_offset, col_offset = self.window_offset
+                    product.writer.merge((slice(row_offset, row_offset + height), slice(col_offset + col_start, col_offset + col_end)), grid, valid)
+
+                del grid
+            del block
+
+        # Writers shared by the chunks of a transect are closed when all chunks are written
+        if self.window_offset is None:
+            for product in self.products:
+                product.writer.close()
+
+class _GatherBlock():
+    """The source of the valid cells of one block of the grid, given to the gather function of each product"""
+    def __init__(self, source_pixel, n_pixels, cell):
+        self.source_pixel = source_pixel
+        self.source_line = source_pixel // n_pixels
+        self.cell = cell
+        self._cube_rows = {}
+
+    def cube_rows(self, datacube, per_cell = False):
+        """The rows of a collapsed datacube (n, k). The gather is done once per block and datacube, and shared by the products using it (e.g. the datacube and the RGB composite).
+        If per_cell, row i of the datacube belongs to cell i of the grid (as after aggregate_bins)."""
+        key = (id(datacube), per_cell)
+        if key not in self._cube_rows:
+            self._cube_rows[key] = datacube[self.cell if per_cell else self.source_pixel, :]
+        return self._cube_rows[key]
+
+    def layer_values(self, data, is_per_line):
+        """The values of an ancillary layer, either per line (n_lines (x j)) or per pixel (n_lines x n_pixels (x j))"""
+        if is_per_line:
+            return data.reshape((data.shape[0], -1))[self.source_line, :]
+        else:
+            n_cells_source = data.shape[0]*data.shape[1]
+            return data.reshape((n_cells_source, -1))[self.source_pixel, :]
+
+    def cell_values(self, grid_values):
+        """The values of a layer already defined on the (flattened) grid"""
+        return grid_values.reshape((-1, 1))[self.cell, :]
+
+def _encode_values(values, dtype, scale, nodata):
+    """Encodes values as round(value/scale) to an integer dtype, clipping out of range values so that the nodata value remains reserved"""
+    if scale != 1:
+        values = values/scale
+
+    if np.issubdtype(dtype, np.integer) and not np.issubdtype(values.dtype, np.integer):
+        info = np.iinfo(dtype)
+        value_min = info.min + 1 if nodata == info.min else info.min
+        value_max = info.max - 1 if nodata == info.max else info.max
+        values = np.clip(np.round(values), value_min, value_max)
+
+        # Undefined values (e.g. NaN) have no integer representation
+        values = np.where(np.isfinite(values), values, nodata)
+
+    return values
+
+class _ENVIWriter():
+    """An ENVI file written through a memory map of shape (rows, cols, bands). The header is made by rasterio (for the map info and CRS),
+    and completed with the metadata when closed."""
+    def __init__(self, path, height, width, n_bands, dtype, nodata, transform, crs, metadata, interleave, prefill = False):
+        self.path = path
+        self.metadata = metadata
+
+        # Make some simple modifications
+        data_file_path = path + '.' + interleave
+        self.header_file_path = path + '.hdr'
+
+        if os.path.exists(data_file_path):
+            os.remove(data_file_path)
+            os.remove(self.header_file_path)
+
+        # Create 1x1x1 dummy file to exploit builtin driver
+        with rasterio.open(data_file_path, 'w', driver='ENVI', height=1, width=1, count=1, crs=crs, dtype=dtype, transform=transform, nodata=nodata) as dst:
+            pass
+
+        # Then remove 
+        os.remove(data_file_path)
+
+        header = sp.io.envi.read_envi_header(self.header_file_path) # Open for extraction
+
+        # Since dummy image was made as 1x1x1 data cube
+        metadata_dim = {
+            'lines': height,
+            'samples': width,
+            'bands': n_bands
+        }
+
+        # Write all dimensions to header
+        for meta_key, value in metadata_dim.items():
+            header[meta_key] = value
+
+        # Create ENVI image without using a context manager
+        dst = envi.create_image(self.header_file_path, interleave='bsq', metadata=header, force=True)
+
+        self.mm = dst.open_memmap(writable=True)
+
+        if prefill:
+            # Cells that are never written (e.g. between the chunks of a transect) are nodata
+            self.mm[...] = nodata
+
+    def __setitem__(self, key, value):
+        self.mm[key] = value
+
+    def merge(self, key, value, valid):
+        """Writes the valid (rows, cols) cells of value to the window key, leaving the other cells of the window as they are"""
+        window = self.mm[key]
+        window[valid] = value[valid]
+
+    def close(self):
+        del self.mm
+
+        header = sp.io.envi.read_envi_header(self.header_file_path) # Open for extraction
+        header.pop('band names')
+
+        # Nobody in the history of the world could have come up with a more annoying bug.
+        # Apparently, the CRS string is written with white spaces by rasterio/GDAL, wheras it should have none.
+        header['coordinate system string'] = '{' + ",".join(header['coordinate system string']) + '}'
+        
+        # Write all meta_data to header
+        for meta_key, value in self.metadata.items():
+            header[meta_key] = value
+
+        sp.io.envi.write_envi_header(fileName=self.header_file_path, header_dict=header)
+
+class _GTiffWriter():
+    """A GeoTIFF written one window at a time. Without cog_options it is a plain GeoTIFF. Otherwise it is tiled, and either compressed 
+    (compress=True) or converted to a cloud optimized GeoTIFF with overviews by GDAL when closed (is_cog=True)."""
+    def __init__(self, path, height, width, n_bands, dtype, nodata, transform, crs, band_names = None, tags = None, scale = 1, cog_options = None, is_cog = False, compress = False):
+        self.tif_path = path + '.tif'
+        self.cog_options = cog_options
+        self.is_cog = is_cog
+        
+        if cog_options is None:
+            self.dst_path = self.tif_path
+            creation_options = {}
+        else:
+            blocksize = int(cog_options['blocksize'])
+            creation_options = {'tiled': True, 'blockxsize': blocksize, 'blockysize': blocksize, 'BIGTIFF': 'IF_SAFER'}
+
+            if is_cog:
+                # Compressed by the COG driver
+                self.dst_path = path + '_tmp.tif'
+            else:
+                self.dst_path = self.tif_path
+                if compress:
+                    predictor = cog_options['predictor']
+                    if predictor == 'YES':
+                        # As chosen by the COG driver: horizontal differencing for integers and floating point prediction for floats
+                        predictor = 2 if np.issubdtype(dtype, np.integer) else 3
+                    creation_options.update({'compress': cog_options['compress'], 'predictor': predictor})
+
+        # Opened for reading as well, since windows of transects are merged (unwritten blocks read as nodata)
+        self.dst = rasterio.open(self.dst_path, 'w+', driver='GTiff', height=height, width=width, count=n_bands, dtype=dtype,
+                                 crs=crs, transform=transform, nodata=nodata, **creation_options)
+        
+        GeoSpatialAbstractionHSI._set_descriptions_and_tags(self.dst, band_names, tags)
+
+        if scale != 1:
+            # Decoding of scaled integers
+            self.dst.scales = [scale]*n_bands
+            self.dst.offsets = [0]*n_bands
+
+        self.window_writer = _RasterWindowWriter(self.dst)
+
+    def __setitem__(self, key, value):
+        self.window_writer[key] = value
+
+    def merge(self, key, value, valid):
+        self.window_writer.merge(key, value, valid)
+
+    def close(self):
+        self.dst.close()
+
+        if self.is_cog:
+            GeoSpatialAbstractionHSI._copy_to_COG(self.dst_path, self.tif_path, self.cog_options)
+
+            os.remove(self.dst_path)
+
+class _ZarrWriter():
+    """A chunked, compressed Zarr array of shape (bands, rows, cols) on the local file system, chunked both spatially and spectrally.
+    Writers in several processes may write to disjoint chunks of the same store, and analysis code can read any window without reading the whole raster.
+    The georeferencing is stored in the attributes, with the dimension names used by xarray."""
+    def __init__(self, path, height, width, n_bands, dtype, nodata, transform, crs, zarr_options, band_names = None, attrs = None, scale = 1):
+        try:
+            import zarr
+            from numcodecs import Blosc
+        except ImportError:
+            raise ImportError('Writing Zarr requires the zarr package (pip install "zarr<3"), alternatively use another output_format')
+
+        blocksize = int(zarr_options['blocksize'])
+        band_chunk = min(int(zarr_options['band_chunk']), n_bands)
+
+        self.chunk_width = blocksize
+
+        compressor = Blosc(cname=zarr_options['compressor'], clevel=int(zarr_options['clevel']), shuffle=Blosc.SHUFFLE)
+
+        self.array = zarr.open_array(path + '.zarr', mode='w', shape=(n_bands, height, width), chunks=(band_chunk, blocksize, blocksize),
+                                     dtype=dtype, fill_value=nodata, compressor=compressor)
+        
+        self.array.attrs.update({'_ARRAY_DIMENSIONS': ['band', 'y', 'x'],
+                                 'crs': str(crs),
+                                 'crs_wkt': pyproj.CRS.from_user_input(crs).to_wkt(),
+                                 'transform': [float(val) for val in np.array(transform)[0:6]],
+                                 'nodata': _to_attribute(nodata),
+                                 'scale_factor': float(scale),
+                                 'add_offset': 0.0})
+        
+        if band_names is not None:
+            self.array.attrs['band_names'] = list(band_names)
+        
+        if attrs is not None:
+            self.array.attrs.update({key: _to_attribute(value) for key, value in attrs.items()})
+
+    def __setitem__(self, key, value):
+        rows, cols = key[0], key[1]
+        bands = key[2] if len(key) > 2 else slice(None)
+
+        # From (rows, cols, bands) to (bands, rows, cols)
+        self.array[bands, rows, cols] = np.transpose(value, axes=[2, 0, 1])
+
+    def merge(self, key, value, valid):
+        """Writes the valid (rows, cols) cells of value to the window key, leaving the other cells of the window as they are"""
+        rows, cols = key[0], key[1]
+
+        window = np.transpose(self.array[:, rows, cols], axes=[1, 2, 0])
+        window[valid] = value[valid]
+
+        self[rows, cols] = window
+
+    def close(self):
+        pass
+
+def _to_attribute(value):
+    """Converts metadata to JSON serializable attributes"""
+    if isinstance(value, np.ndarray):
+        return value.reshape(-1).tolist()
+    elif isinstance(value, np.generic):
+        return value.item()
+    return value
+
+class _RasterWindowWriter():
+    """Wraps an open rasterio dataset so that it can be assigned to like a (rows, cols, bands) memory map, 
+    allowing the product plan to stream blocks to GeoTIFF"""
+    def __init__(self, dst):
+        self.dst = dst
+
+    def __setitem__(self, key, value):
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        rows, cols = key[0], key[1]
+
+        # A slice of bands may be given, otherwise all bands are written
+        bands = key[2] if len(key) > 2 else slice(None)
+        indexes = [i + 1 for i in range(self.dst.count)[bands]]
+
+        window = Window.from_slices(rows, cols, height=self.dst.height, width=self.dst.width)
+
+        # From (rows, cols, bands) to rasterio-friendly (bands, rows, cols)
+        self.dst.write(np.transpose(value, axes=[2, 0, 1]).astype(self.dst.dtypes[0]), indexes=indexes, window=window)
+
+    def merge(self, key, value, valid):
+        """Writes the valid (rows, cols) cells of value to the window key, leaving the other cells of the window as they are"""
+        rows, cols = key[0], key[1]
+
+        window = Window.from_slices(rows, cols, height=self.dst.height, width=self.dst.width)
+
+        merged = np.transpose(self.dst.read(window=window), axes=[1, 2, 0])
+        merged[valid] = value[valid]
+
+        self[rows, cols] = merged
+
+def _open_writer(writers, writer_class, **kwargs):
+    """Creates a writer, or returns the open writer of the same type and path if writers are shared by the chunks of a transect"""
+    if writers is None:
+        return writer_class(**kwargs)
+    
+    key = (writer_class.__name__, kwargs['path'])
+    if key not in writers:
+        writers[key] = writer_class(**kwargs)
+
+    return writers[key]
+
 def _get_max_value(dtype):
     """Gets the maximum value for a given data type.
 
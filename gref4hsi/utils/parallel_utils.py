@@ -0,0 +1,186 @@
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import h5py
+import numpy as np
+from shapely.geometry import MultiPoint
+
+from gref4hsi.utils.transform_utils import transform_points
+
+
+# A unit of work for the scheduler. phase is either 'io' or 'cpu' and is used to mix the two kinds of work across workers
+ChunkTask = namedtuple('ChunkTask', ['key', 'args', 'memory_bytes', 'phase'])
+
+
+def physical_memory_bytes():
+    """Total physical memory. Falls back to 8 GB where it can not be determined (e.g. on Windows without psutil)"""
+    try:
+        return os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        pass
+    try:
+        import psutil
+        return psutil.virtual_memory().total
+    except ImportError:
+        return 8*1024**3
+
+def estimate_orthorectification_cost(h5_filename, h5_paths, anc_dict, config_ortho, config_crs, lut_cached):
+    """Estimates the peak memory and the I/O and CPU work of orthorectifying one chunk. Only dataset shapes and a few
+    edge points of the point cloud are read from the h5 file, so the estimate is cheap compared with the processing.
+
+    The processing has two phases, and the peak is the largest of them:
+        1) Geometry: radiance cube, point cloud (ECEF and projected), search tree and grid coordinates
+        2) Resampling: radiance cube, ancillary layers and lookup table, and one column block of all products (see ProductPlan)
+
+    :param h5_filename: Path to the h5 file of the chunk
+    :type h5_filename: string
+    :param h5_paths: h5 paths of the point cloud ('point_cloud') and radiance cube ('radiance_cube', alternatively 'raw_cube')
+    :type h5_paths: dict
+    :param anc_dict: The ancillary layers
+    :type anc_dict: dict
+    :param config_ortho: The relevant configurations for orthorectification
+    :type config_ortho: SettingsOrthorectification
+    :param config_crs: The coordinate reference systems
+    :type config_crs: SettingsCRS
+    :param lut_cached: Whether the resampling lookup table exists, in which case the geometry phase is skipped
+    :type lut_cached: bool
+    :return: Peak memory in bytes, bytes read/written and CPU work (in arbitrary units)
+    :rtype: float, float, float
+    """
+    with h5py.File(h5_filename, 'r') as f:
+        # An uncalibrated cube is calibrated on first use, in which case only the raw cube exists
+        if h5_paths['radiance_cube'] in f:
+            cube = f[h5_paths['radiance_cube']]
+        else:
+            cube = f[h5_paths['raw_cube']]
+        n, m, k = cube.shape
+        itemsize = cube.dtype.itemsize
+
+        # The extent of the ortho grid follows from the edges of the point cloud
+        points = f[h5_paths['point_cloud']]
+        step = max(1, n // 50)
+        edge_points = np.concatenate((points[::step, 0, :],
+                                      points[::step, -1, :],
+                                      points[-1:, 0, :],
+                                      points[-1:, -1, :]), axis = 0).reshape((-1, 3))
+
+        n_anc_bands = 0
+        anc_bytes = 0
+        for attribute_name, h5_hierarchy_item_path in anc_dict.items():
+            if attribute_name != 'folder' and h5_hierarchy_item_path in f:
+                shape = f[h5_hierarchy_item_path].shape
+                n_anc_bands += 1 if (len(shape) <= 1 or (len(shape) == 2 and shape[1] == m)) else shape[-1]
+
+                # Per-line layers are not broadcast to pixels
+                layer_bytes = np.prod(shape)*f[h5_hierarchy_item_path].dtype.itemsize
+                anc_bytes += layer_bytes
+
+    edge_points_proj = transform_points(edge_points, config_crs.epsg_geocsc, config_crs.epsg_proj)
+    east, north = edge_points_proj[:, 0], edge_points_proj[:, 1]
+
+    if config_ortho.raster_transform_method == 'minimal_rectangle':
+        grid_area = MultiPoint(np.vstack((east, north)).T).minimum_rotated_rectangle.area
+    else:
+        grid_area = (east.max() - east.min())*(north.max() - north.min())
+
+    n_cells = grid_area/config_ortho.ground_resolution**2
+    n_points = n*m
+
+    # The column blocks of ProductPlan are bounded by the block size
+    block_bytes = min(config_ortho.chunk_size_cube_GB*1024**3, n_cells*(k + 3 + len(config_ortho.band_math) + n_anc_bands)*(8 + itemsize))
+
+    cube_bytes = n_points*k*itemsize
+    lut_bytes = n_cells*(8 + 1)
+
+    if lut_cached:
+        geometry_bytes = 0
+    else:
+        # ECEF and projected points, search tree over 2D points, grid coordinates (several float64 copies) and the neighbour search output
+        geometry_bytes = cube_bytes + 2*n_points*3*8 + 2*n_points*2*8 + n_cells*(6*8 + 2*8 + 8 + 8) + lut_bytes
+
+    resampling_bytes = cube_bytes + anc_bytes + lut_bytes + block_bytes
+
+    peak_bytes = max(geometry_bytes, resampling_bytes)
+
+    io_bytes = cube_bytes + anc_bytes + n_cells*n_anc_bands*8 + n_cells*(3 + (0 if config_ortho.resample_rgb_only else k))*itemsize + n_cells*len(config_ortho.band_math)*4
+
+    if lut_cached:
+        cpu_work = n_cells
+    else:
+        # Building and querying the search tree dominates
+        cpu_work = (n_points + n_cells)*np.log2(max(n_points, 2))
+
+    return peak_bytes, io_bytes, cpu_work
+
+def classify_phases(io_bytes, cpu_work):
+    """Labels each task as 'io' or 'cpu' heavy relative to the other tasks, by the ratio of bytes moved to computations
+
+    :param io_bytes: Bytes read/written per task
+    :type io_bytes: list
+    :param cpu_work: CPU work per task
+    :type cpu_work: list
+    :return: The phase of each task
+    :rtype: list
+    """
+    if len(io_bytes) == 0:
+        return []
+
+    ratio = np.array(io_bytes, dtype=np.float64)/np.maximum(np.array(cpu_work, dtype=np.float64), 1)
+    ratio_median = np.median(ratio)
+
+    return ['io' if r >= ratio_median else 'cpu' for r in ratio]
+
+def _next_admissible(pending, running, ram_budget_bytes):
+    """Picks the next task fitting within the memory budget, preferring the phase least represented among running tasks"""
+    memory_in_use = sum(task.memory_bytes for task in running)
+
+    candidates = [task for task in pending if memory_in_use + task.memory_bytes <= ram_budget_bytes]
+
+    if len(candidates) == 0:
+        if len(running) == 0:
+            # A task exceeding the budget on its own is run alone
+            task = pending[0]
+            print(f'Warning: {task.key} is estimated to need {task.memory_bytes/1024**3:.1f} GB, exceeding the budget of {ram_budget_bytes/1024**3:.1f} GB. Running it alone.')
+            return task
+        return None
+
+    n_running_phase = {'io': 0, 'cpu': 0}
+    for task in running:
+        n_running_phase[task.phase] += 1
+
+    # Stable, so the original order decides between tasks of the same phase
+    return min(candidates, key=lambda task: n_running_phase[task.phase])
+
+def run_memory_budgeted(worker_fn, tasks, n_workers, ram_budget_bytes, on_result):
+    """Runs tasks in a process pool, admitting a task only when the summed peak memory estimate of running tasks stays within the budget.
+    Results are handled in the calling process as they complete, which makes it the single writer of shared files.
+
+    :param worker_fn: Module level function called as worker_fn(*task.args)
+    :type worker_fn: function
+    :param tasks: The tasks, in the preferred order
+    :type tasks: list of ChunkTask
+    :param n_workers: Maximal number of processes
+    :type n_workers: int
+    :param ram_budget_bytes: Memory budget for all running tasks
+    :type ram_budget_bytes: float
+    :param on_result: Called as on_result(task, result) when a task completes
+    :type on_result: function
+    """
+    pending = list(tasks)
+    running = {}
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        while len(pending) > 0 or len(running) > 0:
+            while len(pending) > 0 and len(running) < n_workers:
+                task = _next_admissible(pending, running.values(), ram_budget_bytes)
+                if task is None:
+                    break
+                pending.remove(task)
+                running[executor.submit(worker_fn, *task.args)] = task
+
+            done, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+
+            for future in done:
+                task = running.pop(future)
+                on_result(task, future.result())
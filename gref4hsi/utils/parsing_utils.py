@@ -2,6 +2,7 @@
 import sys
 import os
 import configparser
+import re
 from os import path
 from pathlib import Path
 
@@ -16,12 +17,12 @@ import pandas as pd
 import pymap3d as pm
 from scipy.spatial.transform import Slerp
 from scipy.interpolate import interp1d
-from pyproj import CRS, Transformer
 
 # Local modules
 from gref4hsi.utils.geometry_utils import CameraGeometry, GeoPose
 from gref4hsi.utils.geometry_utils import rot_mat_ned_2_ecef, interpolate_poses
 from gref4hsi.utils.geometry_utils import dem_2_mesh, crop_geoid_to_pose
+from gref4hsi.utils.transform_utils import transform_points
 
 
 class Hyperspectral:
@@ -274,19 +275,10 @@ def ardupilot_extract_pose(config, iniPath):
     epsg_geocsc = config['General']['modelepsg']
     # Transform the mesh points to ECEF.
 
-    geocsc = CRS.from_epsg(epsg_geocsc)
-    proj = CRS.from_epsg(epsg_proj)
-    transformer = Transformer.from_crs(proj, geocsc)
-
     points_proj = position_nav_interpolated
 
-    lat = points_proj[:, 0].reshape((-1, 1))
-    lon = points_proj[:, 1].reshape((-1, 1))
-    hei = points_proj[:, 2].reshape((-1, 1))
-
-    (x_ecef, y_ecef, z_ecef) = transformer.transform(xx=lat, yy=lon, zz=hei)
-
-    pos_geocsc = np.concatenate((x_ecef.reshape((-1,1)), y_ecef.reshape((-1,1)), z_ecef.reshape((-1,1))), axis = 1)
+    # Latitude, longitude, height to ECEF
+    pos_geocsc = transform_points(points_proj, epsg_proj, epsg_geocsc)
 
     #dlogr = DataLogger(pose_path, 'CameraLabel, X, Y, Z, Roll, Pitch, Yaw, RotX, RotY, RotZ')
 
@@ -635,6 +627,77 @@ def export_model(config_file):
 
 
 
+def config_option(config, section, key, fallback = None):
+    """Reads an option without the inline comment of the configuration template, e.g. "1 # Number of chunks..." gives "1"
+
+    :param config: The mission configuration
+    :type config: configparser.ConfigParser
+    :param section: The section, e.g. 'Orthorectification'
+    :type section: string
+    :param key: The option
+    :type key: string
+    :param fallback: Returned if the option is missing, defaults to None (raises KeyError)
+    :type fallback: string, optional
+    :return: The value
+    :rtype: string
+    """
+    try:
+        value = config[section][key]
+    except KeyError:
+        if fallback is None:
+            raise
+        return fallback
+
+    return value.split('#')[0].strip()
+
+def tryint(s):
+    try:
+        return int(s)
+    except:
+        return s
+
+def alphanum_key(s):
+    """ Turn a string into a list of string and number chunks.
+        "z23a" -> ["z", 23, "a"]
+    """
+    return [ tryint(c) for c in re.split('([0-9]+)', s) ]
+
+def infer_transect_structure(h5_dir, h5_folder_time_scanlines):
+    """Groups the h5 files (chunks) into transects, where consecutive chunks less than a second apart belong to the same transect
+
+    :param h5_dir: Folder with the h5 files
+    :type h5_dir: string
+    :param h5_folder_time_scanlines: h5 path to the timestamps of the scanlines
+    :type h5_folder_time_scanlines: string
+    :return: The paths of the chunks of each transect number, in chronological order
+    :rtype: dict
+    """
+    transect = {}
+    timestamp_prev = -1
+    
+    h5_filenames = [filename for filename in os.listdir(h5_dir) if filename.endswith('.h5')]
+
+    for h5_filename in sorted(h5_filenames, key=alphanum_key):
+        h5_filepath = os.path.join(h5_dir, h5_filename)
+        # Assuming sorted dir
+        time_scanlines = Hyperspectral.get_dataset(h5_filename=h5_filepath,
+                                                                dataset_name= h5_folder_time_scanlines)
+        
+        if timestamp_prev == -1: # meaning first iteration
+            current_transect_nr = 0
+            transect[current_transect_nr] = [h5_filepath]
+            
+        elif time_scanlines[0] - timestamp_prev < 1: # second (arbitrary)
+            transect[current_transect_nr].append(h5_filepath)
+        else: # New transect
+            current_transect_nr += 1
+            transect[current_transect_nr] = [h5_filepath]
+
+        timestamp_prev = time_scanlines[-1]
+
+    return transect
+
+
 if __name__ == "__main__":
     # Here we could set up necessary steps on a high level. 
     args = sys.argv[1:]
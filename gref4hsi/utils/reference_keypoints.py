@@ -0,0 +1,265 @@
+import os
+
+import h5py
+import numpy as np
+import rasterio
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import calculate_default_transform, Resampling
+from rasterio.windows import Window
+
+from gref4hsi.utils.colours import Image as Imcol
+from gref4hsi.utils.gis_tools import GeoSpatialAbstractionHSI
+
+
+# The keypoints of the reference orthomosaic are stored in one h5 file, sorted by the tile they were detected in.
+# The offsets of the tiles make up a grid index, so that the keypoints within a footprint are read as one slice per row of tiles
+INDEX_NAME = 'reference_keypoints.h5'
+
+# SIFT needs some context around a tile to detect keypoints near its edges
+TILE_MARGIN = 32
+
+
+def reference_keypoint_index_path(config):
+    """The keypoint index lives next to the reference data resampled for each chunk
+
+    :param config: The mission configuration
+    :type config: configparser.ConfigParser
+    :return: Path to the h5 file
+    :rtype: string
+    """
+    return os.path.join(config['Absolute Paths']['ref_ortho_reshaped'], INDEX_NAME)
+
+def _index_key(ref_ortho_path, crs, resolution, tile_size, max_keypoints_per_tile):
+    """Identifies the reference orthomosaic (by path, size and modification time) and the settings of an index"""
+    stat = os.stat(ref_ortho_path)
+    return f'{os.path.abspath(ref_ortho_path)}|{stat.st_size}|{stat.st_mtime_ns}|{crs}|{resolution}|{tile_size}|{max_keypoints_per_tile}'
+
+def _pixel_coordinates(transform, x, y):
+    """The (fractional) column and row of map coordinates in the grid of an affine transform"""
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    cols_rows = np.linalg.solve(np.array([[transform.a, transform.b], [transform.d, transform.e]]),
+                                np.vstack(((x - transform.c).reshape(-1), (y - transform.f).reshape(-1))))
+    return cols_rows[0].reshape(x.shape), cols_rows[1].reshape(y.shape)
+
+def build_reference_keypoint_index(ref_ortho_path, index_path, crs, resolution, tile_size = 1024, max_keypoints_per_tile = 2000):
+    """Detects SIFT keypoints over the reference orthomosaic once per mission. The orthomosaic is resampled on the fly to the CRS and resolution
+    of the HSI composites and processed tile by tile (CLAHE and luma as in compare_hsi_composite_with_rgb_mosaic), retaining the strongest keypoints of each tile.
+    An existing index of the same orthomosaic and settings is reused.
+
+    :param ref_ortho_path: Path to the reference orthomosaic
+    :type ref_ortho_path: string
+    :param index_path: Path to the h5 file
+    :type index_path: string
+    :param crs: The projected CRS of the HSI composites, e.g. 'EPSG:25832'
+    :type crs: string
+    :param resolution: The ground resolution of the HSI composites
+    :type resolution: float
+    :param tile_size: The size of tiles in pixels, defaults to 1024
+    :type tile_size: int, optional
+    :param max_keypoints_per_tile: The number of strongest keypoints to retain per tile, defaults to 2000
+    :type max_keypoints_per_tile: int, optional
+    """
+    key = _index_key(ref_ortho_path, crs, resolution, tile_size, max_keypoints_per_tile)
+
+    if os.path.exists(index_path):
+        with h5py.File(index_path, 'r') as f:
+            if f.attrs.get('key', '') == key:
+                return
+
+    print('Detecting keypoints in the reference orthomosaic')
+
+    with rasterio.open(ref_ortho_path) as src:
+        transform, width, height = calculate_default_transform(src.crs, crs, src.width, src.height, *src.bounds, resolution=resolution)
+
+        with WarpedVRT(src, crs=crs, transform=transform, width=width, height=height, resampling=Resampling.cubic) as vrt:
+            n_tile_rows = int(np.ceil(height/tile_size))
+            n_tile_cols = int(np.ceil(width/tile_size))
+
+            xy_list = []
+            des_list = []
+            tile_offsets = np.zeros(n_tile_rows*n_tile_cols + 1, dtype=np.int64)
+
+            for tile_row in range(n_tile_rows):
+                for tile_col in range(n_tile_cols):
+                    row_start, col_start = tile_row*tile_size, tile_col*tile_size
+                    row_stop, col_stop = min(row_start + tile_size, height), min(col_start + tile_size, width)
+
+                    # The tile with a margin, clipped to the orthomosaic
+                    row_start_m, col_start_m = max(row_start - TILE_MARGIN, 0), max(col_start - TILE_MARGIN, 0)
+                    row_stop_m, col_stop_m = min(row_stop + TILE_MARGIN, height), min(col_stop + TILE_MARGIN, width)
+
+                    rgb = vrt.read(indexes=[1, 2, 3], window=Window(col_start_m, row_start_m, col_stop_m - col_start_m, row_stop_m - row_start_m))
+
+                    uv = np.zeros((0, 2))
+                    des = np.zeros((0, 128), dtype=np.float32)
+
+                    # Tiles without data (outside the orthomosaic) are skipped
+                    if np.any(rgb != 0):
+                        rgb_image = Imcol(np.ascontiguousarray(rgb.transpose((1, 2, 0))))
+                        rgb_image.clahe_adjustment()
+                        rgb_image.to_luma(gamma=False, image_array= rgb_image.clahe_adjusted)
+
+                        uv, des = GeoSpatialAbstractionHSI.detect_sift((rgb_image.luma_array*255).astype(np.uint8), max_keypoints_per_tile)
+
+                        # Keypoints in the margin belong to the neighbouring tiles
+                        uv = uv + np.array([col_start_m, row_start_m])
+                        in_tile = (uv[:, 0] >= col_start) & (uv[:, 0] < col_stop) & (uv[:, 1] >= row_start) & (uv[:, 1] < row_stop)
+                        uv, des = uv[in_tile], des[in_tile]
+
+                    # Pixel coordinates refer to pixel centres
+                    x, y = transform * (uv[:, 0] + 0.5, uv[:, 1] + 0.5)
+                    xy_list.append(np.vstack((x, y)).T)
+                    des_list.append(des)
+
+                    tile = tile_row*n_tile_cols + tile_col
+                    tile_offsets[tile + 1] = tile_offsets[tile] + uv.shape[0]
+
+    # Written under a temporary name, so that an interrupted build is not taken for a valid index
+    tmp_path = index_path + '.tmp'
+    with h5py.File(tmp_path, 'w') as f:
+        f.create_dataset('xy', data=np.concatenate(xy_list, axis=0).reshape((-1, 2)))
+        f.create_dataset('descriptors', data=np.concatenate(des_list, axis=0).reshape((-1, 128)).astype(np.float32))
+        f.create_dataset('tile_offsets', data=tile_offsets)
+        f.attrs['transform'] = np.array(transform)[0:6]
+        f.attrs['width'] = width
+        f.attrs['height'] = height
+        f.attrs['tile_size'] = tile_size
+        f.attrs['n_tile_cols'] = n_tile_cols
+        f.attrs['key'] = key
+    os.replace(tmp_path, index_path)
+
+    print(f'Indexed {tile_offsets[-1]} keypoints of the reference orthomosaic')
+
+def query_reference_keypoints(index_path, bounds):
+    """Reads the keypoints within a bounding box. Only the rows of tiles overlapping the box are read, as one slice each.
+
+    :param index_path: Path to the h5 file
+    :type index_path: string
+    :param bounds: The bounding box (min_x, min_y, max_x, max_y) in the CRS of the index
+    :type bounds: tuple
+    :return: The map coordinates and descriptors of the keypoints
+    :rtype: ndarray(n, 2), ndarray(n, 128) float32
+    """
+    min_x, min_y, max_x, max_y = bounds
+
+    with h5py.File(index_path, 'r') as f:
+        transform = rasterio.Affine(*f.attrs['transform'])
+        tile_size = int(f.attrs['tile_size'])
+        n_tile_cols = int(f.attrs['n_tile_cols'])
+        n_tile_rows = (f['tile_offsets'].shape[0] - 1)//n_tile_cols
+        tile_offsets = f['tile_offsets'][()]
+
+        cols, rows = _pixel_coordinates(transform, np.array([min_x, max_x, min_x, max_x]), np.array([min_y, min_y, max_y, max_y]))
+
+        tile_col_start = int(np.clip(np.floor(cols.min()/tile_size), 0, n_tile_cols))
+        tile_col_stop = int(np.clip(np.floor(cols.max()/tile_size) + 1, 0, n_tile_cols))
+        tile_row_start = int(np.clip(np.floor(rows.min()/tile_size), 0, n_tile_rows))
+        tile_row_stop = int(np.clip(np.floor(rows.max()/tile_size) + 1, 0, n_tile_rows))
+
+        xy_list = []
+        des_list = []
+        for tile_row in range(tile_row_start, tile_row_stop):
+            # The tiles of a row are stored consecutively
+            start = tile_offsets[tile_row*n_tile_cols + tile_col_start]
+            stop = tile_offsets[tile_row*n_tile_cols + tile_col_stop]
+            if stop > start:
+                xy_list.append(f['xy'][start:stop])
+                des_list.append(f['descriptors'][start:stop])
+
+    if len(xy_list) == 0:
+        return np.zeros((0, 2)), np.zeros((0, 128), dtype=np.float32)
+
+    xy = np.concatenate(xy_list, axis=0)
+    des = np.concatenate(des_list, axis=0)
+
+    inside = (xy[:, 0] >= min_x) & (xy[:, 0] <= max_x) & (xy[:, 1] >= min_y) & (xy[:, 1] <= max_y)
+
+    return xy[inside], des[inside]
+
+def detect_sift_tiled(gray, tile_size, max_keypoints_per_tile):
+    """Detects SIFT keypoints tile by tile, retaining the strongest keypoints of each tile
+
+    :param gray: The image
+    :type gray: ndarray(h, w) uint8
+    :param tile_size: The size of tiles in pixels
+    :type tile_size: int
+    :param max_keypoints_per_tile: The number of strongest keypoints to retain per tile
+    :type max_keypoints_per_tile: int
+    :return: The pixel coordinates (u, v) and descriptors of the keypoints
+    :rtype: ndarray(n, 2), ndarray(n, 128) float32
+    """
+    h, w = gray.shape
+
+    uv_list = []
+    des_list = []
+    for row_start in range(0, h, tile_size):
+        for col_start in range(0, w, tile_size):
+            row_stop, col_stop = min(row_start + tile_size, h), min(col_start + tile_size, w)
+            row_start_m, col_start_m = max(row_start - TILE_MARGIN, 0), max(col_start - TILE_MARGIN, 0)
+
+            uv, des = GeoSpatialAbstractionHSI.detect_sift(gray[row_start_m:row_stop + TILE_MARGIN, col_start_m:col_stop + TILE_MARGIN], max_keypoints_per_tile)
+
+            uv = uv + np.array([col_start_m, row_start_m])
+            in_tile = (uv[:, 0] >= col_start) & (uv[:, 0] < col_stop) & (uv[:, 1] >= row_start) & (uv[:, 1] < row_stop)
+
+            uv_list.append(uv[in_tile])
+            des_list.append(des[in_tile])
+
+    return np.concatenate(uv_list, axis=0), np.concatenate(des_list, axis=0)
+
+def compare_hsi_composite_with_keypoint_index(hsi_composite_path, index_path, tile_size = 1024, max_keypoints_per_tile = 2000):
+    """Compares an HSI composite with the reference keypoints within its footprint, as an alternative to compare_hsi_composite_with_rgb_mosaic
+    that needs no resampling of the reference orthomosaic per chunk. The footprint is widened by a quarter tile to allow for misregistration,
+    and matches deviating more than that from the median shift are discarded.
+
+    :param hsi_composite_path: Path to the composite
+    :type hsi_composite_path: string
+    :param index_path: Path to the keypoint index (see build_reference_keypoint_index)
+    :type index_path: string
+    :param tile_size: The size of tiles in pixels, defaults to 1024
+    :type tile_size: int, optional
+    :param max_keypoints_per_tile: The number of strongest keypoints to retain per tile, defaults to 2000
+    :type max_keypoints_per_tile: int, optional
+    :return: The matched pixel coordinates (u, v) in the composite and of the reference keypoints (in the pixel grid of the composite),
+    the absolute difference in meters and the geotransform of the composite
+    :rtype: ndarray(n, 2), ndarray(n, 2), ndarray(n,), tuple
+    """
+    hsi_luma, transform_pixel_projected = GeoSpatialAbstractionHSI.hsi_composite_luma(hsi_composite_path)
+    gray = GeoSpatialAbstractionHSI.normalize_gray(hsi_luma)
+    h, w = gray.shape
+
+    transform = rasterio.Affine.from_gdal(*transform_pixel_projected)
+    image_resolution = np.sqrt(np.abs(transform.a*transform.e - transform.b*transform.d))
+
+    uv_kp_hsi, des_hsi = detect_sift_tiled(gray, tile_size, max_keypoints_per_tile)
+
+    # The footprint of the composite (which may be rotated) with a margin
+    margin = tile_size // 4
+    x, y = transform * (np.array([-margin, w + margin, -margin, w + margin]), np.array([-margin, -margin, h + margin, h + margin]))
+
+    xy_ref, des_ref = query_reference_keypoints(index_path, (x.min(), y.min(), x.max(), y.max()))
+
+    # Into the pixel grid of the composite (pixel coordinates refer to pixel centres)
+    u_ref, v_ref = _pixel_coordinates(transform, xy_ref[:, 0], xy_ref[:, 1])
+    uv_kp_ref = np.vstack((u_ref - 0.5, v_ref - 0.5)).T
+
+    idx_hsi, idx_ref = GeoSpatialAbstractionHSI.match_descriptors(des_hsi, des_ref)
+
+    uv_vec_hsi = uv_kp_hsi[idx_hsi].reshape((-1, 2))
+    uv_vec_ref = uv_kp_ref[idx_ref].reshape((-1, 2))
+
+    # Reference points are sampled from the DEM in the grid of the composite
+    is_valid = (uv_vec_ref[:, 0] >= 0) & (uv_vec_ref[:, 0] <= w - 1) & (uv_vec_ref[:, 1] >= 0) & (uv_vec_ref[:, 1] <= h - 1)
+
+    if np.any(is_valid):
+        shift = np.median(uv_vec_ref[is_valid] - uv_vec_hsi[is_valid], axis=0)
+        is_valid &= np.all(np.abs(uv_vec_ref - uv_vec_hsi - shift) <= margin, axis=1)
+
+    uv_vec_hsi = uv_vec_hsi[is_valid]
+    uv_vec_ref = uv_vec_ref[is_valid]
+
+    print(f'{os.path.basename(hsi_composite_path)}: {uv_vec_hsi.shape[0]} matches')
+
+    diff_AE_meters = np.sqrt(np.sum((uv_vec_ref - uv_vec_hsi)**2, axis=1))*image_resolution
+
+    return uv_vec_hsi, uv_vec_ref, diff_AE_meters, transform_pixel_projected
@@ -0,0 +1,146 @@
+from collections import OrderedDict
+
+import numpy as np
+import rasterio
+from rasterio.warp import reproject, transform_bounds, Resampling
+from rasterio.windows import Window, from_bounds
+
+
+# The services of each process, so that chunks processed by the same (worker) process share the cached blocks
+_SERVICES = {}
+
+
+def reference_raster_service(path):
+    """The service of a reference raster (e.g. the reference orthomosaic or the DEM), opened once per process
+
+    :param path: Path to the raster
+    :type path: string
+    :return: The service
+    :rtype: ReferenceRasterService
+    """
+    if path not in _SERVICES:
+        _SERVICES[path] = ReferenceRasterService(path)
+    return _SERVICES[path]
+
+
+class ReferenceRasterService():
+    """Resamples a reference raster to the grids of chunks in memory. Only the blocks of the raster covering a chunk (plus a margin for the resampling kernel)
+    are read, and the most recently used blocks are kept, so that overlapping neighbouring chunks mostly read from memory."""
+    def __init__(self, path, block_size = 1024, max_cache_bytes = 512*1024**2):
+        """
+        :param path: Path to the raster
+        :type path: string
+        :param block_size: The size of the square blocks in pixels, defaults to 1024
+        :type block_size: int, optional
+        :param max_cache_bytes: The maximal size of the cached blocks, defaults to 512 MB
+        :type max_cache_bytes: int, optional
+        """
+        self.path = path
+        self.block_size = block_size
+        self.max_cache_bytes = max_cache_bytes
+
+        self.src = rasterio.open(path)
+
+        self.blocks = OrderedDict()
+        self.cache_bytes = 0
+        self.n_blocks_read = 0
+
+    def _block(self, block_row, block_col):
+        """A block of all bands, read on first use and moved to the end (most recently used) of the cache"""
+        key = (block_row, block_col)
+
+        if key in self.blocks:
+            self.blocks.move_to_end(key)
+            return self.blocks[key]
+
+        window = Window(block_col*self.block_size,
+                        block_row*self.block_size,
+                        min(self.block_size, self.src.width - block_col*self.block_size),
+                        min(self.block_size, self.src.height - block_row*self.block_size))
+
+        block = self.src.read(window=window)
+        self.n_blocks_read += 1
+
+        self.blocks[key] = block
+        self.cache_bytes += block.nbytes
+
+        # Evict the least recently used blocks
+        while self.cache_bytes > self.max_cache_bytes and len(self.blocks) > 1:
+            _, evicted = self.blocks.popitem(last=False)
+            self.cache_bytes -= evicted.nbytes
+
+        return block
+
+    def read_window(self, bounds, crs, margin = 4):
+        """Reads the part of the raster covering bounds in another CRS, aligned to the blocks
+
+        :param bounds: The bounds (min_x, min_y, max_x, max_y)
+        :type bounds: tuple
+        :param crs: The CRS of the bounds
+        :type crs: rasterio.crs.CRS or string
+        :param margin: Pixels added around the bounds (for the resampling kernel), defaults to 4
+        :type margin: int, optional
+        :return: The data and its transform, or None if the bounds are outside the raster
+        :rtype: ndarray(count, h, w), affine.Affine
+        """
+        bounds_src = transform_bounds(crs, self.src.crs, *bounds, densify_pts=21)
+
+        window = from_bounds(*bounds_src, transform=self.src.transform)
+
+        row_start = max(int(np.floor(window.row_off)) - margin, 0)
+        row_stop = min(int(np.ceil(window.row_off + window.height)) + margin, self.src.height)
+        col_start = max(int(np.floor(window.col_off)) - margin, 0)
+        col_stop = min(int(np.ceil(window.col_off + window.width)) + margin, self.src.width)
+
+        if row_stop <= row_start or col_stop <= col_start:
+            return None, None
+
+        block_rows = range(row_start // self.block_size, (row_stop - 1) // self.block_size + 1)
+        block_cols = range(col_start // self.block_size, (col_stop - 1) // self.block_size + 1)
+
+        data = np.concatenate([np.concatenate([self._block(block_row, block_col) for block_col in block_cols], axis=2)
+                               for block_row in block_rows], axis=1)
+
+        transform = self.src.window_transform(Window(block_cols[0]*self.block_size, block_rows[0]*self.block_size, data.shape[2], data.shape[1]))
+
+        return data, transform
+
+    def resample_to_grid(self, crs, transform, width, height, resampling = Resampling.cubic, nodata = 0):
+        """Resamples the raster to a grid, as resample_rgb_ortho_to_hsi_ortho/resample_dem_to_hsi_ortho but in memory
+
+        :param crs: The CRS of the grid
+        :type crs: rasterio.crs.CRS or string
+        :param transform: The transform of the grid
+        :type transform: affine.Affine
+        :param width: The width of the grid
+        :type width: int
+        :param height: The height of the grid
+        :type height: int
+        :param resampling: The resampling method, defaults to Resampling.cubic
+        :type resampling: rasterio.warp.Resampling, optional
+        :param nodata: The value of cells without data, defaults to 0
+        :type nodata: float, optional
+        :return: The raster in the grid
+        :rtype: ndarray(count, height, width)
+        """
+        destination = np.full((self.src.count, height, width), nodata, dtype=self.src.dtypes[0])
+
+        # The bounds of the grid, which may be rotated
+        x, y = transform * (np.array([0, width, 0, width]), np.array([0, 0, height, height]))
+
+        data, data_transform = self.read_window((x.min(), y.min(), x.max(), y.max()), crs)
+
+        if data is None:
+            return destination
+
+        reproject(source=data,
+                  destination=destination,
+                  src_transform=data_transform,
+                  src_crs=self.src.crs,
+                  src_nodata=self.src.nodata,
+                  dst_transform=transform,
+                  dst_crs=crs,
+                  dst_nodata=nodata,
+                  resampling=resampling)
+
+        return destination
@@ -1,6 +1,5 @@
 from spectral import envi
 import pymap3d as pm
-import pyproj
 import rasterio
 from pathlib import Path
 import json
@@ -14,6 +13,7 @@ import shutil
 from massipipe.pipeline import PipelineProcessor
 from scipy.spatial.transform import Rotation as RotLib
 from gref4hsi.utils.geometry_utils import CalibHSI
+from gref4hsi.utils.transform_utils import get_transformer
 
 
 # Helper function
@@ -32,7 +32,7 @@ def _get_geoid_undulation(src, latitude, longitude):
     # Transform coordinates to raster pixel coordinates
     if src.crs.is_projected:
         geodetic_epsg = 4326
-        transformer = pyproj.Transformer.from_crs(geodetic_epsg, src.crs, always_xy=True)
+        transformer = get_transformer(geodetic_epsg, src.crs, always_xy=True)
         x, y, _ = transformer.transform(longitude, latitude, 0*np.ones(longitude.shape))
         row, col = src.index(x, y)
 
@@ -0,0 +1,134 @@
+from collections import namedtuple
+
+import numpy as np
+
+
+# Averaging of bands into bins, as a matrix such that binned = spectra @ weights, and the centre wavelength and width of each bin
+SpectralBins = namedtuple('SpectralBins', ['weights', 'wavelengths', 'fwhm'])
+
+
+def wavelength_subset(wavelengths, wavelength_range):
+    """The bands within a wavelength range, as a slice so that only those bands need to be read from the h5 file
+
+    :param wavelengths: The band's centre wavelengths, in ascending order
+    :type wavelengths: ndarray(k,) or ndarray(k, 1)
+    :param wavelength_range: Minimal and maximal wavelength, or None for all bands
+    :type wavelength_range: tuple
+    :return: The bands within the range
+    :rtype: slice
+    """
+    if wavelength_range is None:
+        return slice(None)
+
+    wavelengths = np.array(wavelengths, dtype=np.float64).reshape(-1)
+
+    inside = np.nonzero((wavelengths >= wavelength_range[0]) & (wavelengths <= wavelength_range[1]))[0]
+
+    if inside.size == 0:
+        raise ValueError(f'No bands are within the wavelength range {wavelength_range}, the data covers {wavelengths.min()}-{wavelengths.max()}')
+
+    return slice(int(inside[0]), int(inside[-1]) + 1)
+
+def spectral_bins(wavelengths, fwhm, bin_width = None, bin_centers = None):
+    """Groups adjacent bands into bins, either of a fixed width from the first band or around target wavelengths.
+    Around targets, each bin extends halfway to the neighbouring targets (and as far beyond the first and last target).
+    Each bin is the mean of its bands, its wavelength the mean of their wavelengths and its FWHM the span of their wavelengths plus their mean FWHM.
+
+    :param wavelengths: The band's centre wavelengths, in ascending order
+    :type wavelengths: ndarray(k,) or ndarray(k, 1)
+    :param fwhm: The band's widths, or nan if undefined
+    :type fwhm: ndarray(k,) or float
+    :param bin_width: Width of bins, defaults to None
+    :type bin_width: float, optional
+    :param bin_centers: Target wavelengths, used instead of bin_width if given, defaults to None
+    :type bin_centers: list, optional
+    :return: The bins, or None if neither bin_width nor bin_centers are given
+    :rtype: SpectralBins
+    """
+    wavelengths = np.array(wavelengths, dtype=np.float64).reshape(-1)
+    k = wavelengths.size
+
+    fwhm = np.array(fwhm, dtype=np.float64).reshape(-1)
+    if fwhm.size == 1:
+        fwhm = np.full(k, fwhm[0])
+
+    if bin_centers is not None:
+        bin_centers = np.sort(np.array(bin_centers, dtype=np.float64).reshape(-1))
+        if bin_centers.size == 1:
+            raise ValueError('At least two bin centres are needed to define the bin edges')
+
+        edges_inner = 0.5*(bin_centers[1:] + bin_centers[:-1])
+        edges = np.concatenate(([bin_centers[0] - (edges_inner[0] - bin_centers[0])],
+                                edges_inner,
+                                [bin_centers[-1] + (bin_centers[-1] - edges_inner[-1])]))
+
+        bin_band = np.searchsorted(edges, wavelengths, side='right') - 1
+        bin_band[(wavelengths < edges[0]) | (wavelengths >= edges[-1])] = -1
+
+        n_bins = bin_centers.size
+    elif bin_width is not None:
+        bin_band = np.floor((wavelengths - wavelengths.min())/bin_width).astype(np.int64)
+
+        n_bins = bin_band.max() + 1
+    else:
+        return None
+
+    count = np.bincount(bin_band[bin_band >= 0], minlength=n_bins)
+
+    if bin_centers is not None and np.any(count == 0):
+        raise ValueError(f'No bands fall in the bins around {bin_centers[count == 0]}, use fewer bin centres or a wider wavelength range')
+
+    # Bins without bands can occur for gaps in the spectrum and are dropped
+    nonempty = np.nonzero(count > 0)[0]
+    bin_index = np.full(n_bins, -1)
+    bin_index[nonempty] = np.arange(nonempty.size)
+
+    bands = np.nonzero(bin_band >= 0)[0]
+    bins = bin_index[bin_band[bands]]
+
+    weights = np.zeros((k, nonempty.size))
+    weights[bands, bins] = 1/count[bin_band[bands]]
+
+    wavelengths_bins = wavelengths @ weights
+
+    span = np.array([np.ptp(wavelengths[bands[bins == i]]) for i in range(nonempty.size)])
+    fwhm_bins = span + fwhm @ weights
+
+    return SpectralBins(weights=weights, wavelengths=wavelengths_bins, fwhm=fwhm_bins)
+
+def read_spectral_binning(config):
+    """Reads the optional wavelength range and spectral binning from [Orthorectification]:
+        wavelength_range = 400, 900
+        spectral_bin_width = 10
+        spectral_bin_centers = 450, 500, 550 (used instead of spectral_bin_width if given)
+
+    :param config: The mission configuration
+    :type config: configparser.ConfigParser
+    :return: The wavelength range, bin width and bin centres (None where not given)
+    :rtype: tuple, float, list
+    """
+    def read_list(key):
+        try:
+            # Allows inline comments as in the configuration template
+            value = config['Orthorectification'][key].split('#')[0].strip()
+        except KeyError:
+            return None
+
+        if value in ['', 'None']:
+            return None
+
+        return [float(val) for val in value.split(',')]
+
+    wavelength_range = read_list('wavelength_range')
+    if wavelength_range is not None:
+        if len(wavelength_range) != 2:
+            raise ValueError('The wavelength_range must be given as "min, max"')
+        wavelength_range = tuple(wavelength_range)
+
+    bin_width = read_list('spectral_bin_width')
+    if bin_width is not None:
+        bin_width = bin_width[0]
+
+    bin_centers = read_list('spectral_bin_centers')
+
+    return wavelength_range, bin_width, bin_centers
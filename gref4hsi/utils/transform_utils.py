@@ -0,0 +1,197 @@
+import threading
+from collections import namedtuple
+
+import numpy as np
+from pyproj import CRS, Transformer
+
+
+# Constructing a Transformer means building a PROJ pipeline, which is far slower than transforming a small chunk of points.
+# Transformers are therefore built once per (source, target, always_xy) and reused. pyproj transformers must not be shared
+# between threads, so each thread of the process holds its own registry.
+_registry = threading.local()
+
+
+def _crs_key(crs):
+    """Normalizes the ways a CRS is given in the pipeline (epsg as int or string, 'EPSG:xxxx', WKT, pyproj/rasterio CRS) to a hashable key"""
+    if isinstance(crs, (int, np.integer)):
+        return 'EPSG:' + str(int(crs))
+    elif isinstance(crs, str):
+        crs = crs.strip()
+        if crs.isdigit():
+            return 'EPSG:' + crs
+        return crs
+    else:
+        return CRS.from_user_input(crs).srs
+
+def get_transformer(source, target, always_xy = False):
+    """Returns the cached transformer between two CRSs, building it on first use
+
+    :param source: The source CRS, as epsg code, 'EPSG:xxxx', WKT or CRS object
+    :type source: int, string or CRS
+    :param target: The target CRS, as epsg code, 'EPSG:xxxx', WKT or CRS object
+    :type target: int, string or CRS
+    :param always_xy: Whether to use the traditional GIS axis order (lon, lat) rather than the authority order, defaults to False
+    :type always_xy: bool, optional
+    :return: The transformer
+    :rtype: pyproj.Transformer
+    """
+    try:
+        transformers = _registry.transformers
+    except AttributeError:
+        transformers = _registry.transformers = {}
+
+    key = (_crs_key(source), _crs_key(target), bool(always_xy))
+
+    try:
+        return transformers[key]
+    except KeyError:
+        transformer = Transformer.from_crs(CRS.from_user_input(key[0]), CRS.from_user_input(key[1]), always_xy=always_xy)
+        transformers[key] = transformer
+        return transformer
+
+def transform_points(points, source, target, always_xy = False):
+    """Transforms an array of points in one call. The coordinates are along the last axis, so e.g. point clouds of shape (n, m, 3) are
+    transformed without reshaping. The axis order follows the CRS definitions, e.g. (lat, lon, h) for EPSG:4979 unless always_xy=True.
+
+    :param points: The points with 2 or 3 coordinates along the last axis
+    :type points: ndarray(..., 2) or ndarray(..., 3)
+    :param source: The source CRS
+    :type source: int, string or CRS
+    :param target: The target CRS
+    :type target: int, string or CRS
+    :param always_xy: Whether to use the traditional GIS axis order, defaults to False
+    :type always_xy: bool, optional
+    :return: The transformed points, same shape as the input
+    :rtype: ndarray
+    """
+    transformer = get_transformer(source, target, always_xy=always_xy)
+
+    points = np.asarray(points, dtype=np.float64)
+    points_flat = points.reshape((-1, points.shape[-1]))
+
+    coords = transformer.transform(*[points_flat[:, i] for i in range(points_flat.shape[1])])
+
+    return np.stack(coords, axis=-1).reshape(points.shape)
+
+
+# A polynomial approximation of a transform, valid over a limited extent such as one chunk. Points are normalized as (points - offset)/scale
+# before evaluating the monomials with the given exponents. max_residual is the largest 3D error found on the check points.
+ApproximateTransform = namedtuple('ApproximateTransform', ['coefficients', 'exponents', 'offset', 'scale', 'max_residual'])
+
+
+def _monomial_exponents(degree):
+    """Exponents (i, j, k) of all monomials x^i*y^j*z^k of total degree up to degree"""
+    return np.array([(i, j, k) for i in range(degree + 1)
+                               for j in range(degree + 1 - i)
+                               for k in range(degree + 1 - i - j)])
+
+def _design_matrix(points_normalized, exponents):
+    """Evaluates the monomials for each (normalized) point"""
+    # Powers of each coordinate are computed once and shared by the monomials
+    degree = exponents.max()
+    powers = np.ones((degree + 1, points_normalized.shape[0], 3))
+    for power in range(1, degree + 1):
+        powers[power] = powers[power - 1]*points_normalized
+
+    A = np.empty((points_normalized.shape[0], exponents.shape[0]))
+    for col, (i, j, k) in enumerate(exponents):
+        np.multiply(powers[i, :, 0], powers[j, :, 1], out=A[:, col])
+        A[:, col] *= powers[k, :, 2]
+    return A
+
+def fit_approximate_transform(points, source, target, degree = 2, n_control = 2000, n_check = 20000):
+    """Fits a polynomial in the source coordinates to each target coordinate, on control points sampled from the points. The error of the fit is 
+    measured against the exact transform on a separate and denser set of check points. The points with extremal coordinates are
+    in both sets, so that the check covers the whole extent of the points.
+
+    :param points: The points that are to be transformed, e.g. the ECEF point cloud of a chunk
+    :type points: ndarray(..., 3)
+    :param source: The source CRS
+    :type source: int, string or CRS
+    :param target: The target CRS
+    :type target: int, string or CRS
+    :param degree: Total degree of the polynomial, defaults to 2
+    :type degree: int, optional
+    :param n_control: Number of control points for the least squares fit, defaults to 2000
+    :type n_control: int, optional
+    :param n_check: Number of check points, defaults to 20000
+    :type n_check: int, optional
+    :return: The fitted transform, or None if there are too few valid points to fit it
+    :rtype: ApproximateTransform
+    """
+    points_flat = np.asarray(points, dtype=np.float64).reshape((-1, 3))
+    points_flat = points_flat[np.all(np.isfinite(points_flat), axis=1)]
+
+    exponents = _monomial_exponents(degree)
+
+    if points_flat.shape[0] < 2*exponents.shape[0]:
+        return None
+    
+    # Extremal points of each coordinate
+    extremes = points_flat[np.concatenate((np.argmin(points_flat, axis=0), np.argmax(points_flat, axis=0)))]
+
+    # Deterministic, so that the same chunk always gets the same transform
+    rng = np.random.default_rng(0)
+    control = np.concatenate((rng.choice(points_flat, size=min(n_control, points_flat.shape[0]), replace=False, axis=0), extremes), axis=0)
+    check = np.concatenate((rng.choice(points_flat, size=min(n_check, points_flat.shape[0]), replace=False, axis=0), extremes), axis=0)
+
+    # Normalization keeps the least squares problem well conditioned
+    offset = control.mean(axis=0)
+    scale = np.abs(control - offset).max()
+    if scale == 0:
+        return None
+
+    control_target = transform_points(control, source, target)
+
+    coefficients, _, _, _ = np.linalg.lstsq(_design_matrix((control - offset)/scale, exponents), control_target, rcond=None)
+
+    approx = ApproximateTransform(coefficients=coefficients, exponents=exponents, offset=offset, scale=scale, max_residual=np.nan)
+
+    residuals = np.linalg.norm(apply_approximate_transform(approx, check) - transform_points(check, source, target), axis=1)
+
+    return approx._replace(max_residual=residuals.max())
+
+def apply_approximate_transform(approx, points, block_size = 100000):
+    """Applies the fitted transform as one matrix multiply per block of points (the block size bounds the memory of the design matrix)
+
+    :param approx: The fitted transform
+    :type approx: ApproximateTransform
+    :param points: The points
+    :type points: ndarray(..., 3)
+    :param block_size: Number of points per matrix multiply, defaults to 100000
+    :type block_size: int, optional
+    :return: The transformed points, same shape as the input
+    :rtype: ndarray
+    """
+    points = np.asarray(points, dtype=np.float64)
+    points_flat = points.reshape((-1, 3))
+
+    points_transformed = np.zeros(points_flat.shape)
+    for start in range(0, points_flat.shape[0], block_size):
+        block = (points_flat[start:start + block_size] - approx.offset)/approx.scale
+        points_transformed[start:start + block_size] = _design_matrix(block, approx.exponents) @ approx.coefficients
+
+    return points_transformed.reshape(points.shape)
+
+def transform_points_approximate(points, source, target, tolerance, degree = 2):
+    """Transforms the points with a fitted polynomial if its maximal residual is within the tolerance, and exactly otherwise
+
+    :param points: The points
+    :type points: ndarray(..., 3)
+    :param source: The source CRS
+    :type source: int, string or CRS
+    :param target: The target CRS
+    :type target: int, string or CRS
+    :param tolerance: The maximal accepted residual (in units of the target CRS, i.e. meters for projected systems)
+    :type tolerance: float
+    :param degree: Total degree of the polynomial, defaults to 2
+    :type degree: int, optional
+    :return: The transformed points, the fitted transform (None if it could not be fitted) and whether it was used
+    :rtype: ndarray, ApproximateTransform, bool
+    """
+    approx = fit_approximate_transform(points, source, target, degree=degree)
+
+    if approx is None or not approx.max_residual <= tolerance:
+        return transform_points(points, source, target), approx, False
+    
+    return apply_approximate_transform(approx, points), approx, True
@@ -2,7 +2,7 @@
 import os
 import glob
 from datetime import datetime, timedelta, timezone
-from pyproj import CRS, Transformer
+from pyproj import CRS
 
 # Third party libraries
 from scipy.interpolate import griddata
@@ -19,6 +19,7 @@ from scipy.spatial.transform import Rotation as RotLib
 # Lib specific utilites
 from gref4hsi.utils.specim_parsing_utils import Specim
 from gref4hsi.utils.geometry_utils import CalibHSI
+from gref4hsi.utils.transform_utils import get_transformer
 
 
 """Reader for the h5 file format in UHI context. The user provides h5 hierarchy paths as values and keys are the names given to the attributes """
@@ -646,7 +647,7 @@ def point_cloud_to_dem(points, config, resolution_dem, lon0, lat0, h0, method='n
     # Define transformer
     crs_84 = CRS.from_epsg(epsg_wgs84)
     crs_dem = CRS.from_epsg(dem_epsg)
-    transformer = Transformer.from_crs(crs_84, crs_dem)
+    transformer = get_transformer(crs_84, crs_dem)
 
     # Transform extent
     (x, y, z) = transformer.transform(xx=lat_ext, yy=lon_ext, zz=h_ext)